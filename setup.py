@@ -7,6 +7,9 @@ setup(
     entry_points = {
         'console_scripts': [
             'spabademy = spabademy.script:main',
+            'spabademy-pack = spabademy.script:pack_main',
+            'spabademy-fleet = spabademy.script:fleet_main',
+            'spabademy-benchmark = spabademy.script:benchmark_main',
         ],
     },
 )
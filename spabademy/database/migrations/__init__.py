@@ -19,16 +19,92 @@ migration support.
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
 
+from __future__ import with_statement
+
+import time
+import threading
+import weakref
 from spabademy.database.migrations.db import AppliedPatch
 
 class SqlMigrationException(Exception):
     pass
 
+def _missing_patches(sess, repository_name, patch_names):
+    applied_names = AppliedPatch.get_applied_among(sess, repository_name,
+            patch_names)
+    return [patch_name for patch_name in patch_names
+            if patch_name not in applied_names]
+
+def _raise_missing(not_applied):
+    raise SqlMigrationException('The repository has an outdated schema '
+            'state and misses the patches %s' % (not_applied))
+
 def check_repository_has_patches(sess, repository_name, patch_names):
-    not_applied = []
-    for patch_name in patch_names:
-        if not AppliedPatch.is_applied(sess, repository_name, patch_name):
-            not_applied.append(patch_name)
+    not_applied = _missing_patches(sess, repository_name, patch_names)
     if len(not_applied) > 0:
-        raise SqlMigrationException('The repository has an outdated schema '
-                'state and misses the patches %s' % (not_applied))
+        _raise_missing(not_applied)
+
+class _GuardResult(object):
+    def __init__(self, checked_at, not_applied):
+        self.checked_at = checked_at
+        self.not_applied = not_applied
+
+class SchemaGuard(object):
+    """Checks that a repository has a set of required patches applied, like
+    ``check_repository_has_patches``, but caches the result per engine. Meant
+    to be instantiated once per process and checked at start-up and on health
+    checks.
+
+    *repository_name*
+      name of the repository the patches belong to.
+    *patch_names*
+      names of the patches that are required.
+    *ttl*
+      number of seconds a check result is trusted without asking the database
+      again. Once the result expired, only the required patches are looked
+      up again (see ``revalidate``).
+    """
+    def __init__(self, repository_name, patch_names, ttl=60.0,
+            clock=time.time):
+        self.repository_name = repository_name
+        self.patch_names = list(patch_names)
+        self.ttl = ttl
+        self._clock = clock
+        self._results = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def check(self, sess):
+        """Raises ``SqlMigrationException`` in case any of the required patches
+        are missing. Only contacts the database in case there is no cached
+        result for the session's engine or the cached result expired.
+        """
+        result = self._get_result(sess.connection().engine)
+        if result is None or self._clock() - result.checked_at >= self.ttl:
+            result = self.revalidate(sess)
+        if len(result.not_applied) > 0:
+            _raise_missing(result.not_applied)
+
+    def revalidate(self, sess):
+        """Looks up which of the required patches are applied, with a query
+        restricted to their names, so that its cost doesn't grow with the
+        number of applied patches. Every change of the required patches is
+        noticed. Returns the refreshed check result.
+        """
+        engine = sess.connection().engine
+        result = _GuardResult(self._clock(), _missing_patches(sess,
+                self.repository_name, self.patch_names))
+        with self._lock:
+            self._results[engine] = result
+        return result
+
+    def invalidate(self, engine=None):
+        """Drops the cached result for `engine` or for all engines."""
+        with self._lock:
+            if engine is None:
+                self._results.clear()
+            else:
+                self._results.pop(engine, None)
+
+    def _get_result(self, engine):
+        with self._lock:
+            return self._results.get(engine)
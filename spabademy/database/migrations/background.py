@@ -0,0 +1,228 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Provides a non-blocking counterpart of ``Driver``, which performs the
+migration operations within a background thread and immediately returns
+pending results. Services running an event loop can thereby keep serving
+while long patches run.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from __future__ import with_statement
+
+import sys
+import threading
+import Queue
+from sqlalchemy.orm.session import sessionmaker
+from spabademy.database.migrations.driver import Driver
+from spabademy.database.migrations.db import set_search_path
+from spabademy.database.migrations.db import enable_savepoints
+
+class ResultTimeout(Exception):
+    """Is raised when a pending result doesn't become available in time.
+    """
+    pass
+
+class PendingResult(object):
+    """Holds the result of an operation, which becomes available once the
+    operation finished.
+    """
+    def __init__(self):
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._value = None
+        self._exc_info = None
+
+    def done(self):
+        return self._finished.is_set()
+
+    def result(self, timeout=None):
+        """Returns the operation's return value or raises the operation's
+        exception. Waits at most `timeout` seconds for the operation to finish
+        (by default, waits indefinitely).
+        """
+        if not self._finished.wait(timeout):
+            raise ResultTimeout('operation did not finish within %s '
+                    'seconds' % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+    def exception(self, timeout=None):
+        """Returns the exception raised by the operation or None."""
+        if not self._finished.wait(timeout):
+            raise ResultTimeout('operation did not finish within %s '
+                    'seconds' % timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, callback):
+        """Calls `callback` with this pending result once the operation
+        finished. The callback is called from the background thread, so e.g.
+        an event loop needs to be notified in a thread-safe manner.
+        """
+        with self._lock:
+            if not self._finished.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, value=None, exc_info=None):
+        with self._lock:
+            self._value = value
+            self._exc_info = exc_info
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+class BackgroundDriver(object):
+    """Drives the upgrade and downgrade of a repository like ``Driver``, but
+    performs all operations within a background thread of its own. Each method
+    returns a ``PendingResult`` immediately. The operations are performed one
+    after the other, in the order they were requested.
+
+    The background thread holds a single connection of `engine`. Changes need
+    to be committed explicitly by calling ``commit``. Call ``close`` to stop
+    the background thread and release the connection. The remaining keyword
+    arguments `driver_options` are passed on to the ``Driver``.
+    """
+    def __init__(self, engine, patch_repo, schema=None, **driver_options):
+        # Invalid options are rejected here, not by the first operation.
+        if Driver(None, patch_repo, schema=schema,
+                **driver_options).uses_savepoints():
+            enable_savepoints(engine)
+        self._engine = engine
+        self.patch_repo = patch_repo
+        self.schema = schema
+        self._driver_options = driver_options
+        self._calls = Queue.Queue()
+        self._lock = threading.Lock()
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            conn = self._engine.connect()
+        except Exception:
+            # Without connection, all operations fail.
+            self._fail_outstanding(sys.exc_info())
+            return
+
+        sess = sessionmaker(bind=conn, autocommit=False)()
+        driver = Driver(sess, self.patch_repo, schema=self.schema,
+                **self._driver_options)
+        pending = None
+        exc_info = None
+        try:
+            while True:
+                func, args, kwargs, pending = self._calls.get()
+                if func is None:
+                    break
+                try:
+                    if self.schema is not None:
+                        # A rollback also reverts the search_path.
+                        set_search_path(sess, self.schema)
+                    value = func(driver, *args, **kwargs)
+                except Exception:
+                    pending._finish(exc_info=sys.exc_info())
+                else:
+                    pending._finish(value)
+        except BaseException:
+            exc_info = sys.exc_info()
+            raise
+        finally:
+            sess.close()
+            conn.close()
+            if exc_info is not None:
+                # The thread stops, so the current and all later operations
+                # fail instead of waiting forever.
+                if pending is not None and not pending.done():
+                    pending._finish(exc_info=exc_info)
+                self._fail_outstanding(exc_info)
+        pending._finish()
+
+    def _fail_outstanding(self, exc_info):
+        """Fails all requested operations and all operations requested from
+        now on with `exc_info`."""
+        with self._lock:
+            self._exc_info = exc_info
+        while True:
+            try:
+                _, _, _, pending = self._calls.get_nowait()
+            except Queue.Empty:
+                break
+            pending._finish(exc_info=exc_info)
+
+    def _submit(self, func, *args, **kwargs):
+        pending = PendingResult()
+        with self._lock:
+            if self._exc_info is None:
+                self._calls.put((func, args, kwargs, pending))
+                return pending
+        pending._finish(exc_info=self._exc_info)
+        return pending
+
+    def add_listener(self, listener):
+        """Registers `listener` to receive the events of the operations (see
+        ``Driver.add_listener``). The listener is called from the background
+        thread."""
+        return self._submit(Driver.add_listener, listener)
+
+    def init_repo(self, patches=None):
+        return self._submit(Driver.init_repo, patches)
+
+    def uninit_repo(self):
+        return self._submit(Driver.uninit_repo)
+
+    def applied_patches(self):
+        """Returns the pending list of applied patches (see
+        ``Driver.applied_patches``)."""
+        return self._submit(lambda driver: driver.applied_patches)
+
+    def unapplied_patches(self):
+        return self._submit(lambda driver: driver.unapplied_patches)
+
+    def upgrade_patches(self, patches, execute_sql=True):
+        return self._submit(Driver.upgrade_patches, patches,
+                execute_sql=execute_sql)
+
+    def upgrade(self, execute_sql=True):
+        return self._submit(Driver.upgrade, execute_sql=execute_sql)
+
+    def downgrade_patches(self, patches, execute_sql=True):
+        return self._submit(Driver.downgrade_patches, patches,
+                execute_sql=execute_sql)
+
+    def downgrade(self, execute_sql=True):
+        return self._submit(Driver.downgrade, execute_sql=execute_sql)
+
+    def commit(self):
+        return self._submit(Driver.commit)
+
+    def rollback(self):
+        return self._submit(Driver.rollback)
+
+    def close(self):
+        """Stops the background thread once all requested operations were
+        performed. The returned pending result finishes once the connection
+        was released.
+        """
+        return self._submit(None)
@@ -0,0 +1,184 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Tests the ``spabademy.database.migration.background`` module.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+import tempfile
+import shutil
+import os.path
+import threading
+from nose.tools import eq_
+from sqlalchemy.engine import create_engine
+from spabademy.database.migrations.patch import Patch
+from spabademy.database.migrations.patch import PatchRepository
+from spabademy.database.migrations.driver import PatchFailedException
+from spabademy.database.migrations.driver import TRANSACTION_SAVEPOINT
+from spabademy.database.migrations.events import MigrationListener
+from spabademy.database.migrations.events import COMMIT
+from spabademy.database.migrations.events import ROLLBACK
+from spabademy.database.migrations.background import BackgroundDriver
+from spabademy.database.migrations.background import PendingResult
+from spabademy.database.migrations.background import ResultTimeout
+
+class TestBackgroundDriver(object):
+    def __init__(self):
+        self.tmp_dir_path = None
+        self.repo = None
+        self.patch1 = None
+        self.patch2 = None
+
+    def setUp(self):
+        self.tmp_dir_path = tempfile.mkdtemp()
+        self.patch1 = Patch('patch1', upgrade_sql='CREATE TABLE t1(a integer);',
+                downgrade_sql='DROP TABLE t1;')
+        self.patch2 = Patch('patch2', depends_on_names=[('patch1', False)],
+                upgrade_sql='CREATE TABLE t2(a integer);',
+                downgrade_sql='DROP TABLE t2;')
+        self.repo = PatchRepository(repo_name='test_repo')
+        self.repo.add_patches(self.patch1, self.patch2)
+        self.repo.resolve_dependencies()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir_path)
+
+    def create_engine(self, name):
+        return create_engine('sqlite:///%s' % os.path.join(self.tmp_dir_path,
+                name))
+
+    def test_upgrade(self):
+        driver = BackgroundDriver(self.create_engine('test.db'), self.repo)
+        driver.init_repo()
+        driver.commit()
+        upgraded = driver.upgrade_patches([self.patch2])
+        applied = driver.applied_patches()
+        driver.commit()
+        eq_(upgraded.result(), [self.patch1, self.patch2])
+        eq_(applied.result(), [self.patch1, self.patch2])
+        driver.downgrade_patches([self.patch2]).result()
+        eq_(driver.applied_patches().result(), [self.patch1])
+        driver.rollback()
+        driver.close().result()
+
+        # The changes were committed.
+        driver = BackgroundDriver(self.create_engine('test.db'), self.repo)
+        eq_(driver.applied_patches().result(), [self.patch1, self.patch2])
+        driver.close().result()
+
+    def test_failure(self):
+        driver = BackgroundDriver(self.create_engine('test.db'), self.repo)
+        driver.init_repo()
+        failed = driver.init_repo()
+        try:
+            failed.result()
+        except RuntimeError:
+            pass
+        else:
+            assert False, 'expected RuntimeError'
+        assert isinstance(failed.exception(), RuntimeError)
+        # The driver remains usable.
+        eq_(driver.applied_patches().result(), [])
+        driver.close().result()
+
+    def test_savepoint_mode(self):
+        patch3 = Patch('patch3', depends_on_names=[('patch2', False)],
+                upgrade_sql='CREATE TABLE t1(a integer);')
+        self.repo.add_patch(patch3)
+        self.repo.resolve_dependencies()
+        driver = BackgroundDriver(self.create_engine('test.db'), self.repo,
+                transaction_mode=TRANSACTION_SAVEPOINT)
+        driver.init_repo()
+        driver.commit()
+        try:
+            driver.upgrade_patches([patch3]).result()
+        except PatchFailedException:
+            pass
+        else:
+            assert False, 'expected PatchFailedException'
+        # The patches before the failed one were committed.
+        driver.rollback()
+        eq_(driver.applied_patches().result(), [self.patch1, self.patch2])
+        driver.close().result()
+
+    def test_invalid_options(self):
+        try:
+            BackgroundDriver(self.create_engine('test.db'), self.repo,
+                    commit_every=0)
+        except ValueError:
+            pass
+        else:
+            assert False, 'expected ValueError'
+
+    def test_listener(self):
+        kinds = []
+        class Listener(MigrationListener):
+            def handle(self, event):
+                if event.kind in (COMMIT, ROLLBACK):
+                    kinds.append(event.kind)
+        driver = BackgroundDriver(self.create_engine('test.db'), self.repo)
+        driver.add_listener(Listener())
+        driver.init_repo()
+        driver.commit()
+        driver.rollback()
+        driver.close().result()
+        eq_(kinds, [COMMIT, ROLLBACK])
+
+    def test_thread_stopped(self):
+        class Listener(MigrationListener):
+            def handle(self, event):
+                if event.kind == COMMIT:
+                    raise SystemExit()
+        driver = BackgroundDriver(self.create_engine('test.db'), self.repo)
+        driver.add_listener(Listener())
+        committed = driver.commit()
+        queued = driver.applied_patches()
+        # The pending results fail instead of waiting for the stopped thread.
+        for pending in [committed, queued, driver.applied_patches(),
+                driver.close()]:
+            assert isinstance(pending.exception(timeout=10), SystemExit)
+
+    def test_concurrent_drivers(self):
+        drivers = [BackgroundDriver(self.create_engine('test%d.db' % i),
+                self.repo) for i in range(4)]
+        for driver in drivers:
+            driver.init_repo()
+            driver.commit()
+        pending = [driver.upgrade() for driver in drivers]
+        eq_([result.result() for result in pending],
+                [[self.patch1, self.patch2]] * 4)
+        for driver in drivers:
+            driver.close().result()
+
+class TestPendingResult(object):
+    def test_callback(self):
+        pending = PendingResult()
+        results = []
+        pending.add_done_callback(lambda p: results.append(p.result()))
+        eq_(pending.done(), False)
+        try:
+            pending.result(timeout=0)
+        except ResultTimeout:
+            pass
+        else:
+            assert False, 'expected ResultTimeout'
+
+        thread = threading.Thread(target=pending._finish, args=(42,))
+        thread.start()
+        thread.join()
+        eq_(results, [42])
+        pending.add_done_callback(lambda p: results.append(p.result()))
+        eq_(results, [42, 42])
@@ -0,0 +1,305 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Provides benchmarks of the patch loader, the planners and the driver on
+synthetic patch repositories of configurable size and shape.
+
+The repositories are generated deterministically from a seed, so runs with
+the same parameters are comparable. The results are plain dictionaries,
+which can be stored as JSON and compared against a baseline to detect
+regressions (see ``compare_results``).
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from __future__ import with_statement
+
+import os
+import os.path
+import sys
+import time
+import random
+import platform
+import sqlalchemy
+from sqlalchemy.engine import create_engine
+from sqlalchemy.orm.session import sessionmaker
+from spabademy.database.migrations.driver import Driver
+from spabademy.database.migrations.patch import DirPatchLoader
+from spabademy.database.migrations.patch import DirPatchRepositoryLoader
+from spabademy.database.migrations.patch import generate_upgrade_plan
+from spabademy.database.migrations.patch import generate_downgrade_plan
+
+# Version of the result format.
+RESULT_FORMAT = 1
+
+SHAPES = ('chain', 'fanout', 'diamond', 'random')
+
+# Number of patches per layer of the diamond shape.
+DIAMOND_WIDTH = 8
+
+# The patches' scripts modify rows of this table, which the driver benchmarks
+# create beforehand.
+DATA_TABLE = 'benchmark_data'
+
+def patch_name(num):
+    return 'p%06d' % num
+
+def _dependencies(shape, num, rand):
+    """Returns the numbers of the patches patch `num` depends on."""
+    if num == 0:
+        return []
+    if shape == 'chain':
+        return [num - 1]
+    elif shape == 'fanout':
+        return [0]
+    elif shape == 'diamond':
+        # Each patch depends on two neighbours of the layer before it.
+        if num < DIAMOND_WIDTH:
+            return [0]
+        layer_start = num - num % DIAMOND_WIDTH - DIAMOND_WIDTH
+        pos = num % DIAMOND_WIDTH
+        return sorted(set([layer_start + pos,
+                layer_start + (pos + 1) % DIAMOND_WIDTH]))
+    elif shape == 'random':
+        # Mostly recent patches, like in a real repository.
+        return sorted(set(max(0, num - 1 - int(rand.expovariate(0.05)))
+                for _ in range(rand.randint(1, 3))))
+    raise ValueError('unknown repository shape "%s"' % shape)
+
+def generate_repo(repo_dir, num_patches, shape, optional_ratio=0.0, seed=0):
+    """Writes a repository of `num_patches` patches of the given `shape` to
+    the new directory `repo_dir`:
+
+    ``chain``
+      each patch depends on the one before it.
+    ``fanout``
+      all patches depend on the first patch.
+    ``diamond``
+      the patches form layers and each patch depends on two patches of the
+      layer before it.
+    ``random``
+      each patch depends on one to three random, mostly recent patches.
+
+    A fraction `optional_ratio` of the patches gets an additional optional
+    dependency on a patch that doesn't exist and the same fraction of the
+    dependencies is marked optional.
+    """
+    rand = random.Random(seed)
+    os.makedirs(repo_dir)
+    with open(os.path.join(repo_dir, 'repo_name'), 'wb') as fp:
+        fp.write('benchmark_%s\n' % shape)
+    for num in xrange(num_patches):
+        name = patch_name(num)
+        patch_dir = os.path.join(repo_dir, name)
+        os.mkdir(patch_dir)
+        deps = []
+        for dep in _dependencies(shape, num, rand):
+            optional = rand.random() < optional_ratio
+            deps.append(patch_name(dep) + ('?' if optional else ''))
+        if rand.random() < optional_ratio:
+            deps.append('missing_%s?' % name)
+        with open(os.path.join(patch_dir, 'depends_on'), 'wb') as fp:
+            for dep in deps:
+                fp.write('%s\n' % dep)
+        with open(os.path.join(patch_dir, 'upgrade.sql'), 'wb') as fp:
+            fp.write("INSERT INTO %s VALUES ('%s');\n" % (DATA_TABLE, name))
+        with open(os.path.join(patch_dir, 'downgrade.sql'), 'wb') as fp:
+            fp.write("DELETE FROM %s WHERE name = '%s';\n" % (DATA_TABLE,
+                    name))
+
+def time_call(func, repeats, setup=None):
+    """Calls `func` `repeats` times and returns the list of the durations
+    in seconds. `setup` is called before each call, without being timed,
+    and its result is passed to `func`.
+    """
+    times = []
+    for _ in xrange(repeats):
+        arg = setup() if setup is not None else None
+        start = time.time()
+        if setup is not None:
+            func(arg)
+        else:
+            func()
+        times.append(time.time() - start)
+    return times
+
+def _result(benchmark, shape, num_patches, times):
+    times = sorted(times)
+    return {
+        'benchmark': benchmark,
+        'shape': shape,
+        'num_patches': num_patches,
+        'times': times,
+        'min': times[0],
+        'median': times[len(times) // 2],
+        }
+
+def _load_repo(repo_dir):
+    return DirPatchRepositoryLoader(patch_loader=DirPatchLoader())\
+            .load_repo(repo_dir)
+
+def benchmark_planners(repo_dir, shape, num_patches, repeats):
+    """Returns the results of the loader and planner benchmarks on the
+    repository `repo_dir`."""
+    results = [_result('load_repo', shape, num_patches,
+            time_call(lambda: _load_repo(repo_dir), repeats))]
+    results.append(_result('resolve_dependencies', shape, num_patches,
+            time_call(lambda repo: repo.resolve_dependencies(), repeats,
+                    setup=lambda: _load_repo(repo_dir))))
+
+    repo = _load_repo(repo_dir)
+    repo.resolve_dependencies()
+    patches = repo.patches.values()
+    results.append(_result('generate_upgrade_plan', shape, num_patches,
+            time_call(lambda: generate_upgrade_plan(applied_patches=[],
+                    to_be_applied_patches=patches), repeats)))
+    # Removing the first patch removes everything depending on it.
+    first_patch = repo.patches[patch_name(0)]
+    results.append(_result('generate_downgrade_plan', shape, num_patches,
+            time_call(lambda: generate_downgrade_plan(
+                    applied_patches=patches,
+                    to_be_removed_patches=[first_patch]), repeats)))
+    # The minimal set is computed on a fresh repository each time, so that
+    # cached dependency closures don't distort the results.
+    def setup_minimal():
+        repo = _load_repo(repo_dir)
+        repo.resolve_dependencies()
+        return repo
+    results.append(_result('calculate_minimal_deps', shape, num_patches,
+            time_call(lambda repo: Driver(None, repo).calculate_minimal_deps(
+                    repo.patches.values()), repeats, setup=setup_minimal)))
+    return results
+
+def benchmark_driver(repo_dir, db_path, shape, num_patches, repeats,
+        split_scripts=False):
+    """Returns the results of the driver's upgrade and downgrade of all
+    patches of the repository `repo_dir`, committed to the SQLite database
+    file `db_path`. The driver's messages are discarded."""
+    repo = _load_repo(repo_dir)
+    repo.resolve_dependencies()
+    engine = create_engine('sqlite:///%s' % db_path)
+    sess = sessionmaker(bind=engine)()
+    # The driver's messages would mix with the results.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        driver = Driver(sess, repo, split_scripts=split_scripts)
+        driver.init_repo()
+        sess.execute('CREATE TABLE %s(name varchar)' % DATA_TABLE)
+        driver.commit()
+        def upgrade():
+            driver.upgrade()
+            driver.commit()
+        def downgrade():
+            driver.downgrade()
+            driver.commit()
+        upgrade_times = []
+        downgrade_times = []
+        for _ in xrange(repeats):
+            upgrade_times.extend(time_call(upgrade, 1))
+            downgrade_times.extend(time_call(downgrade, 1))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        sess.close()
+        engine.dispose()
+    return [_result('driver_upgrade', shape, num_patches, upgrade_times),
+            _result('driver_downgrade', shape, num_patches, downgrade_times)]
+
+def run_benchmarks(work_dir, shapes=SHAPES, num_patches=10000,
+        driver_patches=1000, repeats=3, optional_ratio=0.1, seed=0,
+        split_scripts=False, progress=None):
+    """Generates a repository of `num_patches` patches per shape within the
+    empty directory `work_dir` and runs the loader and planner benchmarks on
+    it. The driver benchmarks run on repositories of `driver_patches` patches
+    of the same shapes (none, if `driver_patches` is 0). Each benchmark is
+    repeated `repeats` times. `progress`, if passed, is called with a
+    description of each step.
+
+    Returns a dictionary with the format version, the environment, the
+    parameters and the list of results.
+    """
+    results = []
+    for shape in shapes:
+        repo_dir = os.path.join(work_dir, '%s_%d' % (shape, num_patches))
+        if progress is not None:
+            progress('generating %d patches of shape %s' % (num_patches,
+                    shape))
+        generate_repo(repo_dir, num_patches, shape,
+                optional_ratio=optional_ratio, seed=seed)
+        if progress is not None:
+            progress('benchmarking loader and planners on %s' % shape)
+        results.extend(benchmark_planners(repo_dir, shape, num_patches,
+                repeats))
+        if driver_patches <= 0:
+            continue
+        if driver_patches != num_patches:
+            repo_dir = os.path.join(work_dir, '%s_%d' % (shape,
+                    driver_patches))
+            generate_repo(repo_dir, driver_patches, shape,
+                    optional_ratio=optional_ratio, seed=seed)
+        if progress is not None:
+            progress('benchmarking driver on %d patches of shape %s' % (
+                    driver_patches, shape))
+        results.extend(benchmark_driver(repo_dir, os.path.join(work_dir,
+                '%s.db' % shape), shape, driver_patches, repeats,
+                split_scripts=split_scripts))
+    return {
+        'format': RESULT_FORMAT,
+        'environment': environment(),
+        'parameters': {
+            'shapes': list(shapes),
+            'num_patches': num_patches,
+            'driver_patches': driver_patches,
+            'repeats': repeats,
+            'optional_ratio': optional_ratio,
+            'seed': seed,
+            'split_scripts': split_scripts,
+            },
+        'results': results,
+        }
+
+def environment():
+    """Returns a description of the environment the benchmarks run in."""
+    return {
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'platform': platform.platform(),
+        'argv': sys.argv,
+        }
+
+def compare_results(baseline, current, max_slowdown=1.2,
+        min_difference=0.01):
+    """Compares the `current` benchmark run to the `baseline` run (as returned
+    by ``run_benchmarks``) by the fastest time of each benchmark. Returns a
+    list of ``(benchmark, shape, num_patches, baseline_time, current_time,
+    regressed)`` tuples for the benchmarks of both runs. A benchmark
+    regressed in case it became slower by more than the factor
+    `max_slowdown` and by more than `min_difference` seconds, which keeps
+    the noise of very fast benchmarks from counting as regressions.
+    """
+    def key(result):
+        return (result['benchmark'], result['shape'], result['num_patches'])
+    baseline_times = dict((key(result), result['min'])
+            for result in baseline['results'])
+    comparison = []
+    for result in current['results']:
+        baseline_time = baseline_times.get(key(result))
+        if baseline_time is None:
+            continue
+        comparison.append(key(result) + (baseline_time, result['min'],
+                result['min'] > baseline_time * max_slowdown and
+                result['min'] - baseline_time > min_difference))
+    return comparison
@@ -0,0 +1,102 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Tests the ``spabademy.database.migration.benchmark`` module.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+import os.path
+import tempfile
+import shutil
+from nose.tools import eq_
+from spabademy.database.migrations.patch import DirPatchLoader
+from spabademy.database.migrations.patch import DirPatchRepositoryLoader
+from spabademy.database.migrations.benchmark import SHAPES
+from spabademy.database.migrations.benchmark import generate_repo
+from spabademy.database.migrations.benchmark import run_benchmarks
+from spabademy.database.migrations.benchmark import compare_results
+
+class TestBenchmark(object):
+    def __init__(self):
+        self.tmp_dir_path = None
+
+    def setUp(self):
+        self.tmp_dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir_path)
+
+    def load(self, shape, **kwargs):
+        repo_dir = os.path.join(self.tmp_dir_path, shape)
+        generate_repo(repo_dir, 20, shape, **kwargs)
+        repo = DirPatchRepositoryLoader(DirPatchLoader()).load_repo(repo_dir)
+        repo.resolve_dependencies()
+        return repo
+
+    def test_shapes(self):
+        def deps(repo, patch_name):
+            return sorted(patch.name
+                    for patch in repo.patches[patch_name].depends_on)
+        repo = self.load('chain')
+        eq_(len(repo.patches), 20)
+        eq_(repo.repo_name, 'benchmark_chain')
+        eq_(deps(repo, 'p000000'), [])
+        eq_(deps(repo, 'p000019'), ['p000018'])
+        repo = self.load('fanout')
+        eq_(deps(repo, 'p000019'), ['p000000'])
+        repo = self.load('diamond')
+        eq_(deps(repo, 'p000003'), ['p000000'])
+        eq_(deps(repo, 'p000009'), ['p000001', 'p000002'])
+        eq_(deps(repo, 'p000015'), ['p000000', 'p000007'])
+        repo = self.load('random')
+        for patch in repo.patches.itervalues():
+            assert all(dep.name < patch.name for dep in patch.depends_on)
+
+    def test_optional(self):
+        repo = self.load('random', optional_ratio=1.0)
+        for patch in repo.patches.itervalues():
+            eq_(patch.missing_deps, ['missing_%s' % patch.name])
+            assert all(is_optional
+                    for _, is_optional in patch.depends_on_names)
+
+    def test_run(self):
+        run = run_benchmarks(self.tmp_dir_path, num_patches=10,
+                driver_patches=5, repeats=2)
+        eq_(run['parameters']['num_patches'], 10)
+        eq_(sorted(set((result['benchmark'], result['shape'],
+                result['num_patches']) for result in run['results'])),
+                sorted([(benchmark, shape, 10) for shape in SHAPES
+                        for benchmark in ['load_repo', 'resolve_dependencies',
+                                'generate_upgrade_plan',
+                                'generate_downgrade_plan',
+                                'calculate_minimal_deps']] +
+                        [(benchmark, shape, 5) for shape in SHAPES
+                        for benchmark in ['driver_upgrade',
+                                'driver_downgrade']]))
+        for result in run['results']:
+            eq_(len(result['times']), 2)
+            eq_(result['min'], min(result['times']))
+
+def test_compare_results():
+    def run(*times):
+        return {'results': [{'benchmark': 'load_repo', 'shape': shape,
+                'num_patches': 10, 'min': time} for shape, time in times]}
+    eq_(compare_results(run(('chain', 1.0), ('fanout', 1.0),
+            ('diamond', 0.001)), run(('chain', 1.1), ('fanout', 1.5),
+            ('diamond', 0.002), ('random', 1.0))), [
+            ('load_repo', 'chain', 10, 1.0, 1.1, False),
+            ('load_repo', 'fanout', 10, 1.0, 1.5, True),
+            ('load_repo', 'diamond', 10, 0.001, 0.002, False)])
@@ -0,0 +1,260 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Provides bulk loading of the data files of patches (see ``DataFile``).
+
+On PostgreSQL, the files are loaded with ``COPY ... FROM STDIN``. Elsewhere,
+the rows are parsed and inserted with ``executemany`` in batches. Either way,
+the files are read piece by piece and never held in memory completely.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from __future__ import with_statement
+
+import re
+import itertools
+from sqlalchemy.exc import DBAPIError
+from spabademy.database.migrations.db import execute_statement
+from spabademy.database.migrations.patch import PatchNotFound
+
+# Number of rows passed to each ``executemany`` call.
+BATCH_SIZE = 1000
+
+# Number of bytes passed to the server at once by ``COPY``.
+_COPY_CHUNK_SIZE = 64 * 1024
+
+# Parameter styles whose parameters are passed as dictionaries.
+_NAMED_PARAMSTYLES = ('named', 'pyformat')
+
+_TEXT_ESCAPE_RE = re.compile(r'\\(?:([0-7]{1,3})|x([0-9A-Fa-f]{1,2})|(.))')
+_TEXT_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t',
+        'v': '\v'}
+
+class InvalidDataFile(Exception):
+    """Is raised when a row of a data file doesn't match the data file's
+    columns.
+    """
+    pass
+
+def load_data_file(sess, data_file, batch_size=None):
+    """Loads the rows of `data_file` into its table, within the session's
+    transaction. Returns the number of loaded rows or None, if unknown.
+    """
+    conn = sess.connection()
+    dialect = conn.engine.dialect
+    fp = _open(data_file)
+    with fp:
+        cursor = conn.connection.cursor()
+        try:
+            if getattr(cursor, 'copy_expert', None) is not None:
+                return _copy_from(cursor, dialect, data_file, fp)
+            statement = 'INSERT INTO %s (%s) VALUES (%s)' % (data_file.table,
+                    ', '.join(data_file.columns), ', '.join(_placeholders(
+                            dialect, len(data_file.columns))))
+            return _execute_many(cursor, dialect, statement,
+                    iter_rows(data_file, fp), batch_size)
+        finally:
+            cursor.close()
+
+def unload_data_file(sess, data_file, batch_size=None):
+    """Removes the rows of `data_file` from its table, according to the data
+    file's ``downgrade`` mode. Returns the number of removed rows or None, if
+    unknown.
+    """
+    conn = sess.connection()
+    dialect = conn.engine.dialect
+    if data_file.downgrade == 'truncate':
+        if dialect.name == 'postgresql':
+            return execute_statement(sess, 'TRUNCATE TABLE %s' % (
+                    data_file.table))
+        return execute_statement(sess, 'DELETE FROM %s' % data_file.table)
+
+    # Rows containing NULL values don't match and are kept.
+    statement = 'DELETE FROM %s WHERE %s' % (data_file.table, ' AND '.join(
+            '%s = %s' % (column, placeholder) for column, placeholder in zip(
+                    data_file.columns, _placeholders(dialect,
+                            len(data_file.columns)))))
+    fp = _open(data_file)
+    with fp:
+        cursor = conn.connection.cursor()
+        try:
+            return _execute_many(cursor, dialect, statement,
+                    iter_rows(data_file, fp), batch_size)
+        finally:
+            cursor.close()
+
+def _open(data_file):
+    fp = data_file.open()
+    if fp is None:
+        raise PatchNotFound('data file "%s"' % data_file.name)
+    return fp
+
+def _copy_from(cursor, dialect, data_file, fp):
+    statement = 'COPY %s (%s) FROM STDIN%s' % (data_file.table,
+            ', '.join(data_file.columns),
+            ' CSV' if data_file.format == 'csv' else '')
+    try:
+        cursor.copy_expert(statement, fp, size=_COPY_CHUNK_SIZE)
+    except dialect.dbapi.Error, e:
+        raise DBAPIError.instance(statement, None, e, dialect.dbapi.Error)
+    if cursor.rowcount < 0:
+        return None
+    return cursor.rowcount
+
+def _execute_many(cursor, dialect, statement, rows, batch_size):
+    if batch_size is None:
+        batch_size = BATCH_SIZE
+    total_rowcount = 0
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if len(batch) == 0:
+            break
+        if dialect.dbapi.paramstyle in _NAMED_PARAMSTYLES:
+            batch = [dict(('c%d' % pos, value)
+                    for pos, value in enumerate(row)) for row in batch]
+        try:
+            cursor.executemany(statement, batch)
+        except dialect.dbapi.Error, e:
+            raise DBAPIError.instance(statement, None, e, dialect.dbapi.Error)
+        if cursor.rowcount < 0:
+            total_rowcount = None
+        elif total_rowcount is not None:
+            total_rowcount += cursor.rowcount
+    return total_rowcount
+
+def _placeholders(dialect, num):
+    """Returns the placeholders of `num` parameters in the DB-API module's
+    parameter style. The named styles refer to the values of a row as
+    ``c0``, ``c1`` and so on (see ``_execute_many``)."""
+    paramstyle = dialect.dbapi.paramstyle
+    if paramstyle == 'qmark':
+        return ['?'] * num
+    elif paramstyle == 'format':
+        return ['%s'] * num
+    elif paramstyle == 'numeric':
+        return [':%d' % (pos + 1) for pos in range(num)]
+    elif paramstyle == 'named':
+        return [':c%d' % pos for pos in range(num)]
+    elif paramstyle == 'pyformat':
+        return ['%%(c%d)s' % pos for pos in range(num)]
+    raise ValueError('DB-API parameter style "%s" is not supported'
+            % paramstyle)
+
+def iter_rows(data_file, fp):
+    """Yields the rows of `data_file`, read from the binary file object `fp`,
+    as tuples of unicode strings (or None for NULL values). The values are
+    parsed like ``COPY`` does on PostgreSQL, so that the same rows are loaded
+    on all back-ends.
+    """
+    if data_file.format == 'csv':
+        rows = _iter_csv_rows(data_file, fp)
+    else:
+        rows = _iter_text_rows(fp)
+    num_columns = len(data_file.columns)
+    for row_num, row in enumerate(rows):
+        if len(row) != num_columns:
+            raise InvalidDataFile('data file "%s": row %d has %d values '
+                    'instead of %d' % (data_file.name, row_num + 1, len(row),
+                            num_columns))
+        yield tuple(row)
+
+def _iter_csv_rows(data_file, fp):
+    """Yields the values of the CSV records of `data_file`, read from `fp`.
+    Like with ``COPY ... CSV``, unquoted empty values are NULL, while quoted
+    empty values (``""``) are empty strings. Quoted values may contain
+    commas, doubled quotes and line breaks. An empty line is a record with a
+    single NULL value, which is only valid for data files with one column.
+    """
+    lines = iter(fp)
+    for line in lines:
+        if '"' in line:
+            yield _parse_csv_record(data_file, line, lines)
+            continue
+        line = line.rstrip('\n')
+        if line.endswith('\r'):
+            line = line[:-1]
+        yield [None if value == '' else value.decode('utf-8')
+                for value in line.split(',')]
+
+def _parse_csv_record(data_file, line, lines):
+    """Returns the values of the CSV record starting with `line`. Further
+    lines are read from `lines` while within a quoted value."""
+    values = []
+    chars = []
+    quoted = False
+    in_quotes = False
+    pos = 0
+    while True:
+        if pos == len(line):
+            if not in_quotes:
+                break
+            line = next(lines, None)
+            if line is None:
+                raise InvalidDataFile('data file "%s": unterminated quoted '
+                        'value' % data_file.name)
+            pos = 0
+            continue
+        char = line[pos]
+        pos += 1
+        if in_quotes:
+            if char != '"':
+                chars.append(char)
+            elif line[pos:pos + 1] == '"':
+                chars.append(char)
+                pos += 1
+            else:
+                in_quotes = False
+        elif char == '"':
+            in_quotes = quoted = True
+        elif char == ',':
+            values.append(_csv_value(chars, quoted))
+            chars = []
+            quoted = False
+        elif char in '\r\n':
+            break
+        else:
+            chars.append(char)
+    values.append(_csv_value(chars, quoted))
+    return values
+
+def _csv_value(chars, quoted):
+    value = ''.join(chars)
+    if value == '' and not quoted:
+        return None
+    return value.decode('utf-8')
+
+def _iter_text_rows(fp):
+    for line in fp:
+        line = line.rstrip('\n')
+        if line.endswith('\r'):
+            line = line[:-1]
+        if line == '\\.':
+            # End-of-data marker.
+            break
+        yield [_unescape_text(value) for value in line.split('\t')]
+
+def _unescape_text(value):
+    if value == '\\N':
+        return None
+    return _TEXT_ESCAPE_RE.sub(_unescape_match, value).decode('utf-8')
+
+def _unescape_match(match):
+    octal, hexadecimal, char = match.groups()
+    if octal is not None:
+        return chr(int(octal, 8) & 0xff)
+    if hexadecimal is not None:
+        return chr(int(hexadecimal, 16))
+    return _TEXT_ESCAPES.get(char, char)
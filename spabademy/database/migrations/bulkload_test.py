@@ -0,0 +1,167 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Tests the ``spabademy.database.migration.bulkload`` module.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from __future__ import with_statement
+
+import tempfile
+import shutil
+import os.path
+import gzip
+import sqlite3
+from nose.tools import eq_
+from nose.tools import raises
+from sqlalchemy.engine import create_engine
+from sqlalchemy.orm.session import sessionmaker
+from spabademy.database.migrations.patch import DataFile
+from spabademy.database.migrations.patch import FileScript
+from spabademy.database.migrations.bulkload import load_data_file
+from spabademy.database.migrations.bulkload import unload_data_file
+from spabademy.database.migrations.bulkload import iter_rows
+from spabademy.database.migrations.bulkload import InvalidDataFile
+from spabademy.database.migrations.bulkload import _placeholders
+from spabademy.database.migrations.bulkload import _execute_many
+
+class TestBulkLoad(object):
+    def __init__(self):
+        self.tmp_dir_path = None
+        self.sess = None
+
+    def setUp(self):
+        self.tmp_dir_path = tempfile.mkdtemp()
+        engine = create_engine('sqlite://')
+        self.sess = sessionmaker(bind=engine, autocommit=False)()
+        self.sess.execute('CREATE TABLE t(a integer, b text)')
+
+    def tearDown(self):
+        self.sess.close()
+        shutil.rmtree(self.tmp_dir_path)
+
+    def data_file(self, name, contents, downgrade='truncate'):
+        path = os.path.join(self.tmp_dir_path, name)
+        with open(path, 'wb') as fp:
+            fp.write(contents)
+        return DataFile(name, 't', ['a', 'b'], FileScript(path), downgrade)
+
+    def rows(self):
+        return self.sess.execute('SELECT a, b FROM t ORDER BY a').fetchall()
+
+    def test_csv(self):
+        data_file = self.data_file('rows.csv', '1,"x,y"\n2,\n3,"a\nb"\n')
+        with data_file.open() as fp:
+            eq_(list(iter_rows(data_file, fp)), [(u'1', u'x,y'),
+                    (u'2', None), (u'3', u'a\nb')])
+
+    def test_csv_quoting(self):
+        # Quoted empty values are empty strings, like with COPY ... CSV.
+        data_file = self.data_file('rows.csv',
+                '1,""\n2,\n"3","say ""hi"""\r\n4,"a,\r\nb"')
+        with data_file.open() as fp:
+            eq_(list(iter_rows(data_file, fp)), [(u'1', u''), (u'2', None),
+                    (u'3', u'say "hi"'), (u'4', u'a,\r\nb')])
+        eq_(load_data_file(self.sess, data_file), 4)
+        eq_(self.sess.execute('SELECT a FROM t WHERE b IS NULL').fetchall(),
+                [(2,)])
+        eq_(self.sess.execute("SELECT a FROM t WHERE b = ''").fetchall(),
+                [(1,)])
+
+    @raises(InvalidDataFile)
+    def test_csv_unterminated(self):
+        data_file = self.data_file('rows.csv', '1,"x\n2,y\n')
+        with data_file.open() as fp:
+            list(iter_rows(data_file, fp))
+
+    def test_csv_empty_line(self):
+        # An empty line is a NULL value, like with COPY ... CSV.
+        path = os.path.join(self.tmp_dir_path, 'rows.csv')
+        with open(path, 'wb') as fp:
+            fp.write('x\n\n""\n')
+        data_file = DataFile('rows.csv', 't', ['b'], FileScript(path))
+        with data_file.open() as fp:
+            eq_(list(iter_rows(data_file, fp)), [(u'x',), (None,), (u'',)])
+        eq_(load_data_file(self.sess, data_file), 3)
+
+    @raises(InvalidDataFile)
+    def test_csv_empty_line_with_columns(self):
+        data_file = self.data_file('rows.csv', '1,x\n\n2,y\n')
+        with data_file.open() as fp:
+            list(iter_rows(data_file, fp))
+
+    def test_text(self):
+        data_file = self.data_file('rows.tsv',
+                '1\tx\\ty\n2\t\\N\n3\t\\303\\244\\\\\n\\.\n4\tz\n')
+        with data_file.open() as fp:
+            eq_(list(iter_rows(data_file, fp)), [(u'1', u'x\ty'),
+                    (u'2', None), (u'3', u'\xe4\\')])
+
+    @raises(InvalidDataFile)
+    def test_invalid_row(self):
+        data_file = self.data_file('rows.csv', '1,x\n2\n')
+        with data_file.open() as fp:
+            list(iter_rows(data_file, fp))
+
+    def test_load_and_truncate(self):
+        data = ''.join('%d,v%d\n' % (i, i) for i in range(25))
+        gz_path = os.path.join(self.tmp_dir_path, 'rows.csv.gz')
+        with gzip.GzipFile(gz_path, 'wb') as fp:
+            fp.write(data)
+        data_file = DataFile('rows.csv', 't', ['a', 'b'],
+                FileScript(os.path.join(self.tmp_dir_path, 'rows.csv')))
+        eq_(load_data_file(self.sess, data_file, batch_size=7), 25)
+        eq_(self.rows(), [(i, u'v%d' % i) for i in range(25)])
+        unload_data_file(self.sess, data_file)
+        eq_(self.rows(), [])
+
+    def test_load_and_delete(self):
+        self.sess.execute("INSERT INTO t VALUES (0, 'other')")
+        data_file = self.data_file('rows.csv', '1,x\n2,y\n',
+                downgrade='delete')
+        eq_(load_data_file(self.sess, data_file), 2)
+        eq_(unload_data_file(self.sess, data_file, batch_size=1), 2)
+        eq_(self.rows(), [(0, u'other')])
+
+class _DBAPI(object):
+    Error = sqlite3.Error
+
+    def __init__(self, paramstyle):
+        self.paramstyle = paramstyle
+
+class _Dialect(object):
+    def __init__(self, paramstyle):
+        self.dbapi = _DBAPI(paramstyle)
+
+def test_paramstyles():
+    eq_(_placeholders(_Dialect('format'), 2), ['%s', '%s'])
+    eq_(_placeholders(_Dialect('pyformat'), 2), ['%(c0)s', '%(c1)s'])
+    # SQLite understands the other styles.
+    for paramstyle in ['qmark', 'numeric', 'named']:
+        dialect = _Dialect(paramstyle)
+        conn = sqlite3.connect(':memory:')
+        cursor = conn.cursor()
+        cursor.execute('CREATE TABLE t(a integer, b text)')
+        eq_(_execute_many(cursor, dialect, 'INSERT INTO t (a, b) VALUES '
+                '(%s)' % ', '.join(_placeholders(dialect, 2)),
+                iter([(u'1', u'x'), (u'2', None)]), None), 2)
+        eq_(cursor.execute('SELECT a, b FROM t ORDER BY a').fetchall(),
+                [(1, u'x'), (2, None)])
+        conn.close()
+
+@raises(ValueError)
+def test_unknown_paramstyle():
+    _placeholders(_Dialect('other'), 1)
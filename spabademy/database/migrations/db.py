@@ -19,14 +19,27 @@ storage of the repository's state.
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
 
+import hashlib
+import weakref
+import threading
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.schema import ForeignKey
 from sqlalchemy.types import Integer
 from sqlalchemy.types import String
+from sqlalchemy.types import Float
+from sqlalchemy.types import Boolean
 from sqlalchemy.schema import Column
 from sqlalchemy.schema import MetaData
 from sqlalchemy.orm import relation
 from sqlalchemy.orm import backref
+from sqlalchemy.sql import select
+from sqlalchemy.sql import bindparam
+from sqlalchemy.exc import DBAPIError
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 _metadata = MetaData()
 _Base = declarative_base(metadata=_metadata)
@@ -50,6 +63,30 @@ class Repository(_Base):
         return "<MigrateRepository('%d','%s')>" % (self.repository_id,
                 self.repository_name)
 
+    @staticmethod
+    def remove(sess, repository_id):
+        """Removes the repository `repository_id` together with all its
+        applied patches, without loading them into the session.
+        """
+        applied_table = AppliedPatch.__table__
+        sess.execute(applied_table.delete()\
+                .where(applied_table.c.repository_id == repository_id))
+        for table in (PatchProgress.__table__, PatchRun.__table__):
+            if table.exists(sess.connection()):
+                sess.execute(table.delete()\
+                        .where(table.c.repository_id == repository_id))
+        repo_table = Repository.__table__
+        sess.execute(repo_table.delete()\
+                .where(repo_table.c.repository_id == repository_id))
+
+    @staticmethod
+    def get_id(sess, repository_name):
+        """Returns the id of repository `repository_name` or None in case the
+        repository does not exist.
+        """
+        return _execute_cached(sess, _REPOSITORY_ID_SELECT,
+                repository_name=repository_name).scalar()
+
 class AppliedPatch(_Base):
     """@DynamicAttrs"""
     __tablename__ = 'migrate_applied_patches'
@@ -75,16 +112,233 @@ class AppliedPatch(_Base):
                 .filter(Repository.repository_name == repository_name)\
                 .all()
 
+    @staticmethod
+    def get_names(sess, repository_name):
+        """Returns the names of the applied patches for repository
+        `repository_name` as frozenset. Unlike ``get_all``, no ORM objects are
+        loaded.
+        """
+        return frozenset(row[0] for row in _execute_cached(sess,
+                _APPLIED_NAMES_SELECT, repository_name=repository_name))
+
+    @staticmethod
+    def get_applied_among(sess, repository_name, patch_names):
+        """Returns the names of those of the patches `patch_names` that are
+        applied for repository `repository_name` as frozenset. Only the
+        requested names are read, not all applied patches.
+        """
+        patch_names = sorted(set(patch_names))
+        applied_names = set()
+        # Keep below the bind parameter limits of the back-ends.
+        for start in xrange(0, len(patch_names), _MAX_IN_PARAMS):
+            applied_names.update(row[0] for row in sess.execute(
+                    _APPLIED_NAMES_SELECT.where(
+                            _applied_table.c.patch_name.in_(
+                                    patch_names[start:start +
+                                            _MAX_IN_PARAMS])),
+                    {'repository_name': repository_name}))
+        return frozenset(applied_names)
+
+    @staticmethod
+    def get_digest(sess, repository_name):
+        """Returns the hex encoded SHA-1 digest over the sorted names of all
+        applied patches of repository `repository_name` (see
+        ``names_digest``), read with a single query. The digest differs for
+        any two different sets of applied patches.
+        """
+        return names_digest(AppliedPatch.get_names(sess, repository_name))
+
     @staticmethod
     def is_applied(sess, repository_name, patch_name):
-        patch = sess.query(AppliedPatch)\
-                .join(Repository)\
-                .filter(Repository.repository_name == repository_name)\
-                .filter(AppliedPatch.patch_name == patch_name)\
-                .first()
-        return patch is not None
+        row = _execute_cached(sess, _IS_APPLIED_SELECT,
+                repository_name=repository_name,
+                patch_name=patch_name).first()
+        return row is not None
+
+    @staticmethod
+    def add_all(sess, repository_id, patch_names):
+        """Marks the patches `patch_names` as applied for the repository
+        `repository_id`, using a single multi-row insert.
+        """
+        params = [{'repository_id': repository_id, 'patch_name': patch_name}
+                for patch_name in patch_names]
+        if len(params) > 0:
+            _execute_cached(sess, _APPLIED_INSERT, params)
+
+    @staticmethod
+    def remove_all(sess, repository_id, patch_names):
+        """Marks the patches `patch_names` as no longer applied for the
+        repository `repository_id`, using set-based deletes.
+        """
+        table = AppliedPatch.__table__
+        patch_names = list(patch_names)
+        # Keep below the bind parameter limits of the back-ends (e.g. SQLite
+        # only allows 999 parameters per statement by default).
+        for start in xrange(0, len(patch_names), _MAX_IN_PARAMS):
+            sess.execute(table.delete()\
+                    .where(table.c.repository_id == repository_id)\
+                    .where(table.c.patch_name.in_(
+                            patch_names[start:start + _MAX_IN_PARAMS])))
+
+_MAX_IN_PARAMS = 500
+
+def names_digest(patch_names):
+    """Returns the hex encoded SHA-1 digest over the `patch_names`. The names
+    are sorted by their UTF-8 encoding, independent of any database collation,
+    and each is prefixed by its length.
+    """
+    digest = hashlib.sha1()
+    for patch_name in sorted(_encode_name(patch_name)
+            for patch_name in patch_names):
+        digest.update('%d:%s' % (len(patch_name), patch_name))
+    return digest.hexdigest()
+
+def _encode_name(patch_name):
+    if isinstance(patch_name, unicode):
+        return patch_name.encode('utf-8')
+    return patch_name
+
+class PatchProgress(_Base):
+    """Records the key of the last row transformed by a resumable Python
+    migration of a patch (see ``PythonMigration``). The key is stored JSON
+    encoded. A row without a key yet (JSON ``null``) records that the migration
+    was started, i.e. that the patch's script and data files ran before it.
+
+    @DynamicAttrs"""
+    __tablename__ = 'migrate_patch_progress'
+
+    repository_id = Column(Integer,
+            ForeignKey('migrate_repositories.repository_id'), primary_key=True)
+    patch_name = Column(String, primary_key=True)
+    operation = Column(String, primary_key=True)
+    last_key = Column(String)
+
+    @staticmethod
+    def create_table(sess):
+        """Creates the table, in case the repository was initialised before
+        the table existed."""
+        PatchProgress.__table__.create(sess.connection(), checkfirst=True)
+
+    @staticmethod
+    def get(sess, repository_id, patch_name, operation):
+        """Returns the last key recorded for the `operation` of patch
+        `patch_name` or None."""
+        return PatchProgress.get_state(sess, repository_id, patch_name,
+                operation)[1]
+
+    @staticmethod
+    def get_state(sess, repository_id, patch_name, operation):
+        """Returns a tuple of whether progress was recorded for the
+        `operation` of patch `patch_name` and the last key recorded (None, if
+        no chunk was recorded yet)."""
+        table = PatchProgress.__table__
+        last_key = sess.execute(select([table.c.last_key],
+                (table.c.repository_id == repository_id) &
+                (table.c.patch_name == patch_name) &
+                (table.c.operation == operation))).scalar()
+        if last_key is None:
+            return (False, None)
+        return (True, json.loads(last_key))
+
+    @staticmethod
+    def set(sess, repository_id, patch_name, operation, last_key):
+        PatchProgress.clear(sess, repository_id, patch_name, operation)
+        sess.execute(PatchProgress.__table__.insert(), {
+                'repository_id': repository_id, 'patch_name': patch_name,
+                'operation': operation, 'last_key': json.dumps(last_key)})
+
+    @staticmethod
+    def clear(sess, repository_id, patch_name, operation):
+        table = PatchProgress.__table__
+        sess.execute(table.delete()\
+                .where(table.c.repository_id == repository_id)\
+                .where(table.c.patch_name == patch_name)\
+                .where(table.c.operation == operation))
+
+class PatchRun(_Base):
+    """Records a single upgrade or downgrade of a patch: when it started
+    (seconds since the epoch), how long it took (in seconds), how many
+    statements it executed, how many rows they affected (if known), whether
+    it succeeded and on which database it ran.
+
+    @DynamicAttrs"""
+    __tablename__ = 'migrate_patch_runs'
+
+    run_id = Column(Integer, primary_key=True)
+    repository_id = Column(Integer,
+            ForeignKey('migrate_repositories.repository_id'), index=True)
+    patch_name = Column(String)
+    operation = Column(String)
+    started_at = Column(Float)
+    duration = Column(Float)
+    num_statements = Column(Integer)
+    rowcount = Column(Integer)
+    succeeded = Column(Boolean)
+    database = Column(String)
+
+    @staticmethod
+    def create_table(sess):
+        """Creates the table, in case the repository was initialised before
+        the table existed."""
+        PatchRun.__table__.create(sess.connection(), checkfirst=True)
+
+    @staticmethod
+    def add_all(sess, repository_id, runs):
+        """Records the `runs`, a list of dictionaries with the values of the
+        table's columns (except for ``run_id`` and ``repository_id``), using a
+        single multi-row insert.
+        """
+        params = []
+        for run in runs:
+            run = dict(run)
+            run['repository_id'] = repository_id
+            params.append(run)
+        if len(params) > 0:
+            sess.execute(PatchRun.__table__.insert(), params)
+
+    @staticmethod
+    def get_durations(sess, repository_name, patch_names=None):
+        """Returns the list of ``(patch_name, operation, duration,
+        succeeded)`` tuples of all recorded runs of the repository
+        `repository_name`, in the order they started. Optionally, only the runs
+        of the patches `patch_names` are returned.
+        """
+        table = PatchRun.__table__
+        query = select([table.c.patch_name, table.c.operation,
+                table.c.duration, table.c.succeeded],
+                _repo_table.c.repository_name == repository_name,
+                from_obj=[table.join(_repo_table)])\
+                .order_by(table.c.started_at)
+        if patch_names is not None:
+            query = query.where(table.c.patch_name.in_(list(patch_names)))
+        return [tuple(row) for row in sess.execute(query)]
 
-DB_CLASSES = [Repository, AppliedPatch]
+DB_CLASSES = [Repository, AppliedPatch, PatchProgress, PatchRun]
+
+_repo_table = Repository.__table__
+_applied_table = AppliedPatch.__table__
+
+# The book-keeping statements are built once and their compiled form is cached
+# per dialect in ``_compiled_cache``.
+_REPOSITORY_ID_SELECT = select([_repo_table.c.repository_id],
+        _repo_table.c.repository_name == bindparam('repository_name'))
+_APPLIED_NAMES_SELECT = select([_applied_table.c.patch_name],
+        _repo_table.c.repository_name == bindparam('repository_name'),
+        from_obj=[_applied_table.join(_repo_table)])
+_IS_APPLIED_SELECT = select([_applied_table.c.patch_name],
+        (_repo_table.c.repository_name == bindparam('repository_name')) &
+        (_applied_table.c.patch_name == bindparam('patch_name')),
+        from_obj=[_applied_table.join(_repo_table)]).limit(1)
+_APPLIED_INSERT = _applied_table.insert()
+
+_compiled_cache = {}
+
+def _execute_cached(sess, stmt, *multiparams, **params):
+    """Execute the statement `stmt` on the session's connection, re-using
+    the compiled statement from earlier executions.
+    """
+    conn = sess.connection().execution_options(compiled_cache=_compiled_cache)
+    return conn.execute(stmt, *multiparams, **params)
 
 def create_tables(bind, checkfirst=True):
     dialect = bind.engine.dialect
@@ -97,24 +351,157 @@ def drop_tables(bind, checkfirst=True):
     for dbcls in reversed(DB_CLASSES):
         dbcls.__table__.drop(bind, checkfirst=checkfirst)
 
-def _clear_connection(sess):
+# Engines on which ``enable_savepoints`` was called.
+_savepoint_engines = weakref.WeakKeyDictionary()
+_savepoint_engines_lock = threading.Lock()
+
+def enable_savepoints(engine):
+    """Makes savepoints usable on the connections of `engine`. The pysqlite
+    module commits implicitly before statements other than DML ones, e.g.
+    before ``SAVEPOINT`` or ``CREATE TABLE``, which ends the savepoint's
+    transaction. For SQLite engines, pysqlite's transaction handling is
+    therefore disabled and the transactions are begun explicitly instead.
+    Other engines are left unchanged. Enabling savepoints more than once has
+    no further effect.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    with _savepoint_engines_lock:
+        if engine in _savepoint_engines:
+            return
+        _savepoint_engines[engine] = True
+    def begin(conn):
+        # The pool's proxy doesn't pass on attribute assignments.
+        conn.connection.connection.isolation_level = None
+        conn.execute('BEGIN')
+    event.listen(engine, 'begin', begin)
+
+def set_timeouts(sess, lock_timeout=None, statement_timeout=None):
+    """Limits the time statements of the session wait for locks and the time
+    they run, in seconds. On PostgreSQL, the limits apply until the end of the
+    current transaction. On SQLite, the lock timeout is set as the busy
+    timeout of the connection and the statement timeout is ignored. Other
+    back-ends are left unchanged.
+    """
+    dialect = sess.connection().engine.dialect
+    if dialect.name == 'postgresql':
+        if lock_timeout is not None:
+            sess.execute('SET LOCAL lock_timeout = %d' % (lock_timeout * 1000))
+        if statement_timeout is not None:
+            sess.execute('SET LOCAL statement_timeout = %d' % (
+                    statement_timeout * 1000))
+    elif dialect.name == 'sqlite' and lock_timeout is not None:
+        sess.execute('PRAGMA busy_timeout = %d' % (lock_timeout * 1000))
+
+# SQLSTATE of PostgreSQL's lock_not_available error.
+_PG_LOCK_NOT_AVAILABLE = '55P03'
+
+def is_lock_timeout(error):
+    """Returns whether the ``DBAPIError`` `error` was caused by a statement
+    that timed out waiting for a lock."""
+    orig = getattr(error, 'orig', None)
+    if getattr(orig, 'pgcode', None) == _PG_LOCK_NOT_AVAILABLE:
+        return True
+    # SQLite only reports its locking errors by message.
+    message = str(orig)
+    return 'database is locked' in message or \
+            'database table is locked' in message
+
+def set_search_path(sess, schema):
+    """Restricts the search_path of the session's connection to `schema`
+    (PostgreSQL only), so that the patches and the book-keeping tables are
+    applied to that schema.
+    """
+    preparer = sess.connection().engine.dialect.identifier_preparer
+    sess.execute('SET search_path = %s' % preparer.quote_identifier(schema))
+
+def list_schemas(sess, pattern):
+    """Returns the sorted names of the schemas matching the SQL ``LIKE``
+    pattern `pattern` (PostgreSQL only).
+    """
+    res = sess.execute('SELECT nspname FROM pg_catalog.pg_namespace '
+            'WHERE nspname LIKE :pattern ORDER BY nspname',
+            {'pattern': pattern})
+    return [row[0] for row in res]
+
+def clear_connection(sess, schema=None):
     """Patches might not always reset the connection's role or search_path, so
-    explicitly do that here (currently only for PostgreSQL).
+    explicitly do that here (currently only for PostgreSQL). The search_path
+    is reset to `schema` or, by default, to ``public``.
     """
     dialect = sess.connection().engine.dialect
     if dialect.name == 'postgresql':
         sess.execute('SET ROLE NONE')
-        sess.execute('SET search_path = public')
+        if schema is None:
+            sess.execute('SET search_path = public')
+        else:
+            set_search_path(sess, schema)
 
-def execute_script(sess, sql_text):
+def execute_script(sess, sql_text, schema=None):
     """Execute an SQL script on a session. Works around limitation in SQLite
     back-end, which doesn't allow multiple statements, by using the
     SQLite-specific ``executescript()``-method, when available. The approach
     was borrowed from ``migrate.versioning.script.sql``.
+
+    Afterwards, the search_path is reset to `schema` (see
+    ``clear_connection``). Returns the number of affected rows or None, if
+    unknown.
     """
     dbapi = sess.connection().engine.raw_connection()
     if getattr(dbapi, 'executescript', None) is not None:
+        total_changes = dbapi.total_changes
         dbapi.executescript(sql_text)
+        rowcount = dbapi.total_changes - total_changes
     else:
-        sess.execute(sql_text)
-    _clear_connection(sess)
+        rowcount = sess.execute(sql_text).rowcount
+        if rowcount < 0:
+            rowcount = None
+    clear_connection(sess, schema)
+    return rowcount
+
+def execute_statement(sess, statement):
+    """Execute a single SQL statement directly on the DB-API connection of
+    the session, i.e. within the session's transaction. The statement is
+    passed on unmodified, without any parameter processing by SQLAlchemy or
+    the DB-API module. Returns the number of affected rows or None, if
+    unknown.
+    """
+    conn = sess.connection()
+    dialect = conn.engine.dialect
+    cursor = conn.connection.cursor()
+    try:
+        try:
+            cursor.execute(statement)
+        except dialect.dbapi.Error, e:
+            raise DBAPIError.instance(statement, None, e, dialect.dbapi.Error)
+        rowcount = cursor.rowcount
+    finally:
+        cursor.close()
+    if rowcount < 0:
+        return None
+    return rowcount
+
+# Dialects whose DB-API modules accept several statements within one call.
+_MULTI_STATEMENT_DIALECTS = frozenset(['postgresql'])
+
+def execute_batch(sess, statements):
+    """Execute the list of SQL `statements` like ``execute_statement``. In
+    case the DB-API module accepts several statements within one call, the
+    batch is sent to the server at once. Returns the total number of affected
+    rows or None, if unknown.
+    """
+    dialect = sess.connection().engine.dialect
+    if dialect.name in _MULTI_STATEMENT_DIALECTS and len(statements) > 1:
+        # Only the row count of the last statement would be known. The
+        # semicolons are put on lines of their own, so they don't end up in
+        # a trailing line comment of the preceding statement.
+        execute_statement(sess, '\n;\n'.join(statements))
+        return None
+    total_rowcount = 0
+    for statement in statements:
+        rowcount = execute_statement(sess, statement)
+        if rowcount is None:
+            total_rowcount = None
+        elif total_rowcount is not None:
+            total_rowcount += rowcount
+    return total_rowcount
@@ -19,31 +19,160 @@
 
 from __future__ import with_statement
 
+import sys
+import heapq
+import itertools
+import threading
+import Queue
+from sqlalchemy.orm.session import sessionmaker
 from spabademy.database.migrations.db import create_tables
 from spabademy.database.migrations.db import drop_tables
 from spabademy.database.migrations.db import Repository
 from spabademy.database.migrations.db import AppliedPatch
+from spabademy.database.migrations.db import PatchProgress
 from spabademy.database.migrations.db import execute_script
+from spabademy.database.migrations.db import execute_statement
+from spabademy.database.migrations.db import execute_batch
+from spabademy.database.migrations.db import clear_connection
+from spabademy.database.migrations.db import set_search_path
+from spabademy.database.migrations.db import set_timeouts
+from spabademy.database.migrations.db import is_lock_timeout
+from spabademy.database.migrations import online
+from spabademy.database.migrations.bulkload import load_data_file
+from spabademy.database.migrations.bulkload import unload_data_file
+from spabademy.database.migrations.pymigration import load_python_migration
+from spabademy.database.migrations.sqlsplit import split_statements
+from spabademy.database.migrations.sqlsplit import iter_statements
 from spabademy.database.migrations.patch import Patch
+from spabademy.database.migrations.patch import script_text
+from spabademy.database.migrations.patch import iter_script_chunks
 from spabademy.database.migrations.patch import generate_upgrade_plan
 from spabademy.database.migrations.patch import generate_downgrade_plan
+from spabademy.database.migrations.plan import MigrationPlan
+from spabademy.database.migrations.plan import PlanMismatch
+from spabademy.database.migrations import events
+from spabademy.database.migrations.events import MigrationEvent
+from spabademy.database.migrations.events import PLAN_COMPUTED
+from spabademy.database.migrations.events import PATCH_START
+from spabademy.database.migrations.events import PATCH_END
+from spabademy.database.migrations.events import STATEMENT_START
+from spabademy.database.migrations.events import STATEMENT_END
+from spabademy.database.migrations.events import BOOKKEEPING_WRITE
+from spabademy.database.migrations.events import CHUNK_END
+from spabademy.database.migrations.events import COMMIT
+from spabademy.database.migrations.events import ROLLBACK
+from spabademy.database.migrations.events import RETRY
 from sqlalchemy.exc import DatabaseError
 
+# Transaction modes of the driver (see ``Driver``).
+TRANSACTION_SINGLE = 'single'
+TRANSACTION_PER_PATCH = 'per-patch'
+TRANSACTION_SAVEPOINT = 'savepoint'
+TRANSACTION_MODES = (TRANSACTION_SINGLE, TRANSACTION_PER_PATCH,
+        TRANSACTION_SAVEPOINT)
+
 class PatchFailedException(Exception):
-    """Is raised when an SQL snippet fails to apply.
+    """Is raised when an SQL snippet fails to apply. The database's `error`
+    is kept, if known.
     """
-    def __init__(self, operation, details):
+    def __init__(self, operation, details, error=None):
         Exception.__init__(self, operation)
         self.details = details
+        self.error = error
 
 class Driver(object):
     """Drives the upgrade and downgrade of a repository by applying or
     downgrading patches.
+
+    In case a `schema` is passed (PostgreSQL only), the patches and the
+    book-keeping tables are applied to that schema. The session's search_path
+    needs to be set to the schema beforehand (see ``set_search_path``) and is
+    reset to it after each patch.
+
+    In case `split_scripts` is set, the patch scripts are split into single
+    statements, which are executed one by one on the session's connection.
+    Otherwise, each script is executed at once.
+
+    In case `stream_batch_size` is set, the patch scripts are streamed
+    instead: they are read piece by piece and split into statements, which are
+    executed in batches of up to `stream_batch_size` statements on the
+    session's connection. Only the current batch is kept in memory, no matter
+    how large the scripts are.
+
+    The patches' data files are bulk loaded after the upgrade script and
+    unloaded before the downgrade script (see ``load_data_file``), in batches
+    of `data_batch_size` rows where the rows are inserted one by one. The
+    scripts of patches with data files are always split into statements.
+
+    The patches' Python migrations (see ``PythonMigration``) run last on
+    upgrade and first on downgrade. They transform chunks of `chunk_size`
+    rows. In case `commit_chunks` is set, the session is committed after each
+    chunk and the key of the chunk's last row is recorded, so that an
+    interrupted migration resumes after the last committed chunk. The
+    book-keeping is then also written and committed after each patch, instead
+    of once at the end.
+
+    The `transaction_mode` determines how much of an upgrade or downgrade is
+    committed at once:
+
+    ``TRANSACTION_SINGLE``
+      nothing is committed by the driver, the caller commits all patches
+      together (the default).
+    ``TRANSACTION_PER_PATCH``
+      each patch is committed together with its book-keeping entry, so a
+      failure only loses the failed patch.
+    ``TRANSACTION_SAVEPOINT``
+      each patch is applied within a savepoint and the session is committed
+      after every `commit_every` patches. A failed patch is rolled back to its
+      savepoint, the patches completed before it are committed and then the
+      failure is raised. The patch scripts are always split into statements,
+      so that they are executed within the savepoint (see also
+      ``enable_savepoints``).
+
+    In case an `online` policy (see ``OnlinePolicy``) is passed, the patches
+    are applied in online mode: each patch runs with the policy's lock and
+    statement timeouts within a savepoint. When the patch times out waiting for
+    a lock, it is rolled back to the savepoint and retried after a jittered,
+    exponentially growing wait, until the policy's retry budget is used up.
+    The outer transaction and the patches applied before are kept. As with the
+    savepoint transaction mode, the patch scripts are always split into
+    statements. Python migrations can't commit their chunks in online mode
+    or in the savepoint transaction mode; ``ValueError`` is raised for these
+    combinations.
     """
-    def __init__(self, sess, patch_repo):
+    def __init__(self, sess, patch_repo, schema=None, split_scripts=False,
+            stream_batch_size=None, data_batch_size=None, chunk_size=None,
+            commit_chunks=False, transaction_mode=TRANSACTION_SINGLE,
+            commit_every=1, online=None):
+        if transaction_mode not in TRANSACTION_MODES:
+            raise ValueError('unknown transaction mode "%s"' % (
+                    transaction_mode))
+        if commit_every < 1:
+            raise ValueError('commit_every needs to be at least 1, not %d' % (
+                    commit_every))
+        # Committing a chunk within a patch's savepoint would only release
+        # the savepoint and the patch's commit would then commit the outer
+        # transaction early.
+        if commit_chunks and transaction_mode == TRANSACTION_SAVEPOINT:
+            raise ValueError('chunks cannot be committed in the savepoint '
+                    'transaction mode')
+        if commit_chunks and online is not None:
+            raise ValueError('chunks cannot be committed in online mode')
         self.sess = sess
         self.patch_repo = patch_repo
+        self.schema = schema
+        self.split_scripts = split_scripts
+        self.stream_batch_size = stream_batch_size
+        self.data_batch_size = data_batch_size
+        self.chunk_size = chunk_size
+        self.commit_chunks = commit_chunks
+        self.transaction_mode = transaction_mode
+        self.commit_every = commit_every
+        self.online = online
         self.repo_name = self.patch_repo.repo_name
+        self._repository_id = None
+        self._applied_names = None
+        self._listeners = []
 
     def init_repo(self, patches=None):
         create_tables(self.sess.connection())
@@ -58,9 +187,11 @@ class Driver(object):
         self.sess.add(dbrepo)
         self.sess.flush()
 
-        if patches is not None:
-            for patch in patches:
-                self.sess.add(AppliedPatch(dbrepo.repository_id, patch.name))
+        patch_names = [patch.name for patch in patches] \
+                if patches is not None else []
+        AppliedPatch.add_all(self.sess, dbrepo.repository_id, patch_names)
+        self._repository_id = dbrepo.repository_id
+        self._applied_names = set(patch_names)
 
     def uninit_repo(self):
         # Delete this repository
@@ -68,7 +199,9 @@ class Driver(object):
         if dbrepo is None:
             raise RuntimeError('repository "%s" does not exist' % (
                     self.repo_name))
-        self.sess.delete(dbrepo)
+        Repository.remove(self.sess, dbrepo.repository_id)
+        self.sess.expunge(dbrepo)
+        self.reset_cache()
 
         # Check whether any repositories remain - if not, delete the tables too.
         num_remaining_repos = self.sess.query(Repository).count()
@@ -81,64 +214,502 @@ class Driver(object):
                 .first()
         return existing_repo
 
+    def _get_repository_id(self):
+        if self._repository_id is None:
+            self._repository_id = Repository.get_id(self.sess, self.repo_name)
+            if self._repository_id is None:
+                raise RuntimeError('repository "%s" does not exist' % (
+                        self.repo_name))
+        return self._repository_id
+
+    def _get_applied_names(self):
+        # The set of applied patch names is read once and afterwards kept
+        # up-to-date by the driver's own modifications.
+        if self._applied_names is None:
+            self._applied_names = set(AppliedPatch.get_names(self.sess,
+                    self.repo_name))
+        return self._applied_names
+
+    def reset_cache(self):
+        """Forgets the cached book-keeping state, so that it is read from the
+        database again on next use. Needs to be called in case the book-keeping
+        tables were modified behind the driver's back, e.g. by rolling back the
+        session.
+        """
+        self._repository_id = None
+        self._applied_names = None
+
+    @property
+    def applied_patch_names(self):
+        return frozenset(self._get_applied_names())
+
     @property
     def applied_patches(self):
-        db_patches = AppliedPatch.get_all(self.sess, self.repo_name)
         patches = []
-        for dbpatch in db_patches:
-            if dbpatch.patch_name in self.patch_repo.patches:
-                patches.append(self.patch_repo.patches[dbpatch.patch_name])
+        for patch_name in sorted(self._get_applied_names()):
+            if patch_name in self.patch_repo.patches:
+                patches.append(self.patch_repo.patches[patch_name])
             else:
-                patches.append(Patch(dbpatch.patch_name))
+                patches.append(Patch(patch_name))
         return patches
 
     @property
     def unapplied_patches(self):
-        applied = set(self.applied_patches)
+        applied_names = self._get_applied_names()
         unapplied = [patch for patch in self.patch_repo.patches.itervalues() \
-                if patch not in applied]
+                if patch.name not in applied_names]
         return unapplied
 
+    def add_listener(self, listener):
+        """Registers `listener` (a ``MigrationListener``) to receive the
+        events of the driver's operations.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _emit(self, kind, timestamp, **fields):
+        event = MigrationEvent(kind, timestamp, **fields)
+        for listener in self._listeners:
+            listener.handle(event)
+
+    def _start_step(self, kind=None, **fields):
+        """Returns the start time of a step and emits the step's start event
+        of type `kind`, if any. Without listeners, nothing is measured and None
+        is returned.
+        """
+        if not self._listeners:
+            return None
+        timestamp = events.clock()
+        if kind is not None:
+            self._emit(kind, timestamp, **fields)
+        return timestamp
+
+    def _end_step(self, kind, start, **fields):
+        """Emits the end event of the step started at `start`."""
+        if start is None:
+            return
+        timestamp = events.clock()
+        self._emit(kind, timestamp, duration=timestamp - start, **fields)
+
+    def _run_patch(self, operation, patch, execute_sql):
+        """Executes the script of `patch` for the `operation` (``'upgrade'``
+        or ``'downgrade'``), if any, and loads or unloads its data files. In
+        case `execute_sql` is false, nothing is executed.
+        """
+        start = self._start_step(PATCH_START, operation=operation,
+                patch=patch.name)
+        rowcount = None
+        failed = True
+        try:
+            if execute_sql:
+                rowcount = self._apply_patch(operation, patch)
+            failed = False
+        finally:
+            self._end_step(PATCH_END, start, operation=operation,
+                    patch=patch.name, rowcount=rowcount, failed=failed)
+
+    def uses_savepoints(self):
+        """Returns whether patches are applied within savepoints, which need
+        to be enabled on SQLite engines (see ``enable_savepoints``)."""
+        return self.transaction_mode == TRANSACTION_SAVEPOINT or \
+                self.online is not None
+
+    def _apply_patch(self, operation, patch):
+        """Applies `patch` for the `operation` and returns the total number of
+        rows affected by its statements or None, if unknown."""
+        if self.online is None:
+            return self._apply_patch_once(operation, patch)
+        set_timeouts(self.sess, self.online.lock_timeout,
+                self.online.statement_timeout)
+        delays = self.online.iter_delays()
+        attempt = 1
+        while True:
+            self.sess.begin_nested()
+            try:
+                rowcount = self._apply_patch_once(operation, patch)
+            except PatchFailedException, e:
+                self.sess.rollback()
+                if e.error is None or not is_lock_timeout(e.error):
+                    raise
+                delay = next(delays, None)
+                if delay is None:
+                    print " (giving up after %d attempts)" % attempt
+                    raise
+                print " (attempt %d timed out waiting for a lock, retrying " \
+                        "in %.2fs)" % (attempt, delay)
+                start = self._start_step()
+                online.sleep(delay)
+                self._end_step(RETRY, start, operation=operation,
+                        patch=patch.name, attempt=attempt,
+                        error=e.details[0] if e.details else None)
+                attempt += 1
+            else:
+                self.sess.commit()
+                return rowcount
+
+    def _apply_patch_once(self, operation, patch):
+        if operation == 'upgrade':
+            script = patch.upgrade_script
+            migration = load_python_migration(patch.upgrade_py,
+                    '%s/upgrade.py' % patch.name)
+        else:
+            script = patch.downgrade_script
+            migration = load_python_migration(patch.downgrade_py,
+                    '%s/downgrade.py' % patch.name)
+        # Scripts are possibly read from disk on each access.
+        if self.stream_batch_size is not None:
+            sql = iter_script_chunks(script)
+        else:
+            sql = script_text(script)
+        if sql is None and len(patch.data_files) == 0 and migration is None:
+            return None
+        for patch_name in patch.missing_deps:
+            print " (ignoring optional missing patch '%s')" % patch_name
+        with _TranslateErrors("patch %s failed '%s'" % (operation,
+                patch.name), include_statement=self.split_scripts or
+                self.stream_batch_size is not None or
+                len(patch.data_files) > 0 or self.uses_savepoints()):
+            rowcount = None
+            if operation == 'downgrade':
+                if migration is not None:
+                    self._run_python_migration(operation, patch, migration)
+                for data_file in reversed(patch.data_files):
+                    rowcount = _add_rowcount(rowcount, self._execute_statement(
+                            patch, lambda: 'unload data file %s from %s' % (
+                                    data_file.name, data_file.table),
+                            unload_data_file, self.sess, data_file,
+                            self.data_batch_size))
+            data_files = patch.data_files
+            if operation == 'upgrade' and migration is not None and \
+                    self.commit_chunks and \
+                    self._migration_started(operation, patch):
+                # The script and the data files were committed together with
+                # the migration's first chunk.
+                print " (skipping the script and data files committed before)"
+                sql = None
+                data_files = []
+            if sql is not None:
+                rowcount = _add_rowcount(rowcount, self._execute(patch, sql))
+            if operation == 'upgrade':
+                for data_file in data_files:
+                    rowcount = _add_rowcount(rowcount, self._execute_statement(
+                            patch, lambda: 'load data file %s into %s' % (
+                                    data_file.name, data_file.table),
+                            load_data_file, self.sess, data_file,
+                            self.data_batch_size))
+                if migration is not None:
+                    self._run_python_migration(operation, patch, migration)
+            return rowcount
+
+    def _migration_started(self, operation, patch):
+        PatchProgress.create_table(self.sess)
+        return PatchProgress.get_state(self.sess, self._get_repository_id(),
+                patch.name, operation)[0]
+
+    def _run_python_migration(self, operation, patch, migration):
+        repository_id = self._get_repository_id()
+        last_key = None
+        if self.commit_chunks:
+            PatchProgress.create_table(self.sess)
+            started, last_key = PatchProgress.get_state(self.sess,
+                    repository_id, patch.name, operation)
+            if last_key is not None:
+                print " (resuming after key %r)" % (last_key,)
+            elif not started:
+                # Once committed with the first chunk, the row tells a resumed
+                # upgrade that the script and data files were applied.
+                PatchProgress.set(self.sess, repository_id, patch.name,
+                        operation, None)
+        num_rows = 0
+        start = self._start_step()
+        for rows in migration.iter_chunks(self.sess, self.chunk_size,
+                last_key, restart=self.commit_chunks):
+            migration.transform(self.sess.connection(), rows)
+            num_rows += len(rows)
+            last_key = rows[-1][migration.key]
+            if self.commit_chunks:
+                PatchProgress.set(self.sess, repository_id, patch.name,
+                        operation, last_key)
+                self.commit()
+            print " transformed %d rows (up to key %r)" % (num_rows, last_key)
+            self._end_step(CHUNK_END, start, operation=operation,
+                    patch=patch.name, rowcount=len(rows), last_key=last_key)
+            start = self._start_step()
+        if self.commit_chunks:
+            PatchProgress.clear(self.sess, repository_id, patch.name,
+                    operation)
+
+    def _execute(self, patch, sql):
+        """Executes the script `sql` of `patch` and returns the total number
+        of affected rows or None, if unknown."""
+        rowcount = None
+        if self.stream_batch_size is not None:
+            for batch in _statement_batches(self.sess, sql,
+                    self.stream_batch_size):
+                rowcount = _add_rowcount(rowcount, self._execute_statement(
+                        patch, lambda: ';\n'.join(batch), execute_batch,
+                        self.sess, batch))
+            clear_connection(self.sess, self.schema)
+            return rowcount
+        # The data files are loaded on the session's connection, so the
+        # scripts of patches with data files need to be executed on it, too.
+        # The same goes for patches applied within a savepoint.
+        if not self.split_scripts and len(patch.data_files) == 0 and \
+                not self.uses_savepoints():
+            return self._execute_statement(patch, sql, execute_script,
+                    self.sess, sql, self.schema)
+        dialect_name = self.sess.connection().engine.dialect.name
+        for statement in split_statements(sql, dialect_name):
+            rowcount = _add_rowcount(rowcount, self._execute_statement(patch,
+                    statement, execute_statement, self.sess, statement))
+        clear_connection(self.sess, self.schema)
+        return rowcount
+
+    def _execute_statement(self, patch, statement, execute, *args):
+        """Calls `execute` with `args` to execute the `statement` of `patch`.
+        The `statement` is passed as text or as callable returning the text,
+        which is only called in case there are listeners. Returns the number
+        of affected rows or None, if unknown.
+        """
+        if not self._listeners:
+            return execute(*args)
+        if callable(statement):
+            statement = statement()
+        start = self._start_step(STATEMENT_START, patch=patch.name,
+                statement=statement)
+        rowcount = None
+        failed = True
+        try:
+            rowcount = execute(*args)
+            failed = False
+        finally:
+            self._end_step(STATEMENT_END, start, patch=patch.name,
+                    statement=statement, rowcount=rowcount, failed=failed)
+        return rowcount
+
+    def _plan_computed(self, operation, start, plan):
+        if start is not None:
+            self._end_step(PLAN_COMPUTED, start, operation=operation,
+                    patches=[patch.name for patch in plan])
+
     def upgrade_patches(self, patches, execute_sql=True):
-        dbrepo = self._get_repo()
+        repository_id = self._get_repository_id()
+        start = self._start_step()
         applied_patches = self.applied_patches
         plan = generate_upgrade_plan(applied_patches=applied_patches,
                 to_be_applied_patches=patches)
+        self._plan_computed('upgrade', start, plan)
+        self._run_plan('upgrade', repository_id, plan, execute_sql)
+        return plan
+
+    def _run_plan(self, operation, repository_id, plan, execute_sql):
+        """Runs the patches of `plan` and writes their book-keeping entries,
+        committing according to the transaction mode.
+        """
+        mode = self.transaction_mode
+        if mode == TRANSACTION_SINGLE and self.commit_chunks:
+            mode = TRANSACTION_PER_PATCH
+        num_uncommitted = 0
         for patch in plan:
-            print "applying patch '%s'" % patch.name
-            self.sess.add(AppliedPatch(dbrepo.repository_id, patch.name))
-            if patch.upgrade_sql is not None and execute_sql:
-                for patch_name in patch.missing_deps:
-                    print " (ignoring optional missing patch '%s')" % patch_name
-                with _TranslateErrors("patch upgrade failed '%s'" % (
-                        patch.name)):
-                    execute_script(self.sess, patch.upgrade_sql)
+            if operation == 'upgrade':
+                print "applying patch '%s'" % patch.name
+            else:
+                print "removing patch '%s'" % patch.name
+            if mode == TRANSACTION_SAVEPOINT:
+                self._run_patch_in_savepoint(operation, repository_id, patch,
+                        execute_sql, num_uncommitted)
+                num_uncommitted += 1
+                if num_uncommitted >= self.commit_every:
+                    self.commit()
+                    num_uncommitted = 0
+            else:
+                self._run_patch(operation, patch, execute_sql)
+                if mode == TRANSACTION_PER_PATCH:
+                    self._write_bookkeeping(operation, repository_id,
+                            [patch.name])
+                    self.commit()
+        if mode == TRANSACTION_SINGLE:
+            self._write_bookkeeping(operation, repository_id,
+                    [patch.name for patch in plan])
+
+    def _run_patch_in_savepoint(self, operation, repository_id, patch,
+            execute_sql, num_uncommitted):
+        """Runs `patch` and writes its book-keeping entry within a savepoint.
+        In case of a failure, the savepoint is rolled back and the
+        `num_uncommitted` patches run before are committed.
+        """
+        self.sess.begin_nested()
+        try:
+            self._run_patch(operation, patch, execute_sql)
+            self._write_bookkeeping(operation, repository_id, [patch.name])
+        except:
+            exc_info = sys.exc_info()
+            start = self._start_step()
+            self.sess.rollback()
+            self._end_step(ROLLBACK, start, patch=patch.name)
+            if num_uncommitted > 0:
+                print " (committing the %d patches completed before)" % (
+                        num_uncommitted)
+                self.commit()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.sess.commit()
+
+    def make_plan(self, operation, patches):
+        """Returns the ``MigrationPlan`` for upgrading to (or downgrading,
+        depending on the `operation`) `patches`, which can be stored and
+        applied later on by ``apply_plan``.
+        """
+        fingerprint = AppliedPatch.get_digest(self.sess, self.repo_name)
+        start = self._start_step()
+        if operation == 'upgrade':
+            plan = generate_upgrade_plan(applied_patches=self.applied_patches,
+                    to_be_applied_patches=patches)
+        else:
+            plan = generate_downgrade_plan(
+                    applied_patches=self.applied_patches,
+                    to_be_removed_patches=patches)
+        self._plan_computed(operation, start, plan)
+        known_patches = self.patch_repo.patches
+        return MigrationPlan(self.repo_name, operation, fingerprint,
+                [(patch.name, patch.content_hash if patch.name in known_patches
+                        else None) for patch in plan])
+
+    def apply_plan(self, plan, execute_sql=True):
+        """Applies the precomputed `plan` (see ``make_plan``), without
+        computing a plan of its own. The planned patches are looked up by name
+        in the patch repository; their dependencies don't need to be resolved.
+
+        Raises ``PlanMismatch`` in case the applied patches differ from the
+        ones at planning time (compared by their digest, read with a single
+        query) or in case a patch's contents changed. The plan can therefore be
+        applied to any database with the same patches applied.
+        """
+        if plan.repo_name != self.repo_name:
+            raise PlanMismatch('plan is for repository "%s", not "%s"' % (
+                    plan.repo_name, self.repo_name))
+        fingerprint = AppliedPatch.get_digest(self.sess, self.repo_name)
+        if fingerprint != plan.fingerprint:
+            raise PlanMismatch('the applied patches changed since planning')
+        start = self._start_step()
+        patches = []
+        for patch_name, content_hash in plan.patches:
+            if content_hash is None:
+                patches.append(Patch(patch_name))
+                continue
+            patch = self.patch_repo.patches.get(patch_name)
+            if patch is None:
+                raise PlanMismatch('planned patch "%s" not found' % (
+                        patch_name))
+            if patch.content_hash != content_hash:
+                raise PlanMismatch('patch "%s" changed since planning' % (
+                        patch_name))
+            patches.append(patch)
+        self._plan_computed(plan.operation, start, patches)
+        self._run_plan(plan.operation, self._get_repository_id(), patches,
+                execute_sql)
+        return patches
+
+    def _write_bookkeeping(self, operation, repository_id, patch_names):
+        start = self._start_step()
+        # A cached set of applied patches is kept up-to-date, but it isn't
+        # read just for that.
+        if operation == 'upgrade':
+            AppliedPatch.add_all(self.sess, repository_id, patch_names)
+            if self._applied_names is not None:
+                self._applied_names.update(patch_names)
+        else:
+            AppliedPatch.remove_all(self.sess, repository_id, patch_names)
+            if self._applied_names is not None:
+                self._applied_names.difference_update(patch_names)
+        self._end_step(BOOKKEEPING_WRITE, start, operation=operation,
+                rowcount=len(patch_names))
+
+    def upgrade_patches_parallel(self, patches, num_workers,
+            execute_sql=True):
+        """Like ``upgrade_patches``, but applies patches on up to
+        `num_workers` separate database connections. A patch is started as soon
+        as all patches it depends on were applied. Patches marked as
+        parallel-safe run concurrently with each other, all other patches run
+        alone.
+
+        Each patch is committed together with its book-keeping entry as soon as
+        it was applied, regardless of the transaction mode, so the driver's
+        session is committed before the first
+        patch is started. After a failure, no further patches are started. The
+        patches still running are waited for and then the failure is raised.
+        """
+        if num_workers < 1:
+            raise ValueError('at least one worker is needed, not %d' % (
+                    num_workers))
+        repository_id = self._get_repository_id()
+        applied_names = self._get_applied_names()
+        start = self._start_step()
+        plan = generate_upgrade_plan(applied_patches=self.applied_patches,
+                to_be_applied_patches=patches)
+        self._plan_computed('upgrade', start, plan)
+        self.commit()
+
+        scheduler = _ParallelScheduler(plan)
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+        # The session might be bound to a single connection, so bind the
+        # workers' sessions to the engine instead.
+        Session = sessionmaker(bind=self.sess.get_bind().engine,
+                autocommit=False)
+        def make_driver(sess):
+            return Driver(sess, self.patch_repo, schema=self.schema,
+                    split_scripts=self.split_scripts,
+                    stream_batch_size=self.stream_batch_size,
+                    data_batch_size=self.data_batch_size,
+                    chunk_size=self.chunk_size,
+                    commit_chunks=self.commit_chunks,
+                    transaction_mode=self.transaction_mode,
+                    commit_every=self.commit_every, online=self.online)
+        workers = [threading.Thread(target=_upgrade_worker, args=(Session,
+                make_driver, repository_id, execute_sql, tasks, results))
+                for _ in range(num_workers)]
+        for worker in workers:
+            worker.start()
+
+        failure = None
+        start_times = {}
+        try:
+            while True:
+                if failure is None:
+                    for patch in scheduler.dispatch(num_workers):
+                        start_times[patch] = self._start_step(PATCH_START,
+                                operation='upgrade', patch=patch.name)
+                        print "applying patch '%s'" % patch.name
+                        tasks.put(patch)
+                if scheduler.num_running == 0:
+                    break
+                patch, rowcount, exc_info = _get_result(results, workers)
+                scheduler.complete(patch)
+                self._end_step(PATCH_END, start_times[patch],
+                        operation='upgrade', patch=patch.name,
+                        rowcount=rowcount, failed=exc_info is not None)
+                if exc_info is None:
+                    applied_names.add(patch.name)
+                elif failure is None:
+                    failure = exc_info
+        finally:
+            for worker in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join()
+
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
         return plan
 
     def calculate_minimal_deps(self, patches):
         """Returns the minimal set of patches that is equivalent to `patches`.
-        The returned list will be equal to or smaller than `patches`, due to
+        The returned set will be equal to or smaller than `patches`, due to
         potentially existing dependencies between the patches.
         """
-        # Note: This is a primitive algorithm and slow implementation. It isn't
-        # intended for large sets of patches.
-        patches = set(patches)
-        minimal_patches = patches.copy()
-        for patch in patches:
-            # Generate recursive list of dependencies introduced by this patch.
-            patch_deps = set(generate_upgrade_plan(applied_patches=[],
-                    to_be_applied_patches=[patch]))
-            # See whether any of the other patches are mentioned in the full
-            # dependency list.
-            for other_patch in patches:
-                if other_patch == patch:
-                    continue
-                if other_patch in patch_deps and other_patch in minimal_patches:
-                    # `other_patch` is part of the dependency list of `patch`, so
-                    # (assuming an acyclic graph) it is not part the minimal
-                    # patch set.
-                    minimal_patches.remove(other_patch)
-        return minimal_patches
+        return self.patch_repo.minimal_patches(patches)
 
     def upgrade(self, execute_sql=True):
         return self.upgrade_patches(self.patch_repo.patches.values(),
@@ -161,25 +732,30 @@ class Driver(object):
             self.downgrade_patches(up_plan)
 
     def downgrade_patches(self, patches, execute_sql=True):
-        dbrepo = self._get_repo()
+        repository_id = self._get_repository_id()
+        start = self._start_step()
         applied_patches = self.applied_patches
         plan = generate_downgrade_plan(applied_patches=applied_patches,
                 to_be_removed_patches=patches)
-        for patch in plan:
-            print "removing patch '%s'" % patch.name
-            dbpatch = self.sess.query(AppliedPatch)\
-                    .filter_by(repository_id=dbrepo.repository_id,
-                            patch_name=patch.name)\
-                    .one()
-            self.sess.delete(dbpatch)
-            if patch.downgrade_sql is not None and execute_sql:
-                for patch_name in patch.missing_deps:
-                    print " (ignoring optional missing patch '%s')" % patch_name
-                with _TranslateErrors("patch downgrade failed '%s'" % (
-                        patch.name)):
-                    execute_script(self.sess, patch.downgrade_sql)
+        self._plan_computed('downgrade', start, plan)
+        self._run_plan('downgrade', repository_id, plan, execute_sql)
         return plan
 
+    def commit(self):
+        """Commits the driver's session."""
+        start = self._start_step()
+        self.sess.commit()
+        self._end_step(COMMIT, start)
+
+    def rollback(self):
+        """Rolls back the driver's session and forgets the cached
+        book-keeping state.
+        """
+        start = self._start_step()
+        self.sess.rollback()
+        self.reset_cache()
+        self._end_step(ROLLBACK, start)
+
     def downgrade(self, execute_sql=True):
         applied_patches = self.applied_patches
         self.downgrade_patches(applied_patches, execute_sql=execute_sql)
@@ -193,9 +769,147 @@ class Driver(object):
         self.upgrade_patches(down_plan)
 
 
+class _ParallelScheduler(object):
+    """Keeps track of the patches of an upgrade plan that are ready to be
+    applied, i.e. all of their dependencies within the plan were applied.
+    Ready patches are handed out in plan order, as far as the parallel-safe
+    markers allow.
+    """
+    def __init__(self, plan):
+        self._position = dict((patch, pos) for pos, patch in enumerate(plan))
+        self._num_pending_deps = {}
+        self._ready_safe = []
+        self._ready_exclusive = []
+        self._exclusive_running = False
+        self.num_running = 0
+        for patch in plan:
+            num_deps = len([dep for dep in patch.depends_on
+                    if dep in self._position])
+            self._num_pending_deps[patch] = num_deps
+            if num_deps == 0:
+                self._push_ready(patch)
+
+    def _push_ready(self, patch):
+        if patch.parallel_safe:
+            ready = self._ready_safe
+        else:
+            ready = self._ready_exclusive
+        heapq.heappush(ready, (self._position[patch], patch))
+
+    def dispatch(self, max_running):
+        """Returns the list of patches that may be started now, while at most
+        `max_running` patches run at the same time.
+        """
+        started = []
+        if self._exclusive_running:
+            return started
+        if self.num_running == 0 and self._ready_exclusive and \
+                (not self._ready_safe or
+                        self._ready_exclusive[0] < self._ready_safe[0]):
+            _, patch = heapq.heappop(self._ready_exclusive)
+            self._exclusive_running = True
+            self.num_running += 1
+            return [patch]
+        while self._ready_safe and self.num_running < max_running:
+            _, patch = heapq.heappop(self._ready_safe)
+            self.num_running += 1
+            started.append(patch)
+        return started
+
+    def complete(self, patch):
+        """Marks the running `patch` as finished, which might make its
+        dependents ready."""
+        self.num_running -= 1
+        if not patch.parallel_safe:
+            self._exclusive_running = False
+        for dependent in patch.dependents:
+            if dependent not in self._position:
+                continue
+            self._num_pending_deps[dependent] -= 1
+            if self._num_pending_deps[dependent] == 0:
+                self._push_ready(dependent)
+
+def _upgrade_worker(Session, make_driver, repository_id, execute_sql, tasks,
+        results):
+    """Applies the patches received via `tasks` within a session of its own
+    and reports each patch to `results`, together with the number of affected
+    rows and the exception information in case of a failure. The patches are executed by a driver
+    created by `make_driver` for the session.
+    """
+    sess = Session()
+    driver = None
+    try:
+        while True:
+            patch = tasks.get()
+            if patch is None:
+                break
+            rowcount = None
+            try:
+                if driver is None:
+                    driver = make_driver(sess)
+                if driver.schema is not None:
+                    set_search_path(sess, driver.schema)
+                if execute_sql:
+                    rowcount = driver._apply_patch('upgrade', patch)
+                AppliedPatch.add_all(sess, repository_id, [patch.name])
+                sess.commit()
+            except Exception:
+                exc_info = sys.exc_info()
+                try:
+                    sess.rollback()
+                except Exception:
+                    # The patch's failure is reported, not the rollback's.
+                    pass
+                results.put((patch, None, exc_info))
+            else:
+                results.put((patch, rowcount, None))
+    finally:
+        sess.close()
+
+# Seconds between the checks for ended workers while waiting for a result.
+_WORKER_POLL_INTERVAL = 1.0
+
+def _get_result(results, workers):
+    """Returns the next result of the `workers` reported to `results`. Raises
+    RuntimeError in case all workers ended without reporting it.
+    """
+    while True:
+        try:
+            return results.get(timeout=_WORKER_POLL_INTERVAL)
+        except Queue.Empty:
+            if any(worker.is_alive() for worker in workers):
+                continue
+            # The last result might have been reported just before the end.
+            try:
+                return results.get_nowait()
+            except Queue.Empty:
+                raise RuntimeError('all parallel workers ended without '
+                        'reporting their patches')
+
+def _add_rowcount(total, rowcount):
+    """Returns the sum of the row counts `total` and `rowcount`, either of
+    which might be None (unknown)."""
+    if rowcount is None:
+        return total
+    if total is None:
+        return rowcount
+    return total + rowcount
+
+def _statement_batches(sess, chunks, batch_size):
+    """Yields the statements of the script passed as pieces of text `chunks`
+    in lists of up to `batch_size` statements."""
+    statements = iter_statements(chunks,
+            sess.connection().engine.dialect.name)
+    while True:
+        batch = list(itertools.islice(statements, batch_size))
+        if len(batch) == 0:
+            break
+        yield batch
+
 class _TranslateErrors(object):
-    def __init__(self, operation):
+    def __init__(self, operation, include_statement=False):
         self.operation = operation
+        self.include_statement = include_statement
 
     def __enter__(self):
         return self
@@ -203,7 +917,9 @@ class _TranslateErrors(object):
     def __exit__(self, _type, exc, _traceback):
         if exc is not None:
             if isinstance(exc, DatabaseError):
-                raise PatchFailedException(self.operation,
-                        exc.args[0].strip().splitlines())
+                details = exc.args[0].strip().splitlines()
+                if self.include_statement and exc.statement is not None:
+                    details.append('failed statement: %s' % exc.statement)
+                raise PatchFailedException(self.operation, details, exc)
             # Otherwise, do not suppress the exception.
             return False
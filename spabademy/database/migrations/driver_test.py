@@ -18,14 +18,36 @@ Tests the ``spabademy.database.migration.driver`` module.
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
 
+from __future__ import with_statement
+
+import io
+import sqlite3
+import tempfile
+import shutil
+import os.path
 from spabademy.database.migrations.driver import Driver
+from spabademy.database.migrations.driver import _ParallelScheduler
+from spabademy.database.migrations.driver import PatchFailedException
+from spabademy.database.migrations.driver import TRANSACTION_PER_PATCH
+from spabademy.database.migrations.driver import TRANSACTION_SAVEPOINT
+from spabademy.database.migrations import events
+from spabademy.database.migrations import online
+from spabademy.database.migrations.online import OnlinePolicy
+from spabademy.database.migrations.events import MigrationListener
 from sqlalchemy.engine import create_engine
 from sqlalchemy.orm.session import sessionmaker
 from sqlalchemy.interfaces import PoolListener
+from sqlalchemy import event
 from spabademy.database import table_exists
 from spabademy.database.migrations.db import Repository
+from spabademy.database.migrations.db import AppliedPatch
+from spabademy.database.migrations.db import PatchProgress
+from spabademy.database.migrations.db import enable_savepoints
+from spabademy.database.migrations.db import names_digest
 from spabademy.database.migrations.patch import PatchRepository
 from spabademy.database.migrations.patch import Patch
+from spabademy.database.migrations.patch import DataFile
+from spabademy.database.migrations.plan import PlanMismatch
 from nose.tools import eq_
 
 class SQLiteForeignKeysListener(PoolListener):
@@ -35,6 +57,14 @@ class SQLiteForeignKeysListener(PoolListener):
     def connect(self, dbapi_con, _):
         dbapi_con.execute('PRAGMA foreign_keys=ON')
 
+class BytesSource(object):
+    """Provides a data file's contents from memory."""
+    def __init__(self, data):
+        self.data = data
+
+    def open(self):
+        return io.BytesIO(self.data)
+
 class TestDriver(object):
     def __init__(self):
         self.engine = None
@@ -118,6 +148,29 @@ class TestDriver(object):
         self.assert_tables_not_exist(['migrate_repositories',
                 'migrate_applied_patches'])
 
+    def test_init_with_patches(self):
+        self.init_repo()
+        self.driver.uninit_repo()
+        self.driver.init_repo(patches=[self.patch2, self.patch3])
+        eq_(set(self.driver.applied_patches), set([self.patch2, self.patch3]))
+        self.driver.uninit_repo()
+        self.assert_tables_not_exist(['migrate_repositories',
+                'migrate_applied_patches'])
+
+    def test_many_patches(self):
+        self.driver.init_repo()
+        patches = [Patch('patch%04d' % i) for i in range(1200)]
+        self.patchrepo.add_patches(*patches)
+        self.patchrepo.resolve_dependencies()
+
+        self.driver.upgrade()
+        eq_(len(self.driver.applied_patches), 1200)
+        self.driver.downgrade_patches(patches[100:])
+        eq_(set(self.driver.applied_patches), set(patches[:100]))
+        self.driver.uninit_repo()
+        self.assert_tables_not_exist(['migrate_repositories',
+                'migrate_applied_patches'])
+
     def test_uninit_other_repo(self):
         self.driver.init_repo()
         other_patchrepo = PatchRepository(repo_name='test_repo2')
@@ -182,6 +235,343 @@ class TestDriver(object):
         eq_(set(self.driver.applied_patches), set([]))
         self.assert_tables_not_exist(['t1', 't12', 't2', 't3'])
 
+    def test_applied_patches_read_once(self):
+        self.init_repo()
+        self.sess.commit()
+        driver = Driver(self.sess, self.patchrepo)
+
+        statements = []
+        def count_statements(_conn, _cursor, statement, *_):
+            if statement.startswith('SELECT') and \
+                    'migrate_applied_patches' in statement:
+                statements.append(statement)
+        event.listen(self.engine, 'before_cursor_execute', count_statements)
+
+        eq_(driver.applied_patches, [])
+        eq_(set(driver.unapplied_patches), set([self.patch1, self.patch2,
+                self.patch3]))
+        driver.upgrade_patches([self.patch2])
+        eq_(driver.applied_patch_names, frozenset(['patch2', 'patch3']))
+        driver.upgrade()
+        driver.downgrade_patches([self.patch2])
+        eq_(driver.applied_patches, [self.patch3])
+        eq_(len(statements), 1)
+
+        driver.reset_cache()
+        eq_(driver.applied_patches, [self.patch3])
+        eq_(len(statements), 2)
+
+    def test_events(self):
+        self.init_repo()
+        recorded = []
+        class Recorder(MigrationListener):
+            def handle(self, event):
+                recorded.append(event)
+        self.driver.add_listener(Recorder())
+
+        self.driver.upgrade_patches([self.patch3])
+        self.driver.commit()
+        eq_([event.kind for event in recorded], ['plan_computed',
+                'patch_start', 'statement_start', 'statement_end', 'patch_end',
+                'bookkeeping_write', 'commit'])
+        eq_(recorded[0]['patches'], ['patch3'])
+        eq_(recorded[3]['statement'], 'CREATE TABLE t3(a integer);')
+        eq_(recorded[4]['failed'], False)
+        eq_(recorded[5]['rowcount'], 1)
+        assert recorded[4]['duration'] >= 0
+
+        del recorded[:]
+        try:
+            self.driver.upgrade_patches([self.patch3, Patch('bad',
+                    upgrade_sql='CREATE TABLE t3(a integer);')])
+        except Exception:
+            pass
+        eq_([event.kind for event in recorded], ['plan_computed',
+                'patch_start', 'statement_start', 'statement_end',
+                'patch_end'])
+        eq_(recorded[-1]['failed'], True)
+
+    def test_split_scripts(self):
+        self.init_repo()
+        self.sess.commit()
+        recorded = []
+        class Recorder(MigrationListener):
+            def handle(self, event):
+                recorded.append(event)
+        self.driver.add_listener(Recorder())
+        self.driver.split_scripts = True
+
+        self.driver.upgrade_patches([self.patch1])
+        eq_([event['statement'] for event in recorded
+                if event.kind == 'statement_end'], [
+                'CREATE TABLE t3(a integer)', 'CREATE TABLE t2(a integer)',
+                'CREATE TABLE t1(a integer)', 'CREATE TABLE t12(a integer)'])
+        self.assert_tables_exist(['t1', 't12', 't2', 't3'])
+
+        # The statements run within the session's transaction.
+        patch4 = Patch('patch4', upgrade_sql="INSERT INTO t1 VALUES (1);\n"
+                "INSERT INTO t1 VALUES (2);")
+        self.patchrepo.add_patch(patch4)
+        self.driver.upgrade_patches([patch4])
+        eq_(self.sess.execute('SELECT COUNT(*) FROM t1').scalar(), 2)
+        self.driver.rollback()
+        eq_(self.sess.execute('SELECT COUNT(*) FROM t1').scalar(), 0)
+
+        patch5 = Patch('patch5', upgrade_sql="INSERT INTO t1 VALUES (1);\n"
+                "INSERT INTO missing VALUES (2);")
+        self.patchrepo.add_patch(patch5)
+        try:
+            self.driver.upgrade_patches([patch5])
+        except PatchFailedException, e:
+            eq_(e.args[0], "patch upgrade failed 'patch5'")
+            eq_(e.details[-1],
+                    'failed statement: INSERT INTO missing VALUES (2)')
+        else:
+            assert False, 'expected PatchFailedException'
+
+    def test_stream_scripts(self):
+        self.init_repo()
+        self.sess.commit()
+        recorded = []
+        class Recorder(MigrationListener):
+            def handle(self, event):
+                recorded.append(event)
+        self.driver.add_listener(Recorder())
+        self.driver.stream_batch_size = 2
+
+        patch4 = Patch('patch4', upgrade_sql="CREATE TABLE t4(a integer);\n"
+                "INSERT INTO t4 VALUES (1);\nINSERT INTO t4 VALUES (2);\n"
+                "INSERT INTO t4 VALUES (3);", downgrade_sql='DROP TABLE t4')
+        self.patchrepo.add_patch(patch4)
+        self.driver.upgrade_patches([patch4])
+        eq_([(event['statement'], event['rowcount']) for event in recorded
+                if event.kind == 'statement_end'], [
+                ('CREATE TABLE t4(a integer);\nINSERT INTO t4 VALUES (1)',
+                        None),
+                ('INSERT INTO t4 VALUES (2);\nINSERT INTO t4 VALUES (3)', 2)])
+        # The patch's row count is the sum of the known ones.
+        eq_([event['rowcount'] for event in recorded
+                if event.kind == 'patch_end'], [2])
+        eq_(self.sess.execute('SELECT COUNT(*) FROM t4').scalar(), 3)
+        self.driver.downgrade_patches([patch4])
+        self.assert_tables_not_exist(['t4'])
+
+        patch5 = Patch('patch5', upgrade_sql="INSERT INTO missing VALUES (2)")
+        self.patchrepo.add_patch(patch5)
+        try:
+            self.driver.upgrade_patches([patch5])
+        except PatchFailedException, e:
+            eq_(e.details[-1],
+                    'failed statement: INSERT INTO missing VALUES (2)')
+        else:
+            assert False, 'expected PatchFailedException'
+
+    def test_data_files(self):
+        self.init_repo()
+        self.sess.commit()
+        patch4 = Patch('patch4', upgrade_sql='CREATE TABLE t4(a integer, '
+                'b text);', downgrade_sql='DROP TABLE t4;', data_files=[
+                DataFile('rows.csv', 't4', ['a', 'b'],
+                        BytesSource('1,x\n2,y\n3,z\n'))])
+        self.patchrepo.add_patch(patch4)
+        self.driver.data_batch_size = 2
+        self.driver.upgrade_patches([patch4])
+        eq_(self.sess.execute('SELECT COUNT(*) FROM t4').scalar(), 3)
+        # The rows are removed before the table is dropped.
+        self.driver.downgrade_patches([patch4])
+        self.assert_tables_not_exist(['t4'])
+
+        patch5 = Patch('patch5', data_files=[DataFile('rows.csv', 'missing',
+                ['a'], BytesSource('1\n'))])
+        self.patchrepo.add_patch(patch5)
+        try:
+            self.driver.upgrade_patches([patch5])
+        except PatchFailedException, e:
+            eq_(e.details[-1],
+                    'failed statement: INSERT INTO missing (a) VALUES (?)')
+        else:
+            assert False, 'expected PatchFailedException'
+
+    def test_python_migration(self):
+        # Rolling back needs to undo the patch's CREATE TABLE, too.
+        enable_savepoints(self.engine)
+        self.init_repo()
+        self.sess.execute('CREATE TABLE t4(a integer, b integer)')
+        self.sess.commit()
+        upgrade_py = '''
+QUERY = "SELECT a AS id FROM t4"
+fail_after = [None]
+
+def transform(conn, rows):
+    for row in rows:
+        if fail_after[0] is not None and row.id > fail_after[0]:
+            raise RuntimeError('interrupted')
+        conn.execute("UPDATE t4 SET b = 2 * a WHERE a = %d" % row.id)
+'''
+        patch4 = Patch('patch4', upgrade_sql='CREATE TABLE added(a integer);',
+                upgrade_py=upgrade_py, data_files=[
+                DataFile('rows.csv', 't4', ['a'], BytesSource(''.join(
+                        '%d\n' % i for i in range(1, 8))))])
+        self.patchrepo.add_patch(patch4)
+        self.driver.chunk_size = 3
+        self.driver.upgrade_patches([patch4])
+        eq_(self.sess.execute('SELECT SUM(b) FROM t4').scalar(), 56)
+        self.driver.rollback()
+
+        # Committing chunks, the migration resumes after the last committed
+        # chunk.
+        self.driver.commit_chunks = True
+        patch4.upgrade_py = upgrade_py.replace('[None]', '[4]')
+        try:
+            self.driver.upgrade_patches([patch4])
+        except RuntimeError:
+            pass
+        else:
+            assert False, 'expected RuntimeError'
+        self.driver.rollback()
+        eq_(PatchProgress.get(self.sess, self.driver._get_repository_id(),
+                'patch4', 'upgrade'), 3)
+        eq_(self.sess.execute('SELECT COUNT(*) FROM t4 WHERE b IS NOT NULL')
+                .scalar(), 3)
+        self.sess.execute('UPDATE t4 SET b = 0 WHERE b IS NOT NULL')
+        self.sess.commit()
+
+        # The script and the data file were committed with the first chunk,
+        # so they are skipped.
+        patch4.upgrade_py = upgrade_py
+        self.driver.upgrade_patches([patch4])
+        self.driver.commit()
+        eq_(self.sess.execute('SELECT COUNT(*) FROM t4').scalar(), 7)
+        eq_(self.sess.execute('SELECT SUM(b) FROM t4').scalar(), 44)
+        self.assert_table_exists('added')
+        eq_(PatchProgress.get(self.sess, self.driver._get_repository_id(),
+                'patch4', 'upgrade'), None)
+        eq_(self.driver.applied_patch_names, frozenset(['patch4']))
+
+    def test_plan(self):
+        self.init_repo()
+        plan = self.driver.make_plan('upgrade', [self.patch2])
+        eq_(plan.operation, 'upgrade')
+        eq_(plan.fingerprint, names_digest([]))
+        eq_(plan.patches, [('patch3', self.patch3.content_hash),
+                ('patch2', self.patch2.content_hash)])
+
+        # The plan's patches are applied without resolving their
+        # dependencies.
+        patch2 = Patch('patch2', depends_on_names=[('patch3', False)],
+                upgrade_sql=self.patch2.upgrade_sql,
+                downgrade_sql=self.patch2.downgrade_sql)
+        patch3 = Patch('patch3', upgrade_sql=self.patch3.upgrade_sql,
+                downgrade_sql=self.patch3.downgrade_sql)
+        repo = PatchRepository(repo_name='test_repo')
+        repo.add_patches(patch2, patch3)
+        driver = Driver(self.sess, repo)
+        eq_(driver.apply_plan(plan), [patch3, patch2])
+        self.assert_tables_exist(['t2', 't3'])
+        eq_(AppliedPatch.get_names(self.sess, 'test_repo'),
+                frozenset(['patch2', 'patch3']))
+
+        # The applied patches changed since planning.
+        try:
+            driver.apply_plan(plan)
+        except PlanMismatch:
+            pass
+        else:
+            assert False, 'expected PlanMismatch'
+
+        self.driver.reset_cache()
+        plan = self.driver.make_plan('downgrade', [self.patch3])
+        eq_(plan.fingerprint, names_digest(['patch2', 'patch3']))
+        eq_(plan.patch_names, ['patch2', 'patch3'])
+        repo.add_patch(Patch('patch2', depends_on_names=[('patch3', False)],
+                upgrade_sql=self.patch2.upgrade_sql,
+                downgrade_sql='DROP TABLE t2 ;'))
+        try:
+            driver.apply_plan(plan)
+        except PlanMismatch:
+            pass
+        else:
+            assert False, 'expected PlanMismatch'
+
+    def test_plan_other_database(self):
+        # The applied patches of both databases have the same number and the
+        # same largest name, but differ. Applying the plan to the second
+        # database would apply patch b again.
+        def make_driver(applied_names):
+            sess = sessionmaker(bind=create_engine('sqlite://'))()
+            repo = PatchRepository(repo_name='test_repo')
+            repo.add_patches(Patch('a'), Patch('b'),
+                    Patch('c', depends_on_names=[('b', False)]), Patch('z'))
+            repo.resolve_dependencies()
+            driver = Driver(sess, repo)
+            driver.init_repo(patches=repo.lookup_patch_names(applied_names))
+            return driver
+        driver_a = make_driver(['a', 'z'])
+        driver_b = make_driver(['b', 'z'])
+        plan = driver_a.make_plan('upgrade',
+                [driver_a.patch_repo.patches['c']])
+        eq_(plan.patch_names, ['b', 'c'])
+        try:
+            driver_b.apply_plan(plan)
+        except PlanMismatch:
+            pass
+        else:
+            assert False, 'expected PlanMismatch'
+        eq_(driver_a.apply_plan(plan), [driver_a.patch_repo.patches['b'],
+                driver_a.patch_repo.patches['c']])
+
+    def test_no_listener_no_clock(self):
+        self.init_repo()
+        orig_clock = events.clock
+        def clock():
+            assert False, 'unexpected clock call'
+        events.clock = clock
+        try:
+            self.driver.upgrade()
+            self.driver.commit()
+        finally:
+            events.clock = orig_clock
+
+    def test_no_listener_no_label(self):
+        def label():
+            assert False, 'unexpected label call'
+        executed = []
+        self.driver._execute_statement(Patch('patch1'), label,
+                executed.append, 1)
+        eq_(executed, [1])
+
+        statements = []
+        class Listener(MigrationListener):
+            def handle(self, event):
+                if event.kind == events.STATEMENT_END:
+                    statements.append(event['statement'])
+        self.driver.add_listener(Listener())
+        self.driver._execute_statement(Patch('patch1'), lambda: 'label',
+                executed.append, 2)
+        eq_(executed, [1, 2])
+        eq_(statements, ['label'])
+
+    def test_upgrade_uninitialised(self):
+        self.init_repo()
+        Driver(self.sess, PatchRepository(repo_name='test_repo2')).init_repo()
+        self.driver.uninit_repo()
+        try:
+            self.driver.upgrade()
+        except RuntimeError:
+            pass
+        else:
+            assert False, 'expected RuntimeError'
+
+    def test_renew_patch(self):
+        self.init_repo()
+
+        self.driver.upgrade_patches([self.patch1])
+        self.sess.execute('INSERT INTO t2 VALUES (1)')
+        self.driver.renew_patches([self.patch2])
+        eq_(set(self.driver.applied_patches), set([self.patch1, self.patch2,
+                self.patch3]))
+        eq_(self.sess.execute('SELECT COUNT(*) FROM t2').scalar(), 0)
+
     def test_empty_upgrade(self):
         self.driver.init_repo()
 
@@ -207,3 +597,319 @@ class TestDriver(object):
         eq_(set(self.driver.calculate_minimal_deps(patches=[self.patch1,
             self.patch2, self.patch3, patch4, patch5])), set([self.patch1,
                 patch4]))
+
+class TestTransactionModes(object):
+    """Tests the driver's transaction modes on a database with transactional
+    DDL statements (see ``enable_savepoints``).
+    """
+    def __init__(self):
+        self.engine = None
+        self.sess = None
+        self.patchrepo = None
+        self.driver = None
+        self.num_commits = 0
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        enable_savepoints(self.engine)
+        self.sess = sessionmaker(bind=self.engine)()
+        self.patchrepo = PatchRepository(repo_name='test_repo')
+        self.driver = Driver(self.sess, self.patchrepo)
+        self.driver.init_repo()
+        self.sess.commit()
+        self.num_commits = 0
+        test = self
+        class CommitCounter(MigrationListener):
+            def handle(self, event):
+                if event.kind == 'commit':
+                    test.num_commits += 1
+        self.driver.add_listener(CommitCounter())
+
+        patches = []
+        for num in range(1, 4):
+            patches.append(Patch('patch%d' % num, depends_on_names=[
+                    (patch.name, False) for patch in patches[-1:]],
+                    upgrade_sql='CREATE TABLE t%d(a integer);' % num))
+        patches.append(Patch('patch4', depends_on_names=[('patch3', False)],
+                upgrade_sql='CREATE TABLE t4(a integer);\n'
+                        'INSERT INTO missing VALUES (1);'))
+        self.patchrepo.add_patches(*patches)
+        self.patchrepo.resolve_dependencies()
+
+    def tearDown(self):
+        self.sess.close()
+
+    def upgrade_failing(self):
+        try:
+            self.driver.upgrade_patches([self.patchrepo.patches['patch4']])
+        except PatchFailedException:
+            self.driver.rollback()
+        else:
+            assert False, 'expected PatchFailedException'
+
+    def assert_applied(self, patch_names):
+        eq_(AppliedPatch.get_names(self.sess, 'test_repo'),
+                frozenset(patch_names))
+        for num in range(1, 5):
+            eq_(table_exists(self.sess, 't%d' % num),
+                    'patch%d' % num in patch_names)
+
+    def test_single(self):
+        self.driver.split_scripts = True
+        self.upgrade_failing()
+        eq_(self.num_commits, 0)
+        self.assert_applied([])
+
+    def test_per_patch(self):
+        self.driver.transaction_mode = TRANSACTION_PER_PATCH
+        self.driver.split_scripts = True
+        self.upgrade_failing()
+        eq_(self.num_commits, 3)
+        self.assert_applied(['patch1', 'patch2', 'patch3'])
+
+    def test_savepoint(self):
+        self.driver.transaction_mode = TRANSACTION_SAVEPOINT
+        self.driver.commit_every = 2
+        self.upgrade_failing()
+        # Once after patch2 and once for patch3 after the failure.
+        eq_(self.num_commits, 2)
+        self.assert_applied(['patch1', 'patch2', 'patch3'])
+
+        # A re-run picks up the remaining patch.
+        patch4 = Patch('patch4', depends_on_names=[('patch3', False)],
+                upgrade_sql='CREATE TABLE t4(a integer);')
+        self.patchrepo.add_patch(patch4)
+        self.patchrepo.resolve_dependencies()
+        eq_(self.driver.upgrade_patches([patch4]), [patch4])
+        self.driver.commit()
+        self.assert_applied(['patch1', 'patch2', 'patch3', 'patch4'])
+
+def test_invalid_modes():
+    repo = PatchRepository(repo_name='test_repo')
+    for kwargs in [{'transaction_mode': 'unknown'}, {'commit_every': 0},
+            {'commit_chunks': True, 'transaction_mode': TRANSACTION_SAVEPOINT},
+            {'commit_chunks': True, 'online': OnlinePolicy()}]:
+        try:
+            Driver(None, repo, **kwargs)
+        except ValueError:
+            pass
+        else:
+            assert False, 'expected ValueError for %r' % kwargs
+
+class TestOnlineDriver(object):
+    """Tests the driver's online mode against a lock held by another
+    connection to an SQLite database file.
+    """
+    def __init__(self):
+        self.tmp_dir_path = None
+        self.engine = None
+        self.sess = None
+        self.patchrepo = None
+        self.driver = None
+        self.blocker = None
+        self.delays = []
+        self.orig_sleep = None
+
+    def setUp(self):
+        self.tmp_dir_path = tempfile.mkdtemp()
+        db_path = os.path.join(self.tmp_dir_path, 'test.db')
+        self.engine = create_engine('sqlite:///%s' % db_path)
+        enable_savepoints(self.engine)
+        self.sess = sessionmaker(bind=self.engine)()
+        self.patchrepo = PatchRepository(repo_name='test_repo')
+        self.driver = Driver(self.sess, self.patchrepo,
+                online=OnlinePolicy(lock_timeout=0.05, base_delay=0.01))
+        self.driver.init_repo()
+        self.driver.commit()
+        self.blocker = sqlite3.connect(db_path, isolation_level=None)
+        self.blocker.execute('BEGIN IMMEDIATE')
+        self.delays = []
+        self.orig_sleep = online.sleep
+        online.sleep = self.delays.append
+
+    def tearDown(self):
+        online.sleep = self.orig_sleep
+        self.blocker.close()
+        self.sess.close()
+        shutil.rmtree(self.tmp_dir_path)
+
+    def test_retry(self):
+        patch1 = Patch('patch1', upgrade_sql='CREATE TABLE t1(a integer);')
+        self.patchrepo.add_patches(patch1)
+        self.patchrepo.resolve_dependencies()
+        recorded = []
+        blocker = self.blocker
+        class Releaser(MigrationListener):
+            def handle(self, event):
+                if event.kind == 'retry':
+                    recorded.append(event)
+                    if len(recorded) == 2:
+                        blocker.execute('ROLLBACK')
+        self.driver.add_listener(Releaser())
+
+        self.driver.upgrade_patches([patch1])
+        eq_(len(self.delays), 2)
+        eq_([event['attempt'] for event in recorded], [1, 2])
+        eq_(recorded[0]['patch'], 'patch1')
+        assert 'database is locked' in recorded[0]['error']
+        self.driver.commit()
+        assert table_exists(self.sess, 't1')
+        eq_(AppliedPatch.get_names(self.sess, 'test_repo'),
+                frozenset(['patch1']))
+
+    def test_budget(self):
+        self.driver.online.retry_budget = 0
+        patch1 = Patch('patch1', upgrade_sql='CREATE TABLE t1(a integer);')
+        self.patchrepo.add_patches(patch1)
+        self.patchrepo.resolve_dependencies()
+        try:
+            self.driver.upgrade_patches([patch1])
+        except PatchFailedException, e:
+            assert 'database is locked' in e.details[0]
+        else:
+            assert False, 'expected PatchFailedException'
+        eq_(self.delays, [])
+
+    def test_other_failure(self):
+        self.blocker.execute('ROLLBACK')
+        patch1 = Patch('patch1', upgrade_sql='INSERT INTO missing '
+                'VALUES (1);')
+        self.patchrepo.add_patches(patch1)
+        self.patchrepo.resolve_dependencies()
+        try:
+            self.driver.upgrade_patches([patch1])
+        except PatchFailedException:
+            pass
+        else:
+            assert False, 'expected PatchFailedException'
+        eq_(self.delays, [])
+
+class TestParallelDriver(object):
+    """Tests the parallel upgrade with a file based SQLite database, which
+    can be accessed by more than one connection.
+    """
+    def __init__(self):
+        self.tmp_dir_path = None
+        self.engine = None
+        self.sess = None
+        self.patchrepo = None
+        self.driver = None
+
+    def setUp(self):
+        self.tmp_dir_path = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///%s' % os.path.join(
+                self.tmp_dir_path, 'test.db'))
+        self.sess = sessionmaker(bind=self.engine)()
+        self.patchrepo = PatchRepository(repo_name='test_repo')
+        self.driver = Driver(self.sess, self.patchrepo)
+        self.driver.init_repo()
+
+    def tearDown(self):
+        self.sess.close()
+        shutil.rmtree(self.tmp_dir_path)
+
+    def add_patches(self, *patches):
+        self.patchrepo.add_patches(*patches)
+        self.patchrepo.resolve_dependencies()
+
+    def test_upgrade(self):
+        # SQLite doesn't cope with concurrent schema changes, so the
+        # parallel-safe patches only modify data.
+        self.sess.execute('CREATE TABLE data(a integer)')
+        self.sess.commit()
+        patches = [Patch('patch%02d' % i, upgrade_sql=
+                'INSERT INTO data VALUES (%d);' % i, parallel_safe=True)
+                for i in range(20)]
+        final = Patch('final', depends_on_names=[(patch.name, False)
+                for patch in patches],
+                upgrade_sql='CREATE TABLE final(a integer);')
+        self.add_patches(final, *patches)
+
+        plan = self.driver.upgrade_patches_parallel([final], num_workers=4)
+        eq_(len(plan), 21)
+        eq_(self.driver.applied_patch_names,
+                frozenset(self.patchrepo.patches.keys()))
+        eq_(AppliedPatch.get_names(self.sess, 'test_repo'),
+                frozenset(self.patchrepo.patches.keys()))
+        eq_(self.sess.execute('SELECT COUNT(*) FROM data').scalar(), 20)
+        assert table_exists(self.sess, 'final')
+
+    def test_failure_stops_dispatch(self):
+        patch1 = Patch('patch1', upgrade_sql='CREATE TABLE t1(a integer);')
+        patch2 = Patch('patch2', depends_on_names=[('patch1', False)],
+                upgrade_sql='CREATE TABLE t1(a integer);')
+        patch3 = Patch('patch3', depends_on_names=[('patch2', False)],
+                upgrade_sql='CREATE TABLE t3(a integer);')
+        self.add_patches(patch1, patch2, patch3)
+
+        try:
+            self.driver.upgrade_patches_parallel([patch3], num_workers=2)
+        except Exception:
+            pass
+        else:
+            assert False, 'expected the upgrade to fail'
+        eq_(self.driver.applied_patch_names, frozenset(['patch1']))
+        eq_(AppliedPatch.get_names(self.sess, 'test_repo'),
+                frozenset(['patch1']))
+        assert not table_exists(self.sess, 't3')
+
+    def test_no_workers(self):
+        patch1 = Patch('patch1', parallel_safe=True)
+        self.add_patches(patch1)
+        try:
+            self.driver.upgrade_patches_parallel([patch1], num_workers=0)
+        except ValueError:
+            pass
+        else:
+            assert False, 'expected ValueError'
+        eq_(self.driver.applied_patch_names, frozenset())
+
+    def test_failed_rollback(self):
+        patch1 = Patch('patch1', upgrade_sql='CREATE TABLE t1(a integer);')
+        patch2 = Patch('patch2', upgrade_sql='CREATE TABLE t1(a integer);')
+        self.add_patches(patch1, patch2)
+        self.driver.upgrade_patches_parallel([patch1], num_workers=1)
+        # The worker's rollback after the failed patch fails, too.
+        fail_rollback = [True]
+        def rollback(_conn):
+            if fail_rollback[0]:
+                raise RuntimeError('rollback failed')
+        event.listen(self.engine, 'rollback', rollback)
+        try:
+            self.driver.upgrade_patches_parallel([patch2], num_workers=1)
+        except Exception, e:
+            assert 'already exists' in str(e), str(e)
+        else:
+            assert False, 'expected the upgrade to fail'
+        finally:
+            fail_rollback[0] = False
+        eq_(AppliedPatch.get_names(self.sess, 'test_repo'),
+                frozenset(['patch1']))
+
+class TestParallelScheduler(object):
+    def test_dispatch(self):
+        patch1 = Patch('patch1', parallel_safe=True)
+        patch2 = Patch('patch2', parallel_safe=True)
+        patch3 = Patch('patch3', parallel_safe=True)
+        patch4 = Patch('patch4', depends_on_names=[('patch1', False)])
+        patch5 = Patch('patch5', depends_on_names=[('patch4', False)],
+                parallel_safe=True)
+        repo = PatchRepository()
+        repo.add_patches(patch1, patch2, patch3, patch4, patch5)
+        repo.resolve_dependencies()
+
+        scheduler = _ParallelScheduler([patch1, patch2, patch3, patch4,
+                patch5])
+        eq_(scheduler.dispatch(2), [patch1, patch2])
+        eq_(scheduler.dispatch(2), [])
+        scheduler.complete(patch1)
+        eq_(scheduler.dispatch(2), [patch3])
+        scheduler.complete(patch2)
+        scheduler.complete(patch3)
+        # The patch that isn't parallel-safe runs alone.
+        eq_(scheduler.dispatch(2), [patch4])
+        eq_(scheduler.dispatch(2), [])
+        scheduler.complete(patch4)
+        eq_(scheduler.dispatch(2), [patch5])
+        scheduler.complete(patch5)
+        eq_(scheduler.num_running, 0)
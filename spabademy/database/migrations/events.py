@@ -0,0 +1,131 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Provides the events emitted by ``Driver`` while migrating, together with
+listeners that export them as a trace file or as a timing summary.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from __future__ import with_statement
+
+import time
+import threading
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+PLAN_COMPUTED = 'plan_computed'
+PATCH_START = 'patch_start'
+PATCH_END = 'patch_end'
+STATEMENT_START = 'statement_start'
+STATEMENT_END = 'statement_end'
+BOOKKEEPING_WRITE = 'bookkeeping_write'
+CHUNK_END = 'chunk_end'
+RETRY = 'retry'
+COMMIT = 'commit'
+ROLLBACK = 'rollback'
+
+# The clock used for all event timestamps and durations. Python 2 has no
+# monotonic clock, so the wall clock is used.
+clock = time.time
+
+class MigrationEvent(object):
+    """Describes something that happened during a migration.
+
+    *kind*
+      one of the event kinds, e.g. ``PATCH_END``.
+    *timestamp*
+      the time of the event, according to ``clock``.
+    *fields*
+      the kind-specific details of the event: ``operation`` (``'upgrade'`` or
+      ``'downgrade'``), ``patch`` (name of the patch), ``patches`` (list of
+      patch names), ``statement`` (SQL text), ``duration`` (seconds the
+      finished step took), ``rowcount`` (number of affected rows, if known),
+      ``failed`` (whether the finished step failed), ``last_key`` (key of
+      the last row of a chunk transformed by a Python migration),
+      ``attempt`` (number of the failed attempt of a patch before a retry)
+      and ``error`` (description of the failure).
+    """
+    def __init__(self, kind, timestamp, **fields):
+        self.kind = kind
+        self.timestamp = timestamp
+        self.fields = fields
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def get(self, key, default=None):
+        return self.fields.get(key, default)
+
+    def as_dict(self):
+        data = {'event': self.kind, 'timestamp': self.timestamp}
+        data.update(self.fields)
+        return data
+
+class MigrationListener(object):
+    """Base class of the listeners registered with ``Driver.add_listener``.
+    Events might be emitted from more than one thread (e.g. during a parallel
+    upgrade), but not concurrently.
+    """
+    def handle(self, event):
+        pass
+
+class JsonLinesExporter(MigrationListener):
+    """Writes each event as a JSON object on a line of its own to the file
+    object `fp`.
+    """
+    def __init__(self, fp):
+        self._fp = fp
+        self._lock = threading.Lock()
+
+    def handle(self, event):
+        line = json.dumps(event.as_dict())
+        with self._lock:
+            self._fp.write(line + '\n')
+            self._fp.flush()
+
+class TimingSummary(MigrationListener):
+    """Collects the durations of the patches and of the other migration steps
+    for a human-readable summary.
+    """
+    def __init__(self):
+        self.patch_durations = []
+        self.step_durations = {}
+
+    def handle(self, event):
+        if event.kind == PATCH_END:
+            self.patch_durations.append((event['duration'],
+                    event['operation'], event['patch'], event['failed']))
+        elif event.kind in (PLAN_COMPUTED, BOOKKEEPING_WRITE, COMMIT,
+                ROLLBACK, RETRY):
+            self.step_durations[event.kind] = self.step_durations.get(
+                    event.kind, 0.0) + event['duration']
+
+    def format(self, limit=None):
+        """Returns the lines of the summary, listing the slowest patches
+        and steps first. At most `limit` patches are listed.
+        """
+        durations = sorted(self.patch_durations, reverse=True)
+        lines = ['%d patches took %.3fs' % (len(durations),
+                sum(duration for duration, _, _, _ in durations))]
+        for duration, operation, patch_name, failed in durations[:limit]:
+            lines.append('%9.3fs  %-9s %s%s' % (duration, operation,
+                    patch_name, ' (failed)' if failed else ''))
+        for duration, kind in sorted(((duration, kind) for kind, duration
+                in self.step_durations.iteritems()), reverse=True):
+            lines.append('%9.3fs  %s' % (duration, kind))
+        return lines
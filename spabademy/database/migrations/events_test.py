@@ -0,0 +1,57 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Tests the ``spabademy.database.migration.events`` module.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from StringIO import StringIO
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from nose.tools import eq_
+from spabademy.database.migrations.events import MigrationEvent
+from spabademy.database.migrations.events import JsonLinesExporter
+from spabademy.database.migrations.events import TimingSummary
+from spabademy.database.migrations.events import PATCH_END
+from spabademy.database.migrations.events import COMMIT
+
+def test_json_lines_exporter():
+    fp = StringIO()
+    exporter = JsonLinesExporter(fp)
+    exporter.handle(MigrationEvent(PATCH_END, 10.0, operation='upgrade',
+            patch='patch1', duration=1.5, failed=False))
+    exporter.handle(MigrationEvent(COMMIT, 11.0, duration=0.25))
+    lines = fp.getvalue().splitlines()
+    eq_(len(lines), 2)
+    eq_(json.loads(lines[0]), {'event': 'patch_end', 'timestamp': 10.0,
+            'operation': 'upgrade', 'patch': 'patch1', 'duration': 1.5,
+            'failed': False})
+    eq_(json.loads(lines[1]), {'event': 'commit', 'timestamp': 11.0,
+            'duration': 0.25})
+
+def test_timing_summary():
+    summary = TimingSummary()
+    for name, duration in [('patch1', 0.5), ('patch2', 2.0), ('patch3', 1.0)]:
+        summary.handle(MigrationEvent(PATCH_END, 0.0, operation='upgrade',
+                patch=name, duration=duration, failed=name == 'patch3'))
+    summary.handle(MigrationEvent(COMMIT, 0.0, duration=0.25))
+    eq_(summary.format(limit=2), [
+            '3 patches took 3.500s',
+            '    2.000s  upgrade   patch2',
+            '    1.000s  upgrade   patch3 (failed)',
+            '    0.250s  commit'])
@@ -0,0 +1,267 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Provides support for applying the same migration operation to a whole fleet of
+databases (e.g. the shards of a database) or to many schemas of a database
+(e.g. one schema per tenant), using a bounded pool of worker threads.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from __future__ import with_statement
+
+import time
+import threading
+import Queue
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.engine import create_engine
+from sqlalchemy.orm.session import sessionmaker
+from spabademy.database import build_description_url
+from spabademy.database.migrations.driver import Driver
+from spabademy.database.migrations.driver import PatchFailedException
+from spabademy.database.migrations.db import set_search_path
+from spabademy.database.migrations.db import enable_savepoints
+
+RESULT_OK = 'ok'
+RESULT_FAILED = 'failed'
+RESULT_SKIPPED = 'skipped'
+
+class FanOutResult(object):
+    """Describes the outcome of an operation on a single target (database or
+    schema) of the fan-out.
+
+    *status*
+      one of ``RESULT_OK``, ``RESULT_FAILED`` or ``RESULT_SKIPPED``. Targets
+      are skipped after too many failures.
+    *errors*
+      list of error message lines in case of a failure.
+    *duration*
+      number of seconds the operation took.
+    """
+    def __init__(self, target, description, status, errors=None,
+            duration=None):
+        self.target = target
+        self.description = description
+        self.status = status
+        self.errors = errors if errors is not None else []
+        self.duration = duration
+
+def describe_url(url):
+    """Returns a description of the database `url`, which doesn't reveal the
+    password."""
+    url = make_url(url)
+    return '%s:%s' % (url.drivername, build_description_url(
+            dbhost=url.host, dbport=url.port, dbname=url.database))
+
+def read_url_file(path):
+    """Returns the list of database URLs listed within the file `path`, one
+    per line. Empty lines and lines starting with ``#`` are ignored.
+    """
+    urls = []
+    with open(path, 'r') as fp:
+        for line in fp:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            urls.append(line)
+    return urls
+
+def run_on_databases(urls, patch_repo, operation, num_workers=8,
+        max_failures=None, simulate=False, driver_options=None):
+    """Performs `operation` on each of the databases `urls` and returns the
+    list of ``FanOutResult`` objects, in the order of `urls`.
+
+    The `patch_repo` is loaded and resolved only once and shared by all
+    databases. `operation` is called with a ``Driver`` per database, created
+    with the keyword arguments `driver_options`, and the database's session is
+    committed afterwards (or rolled back, in case `simulate` is set or the
+    operation failed). At most `num_workers` databases are processed at the
+    same time. Once `max_failures` operations failed, the databases not yet
+    started are skipped.
+    """
+    driver_options = _check_driver_options(patch_repo, driver_options)
+    def worker_factory():
+        return _DatabaseWorker(patch_repo, operation, simulate,
+                driver_options)
+    return _fan_out(urls, describe_url, worker_factory, num_workers,
+            max_failures)
+
+def run_on_schemas(engine, schemas, patch_repo, operation, num_workers=8,
+        max_failures=None, simulate=False, driver_options=None):
+    """Performs `operation` on each of the PostgreSQL `schemas` of the
+    database `engine` and returns the list of ``FanOutResult`` objects, in the
+    order of `schemas`.
+
+    Each schema keeps its own book-keeping tables. Each of the `num_workers`
+    workers holds one connection of the engine's pool and switches the
+    search_path of the connection to the schema it processes. Otherwise
+    behaves like ``run_on_databases``.
+    """
+    if engine.dialect.name != 'postgresql':
+        raise ValueError('schemas are only supported by PostgreSQL, not '
+                'by %s' % engine.dialect.name)
+    driver_options = _check_driver_options(patch_repo, driver_options)
+    if Driver(None, patch_repo, **driver_options).uses_savepoints():
+        enable_savepoints(engine)
+    def worker_factory():
+        return _SchemaWorker(engine, patch_repo, operation, simulate,
+                driver_options)
+    return _fan_out(schemas, lambda schema: schema, worker_factory,
+            num_workers, max_failures)
+
+def _check_driver_options(patch_repo, driver_options):
+    """Returns the `driver_options` (an empty dictionary for None), after
+    checking that they are accepted by ``Driver``, so that invalid options
+    fail at once instead of on each target."""
+    if driver_options is None:
+        driver_options = {}
+    Driver(None, patch_repo, **driver_options)
+    return driver_options
+
+def _fan_out(targets, describe, worker_factory, num_workers, max_failures):
+    """Processes the `targets` with up to `num_workers` threads. Each thread
+    processes its targets with a worker of its own, created by
+    `worker_factory` on first use. A worker's ``run`` method returns the
+    ``FanOutResult`` of a target.
+    """
+    results = [None] * len(targets)
+    tasks = Queue.Queue()
+    for pos, target in enumerate(targets):
+        tasks.put((pos, target))
+    lock = threading.Lock()
+    num_failures = [0]
+
+    def work():
+        worker = None
+        try:
+            while True:
+                try:
+                    pos, target = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                with lock:
+                    stopped = max_failures is not None and \
+                            num_failures[0] >= max_failures
+                if stopped:
+                    results[pos] = FanOutResult(target, describe(target),
+                            RESULT_SKIPPED)
+                    continue
+                try:
+                    if worker is None:
+                        worker = worker_factory()
+                except Exception, ex:
+                    result = _failed_result(target, describe(target), ex, None)
+                else:
+                    result = worker.run(target)
+                if result.status == RESULT_FAILED:
+                    with lock:
+                        num_failures[0] += 1
+                results[pos] = result
+        finally:
+            if worker is not None:
+                worker.close()
+
+    threads = [threading.Thread(target=work)
+            for _ in range(min(num_workers, len(targets)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+class _DatabaseWorker(object):
+    """Performs the operation on databases, using a new engine per
+    database."""
+    def __init__(self, patch_repo, operation, simulate, driver_options):
+        self._patch_repo = patch_repo
+        self._operation = operation
+        self._simulate = simulate
+        self._driver_options = driver_options
+
+    def run(self, url):
+        engine = create_engine(url)
+        sess = sessionmaker(bind=engine, autocommit=False)()
+        try:
+            driver = Driver(sess, self._patch_repo, **self._driver_options)
+            if driver.uses_savepoints():
+                enable_savepoints(engine)
+            return _run_operation(url, describe_url(url), driver,
+                    self._operation, self._simulate)
+        finally:
+            sess.close()
+            engine.dispose()
+
+    def close(self):
+        pass
+
+class _SchemaWorker(object):
+    """Performs the operation on schemas, using a single connection for all
+    schemas."""
+    def __init__(self, engine, patch_repo, operation, simulate,
+            driver_options):
+        self._conn = engine.connect()
+        self._sess = sessionmaker(bind=self._conn, autocommit=False)()
+        self._patch_repo = patch_repo
+        self._operation = operation
+        self._simulate = simulate
+        self._driver_options = driver_options
+
+    def run(self, schema):
+        try:
+            set_search_path(self._sess, schema)
+        except Exception, ex:
+            self._sess.rollback()
+            return _failed_result(schema, schema, ex, None)
+        # The search_path is set within the schema's transaction, so it is
+        # reset when the transaction is rolled back.
+        return _run_operation(schema, schema, Driver(self._sess,
+                self._patch_repo, schema=schema, **self._driver_options),
+                self._operation, self._simulate)
+
+    def close(self):
+        # Don't return the connection to the pool with a tenant's
+        # search_path.
+        try:
+            self._sess.execute('RESET search_path')
+            self._sess.commit()
+        finally:
+            self._sess.close()
+            self._conn.close()
+
+def _run_operation(target, description, driver, operation, simulate):
+    start_time = time.time()
+    sess = driver.sess
+    try:
+        operation(driver)
+        if simulate:
+            sess.rollback()
+        else:
+            sess.commit()
+    except (Exception, SystemExit), ex:
+        sess.rollback()
+        return _failed_result(target, description, ex, start_time)
+    return FanOutResult(target, description, RESULT_OK,
+            duration=time.time() - start_time)
+
+def _failed_result(target, description, ex, start_time):
+    if isinstance(ex, PatchFailedException):
+        errors = [ex.args[0]]
+        if ex.details is not None:
+            errors.extend(ex.details)
+    else:
+        errors = ['%s: %s' % (ex.__class__.__name__, ex)]
+    duration = time.time() - start_time if start_time is not None else None
+    return FanOutResult(target, description, RESULT_FAILED, errors,
+            duration)
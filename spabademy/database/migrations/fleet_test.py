@@ -0,0 +1,181 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Tests the ``spabademy.database.migration.fleet`` module.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from __future__ import with_statement
+
+import os
+import sys
+import tempfile
+import shutil
+import os.path
+from nose.tools import eq_
+from sqlalchemy.engine import create_engine
+from sqlalchemy.orm.session import sessionmaker
+from spabademy.database.migrations.patch import Patch
+from spabademy.database.migrations.patch import PatchRepository
+from spabademy.database.migrations.db import AppliedPatch
+from spabademy.database.migrations.driver import TRANSACTION_SAVEPOINT
+from spabademy.database.migrations.fleet import read_url_file
+from spabademy.database.migrations.fleet import run_on_databases
+from spabademy.database.migrations.fleet import run_on_schemas
+from spabademy.database.migrations.fleet import RESULT_OK
+from spabademy.database.migrations.fleet import RESULT_FAILED
+from spabademy.database.migrations.fleet import RESULT_SKIPPED
+from spabademy.script import fleet_main
+
+class TestFleet(object):
+    """Uses SQLite database files as the databases of the fleet."""
+    def __init__(self):
+        self.tmp_dir_path = None
+        self.urls = None
+        self.repo = None
+
+    def setUp(self):
+        self.tmp_dir_path = tempfile.mkdtemp()
+        self.urls = ['sqlite:///%s' % os.path.join(self.tmp_dir_path,
+                'shard%d.db' % i) for i in range(6)]
+        self.repo = PatchRepository(repo_name='test_repo')
+        self.repo.add_patches(
+                Patch('patch1', upgrade_sql='CREATE TABLE t1(a integer);'),
+                Patch('patch2', depends_on_names=[('patch1', False)],
+                        upgrade_sql='CREATE TABLE t2(a integer);'))
+        self.repo.resolve_dependencies()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir_path)
+
+    def applied_names(self, url):
+        engine = create_engine(url)
+        sess = sessionmaker(bind=engine)()
+        try:
+            return AppliedPatch.get_names(sess, 'test_repo')
+        finally:
+            sess.close()
+            engine.dispose()
+
+    def test_read_url_file(self):
+        path = os.path.join(self.tmp_dir_path, 'urls')
+        with open(path, 'w') as fp:
+            fp.write('# shards\n%s\n\n  %s  \n' % (self.urls[0], self.urls[1]))
+        eq_(read_url_file(path), self.urls[:2])
+
+    def test_upgrade(self):
+        results = run_on_databases(self.urls, self.repo,
+                lambda driver: driver.init_repo(), num_workers=3)
+        eq_([result.status for result in results], [RESULT_OK] * 6)
+        results = run_on_databases(self.urls, self.repo,
+                lambda driver: driver.upgrade(), num_workers=3)
+        eq_([result.target for result in results], self.urls)
+        eq_([result.status for result in results], [RESULT_OK] * 6)
+        for url in self.urls:
+            eq_(self.applied_names(url), frozenset(['patch1', 'patch2']))
+
+    def test_simulate(self):
+        run_on_databases(self.urls, self.repo,
+                lambda driver: driver.init_repo())
+        results = run_on_databases(self.urls, self.repo,
+                lambda driver: driver.upgrade(), simulate=True)
+        eq_([result.status for result in results], [RESULT_OK] * 6)
+        for url in self.urls:
+            eq_(self.applied_names(url), frozenset())
+
+    def test_fleet_main_test_command(self):
+        def init(driver):
+            driver.init_repo()
+            driver.sess.execute('CREATE TABLE log(a integer)')
+        run_on_databases(self.urls, self.repo, init)
+        # The downgrade leaves the row behind, so only a rollback removes it.
+        patch_dir = os.path.join(self.tmp_dir_path, 'sql_patches', 'patch1')
+        os.makedirs(patch_dir)
+        with open(os.path.join(self.tmp_dir_path, 'sql_patches',
+                'repo_name'), 'w') as fp:
+            fp.write('test_repo\n')
+        with open(os.path.join(patch_dir, 'upgrade.sql'), 'w') as fp:
+            fp.write('INSERT INTO log VALUES (1);\n')
+        url_file = os.path.join(self.tmp_dir_path, 'urls')
+        with open(url_file, 'w') as fp:
+            fp.write('\n'.join(self.urls))
+
+        old_cwd = os.getcwd()
+        old_argv = sys.argv
+        os.chdir(self.tmp_dir_path)
+        sys.argv = ['spabademy-fleet', '--split-statements', 'test',
+                url_file]
+        try:
+            fleet_main()
+        finally:
+            os.chdir(old_cwd)
+            sys.argv = old_argv
+        for url in self.urls:
+            eq_(self.applied_names(url), frozenset())
+            engine = create_engine(url)
+            try:
+                eq_(engine.execute('SELECT COUNT(*) FROM log').scalar(), 0)
+            finally:
+                engine.dispose()
+
+    def test_max_failures(self):
+        run_on_databases(self.urls[:2], self.repo,
+                lambda driver: driver.init_repo())
+        # Initialising the first two databases again fails.
+        results = run_on_databases(self.urls, self.repo,
+                lambda driver: driver.init_repo(), num_workers=1,
+                max_failures=2)
+        eq_([result.status for result in results], [RESULT_FAILED] * 2 +
+                [RESULT_SKIPPED] * 4)
+        eq_(results[0].errors,
+                ['RuntimeError: repository "test_repo" already exists'])
+        eq_(results[0].description, 'sqlite:/%s' % os.path.join(
+                self.tmp_dir_path, 'shard0.db'))
+
+    def test_savepoint_mode(self):
+        self.repo.add_patch(Patch('patch3', depends_on_names=[('patch2',
+                False)], upgrade_sql='CREATE TABLE t1(a integer);'))
+        self.repo.resolve_dependencies()
+        run_on_databases(self.urls[:2], self.repo,
+                lambda driver: driver.init_repo())
+        results = run_on_databases(self.urls[:2], self.repo,
+                lambda driver: driver.upgrade(),
+                driver_options={'transaction_mode': TRANSACTION_SAVEPOINT})
+        eq_([result.status for result in results], [RESULT_FAILED] * 2)
+        assert 'already exists' in results[0].errors[1], results[0].errors
+        # The patches before the failed one were committed.
+        for url in self.urls[:2]:
+            eq_(self.applied_names(url), frozenset(['patch1', 'patch2']))
+
+    def test_invalid_driver_options(self):
+        try:
+            run_on_databases(self.urls, self.repo,
+                    lambda driver: driver.upgrade(),
+                    driver_options={'commit_every': 0})
+        except ValueError:
+            pass
+        else:
+            assert False, 'expected ValueError'
+
+    def test_schemas_need_postgresql(self):
+        engine = create_engine(self.urls[0])
+        try:
+            run_on_schemas(engine, ['tenant1'], self.repo,
+                    lambda driver: driver.init_repo())
+        except ValueError:
+            pass
+        else:
+            assert False, 'expected ValueError'
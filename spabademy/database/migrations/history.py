@@ -0,0 +1,240 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Provides the run history of patches: a listener recording each patch's
+upgrade or downgrade in the ``migrate_patch_runs`` table, a progress report
+estimating the remaining time from the recorded durations and percentile
+summaries of the recorded durations.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from __future__ import with_statement
+
+import math
+import threading
+from spabademy.database.migrations.db import Repository
+from spabademy.database.migrations.db import PatchRun
+from spabademy.database.migrations.events import MigrationListener
+from spabademy.database.migrations.events import PLAN_COMPUTED
+from spabademy.database.migrations.events import PATCH_START
+from spabademy.database.migrations.events import PATCH_END
+from spabademy.database.migrations.events import STATEMENT_END
+
+# Percentiles listed by ``summarize_runs``.
+PERCENTILES = (50, 90, 99)
+
+class RunHistoryRecorder(MigrationListener):
+    """Collects a run record for each patch the driver upgrades or
+    downgrades. The records are kept in memory and written at once by
+    ``flush``, so that recording adds no statements to the migration itself
+    and failed runs are recorded even though their transaction was rolled
+    back.
+
+    *database*
+      description of the database the patches run on.
+    """
+    def __init__(self, database):
+        self.database = database
+        self._runs = []
+        self._current = {}
+        self._lock = threading.Lock()
+
+    def handle(self, event):
+        if event.kind == PATCH_START:
+            with self._lock:
+                self._current[event['patch']] = {'patch_name': event['patch'],
+                        'operation': event['operation'],
+                        'started_at': event.timestamp, 'num_statements': 0,
+                        'database': self.database}
+        elif event.kind == STATEMENT_END:
+            with self._lock:
+                run = self._current.get(event['patch'])
+                if run is None:
+                    return
+                run['num_statements'] += 1
+        elif event.kind == PATCH_END:
+            with self._lock:
+                run = self._current.pop(event['patch'], None)
+                if run is None:
+                    return
+                run['duration'] = event['duration']
+                run['rowcount'] = event['rowcount']
+                run['succeeded'] = not event['failed']
+                self._runs.append(run)
+
+    @property
+    def runs(self):
+        """The list of recorded runs not written yet."""
+        return list(self._runs)
+
+    def flush(self, sess, repo_name):
+        """Writes the recorded runs of the repository `repo_name` to the
+        history table, using the session `sess`, and commits the session.
+        Nothing is written in case the repository doesn't exist (anymore).
+        """
+        with self._lock:
+            runs = self._runs
+            self._runs = []
+        if len(runs) == 0:
+            return
+        repository_id = Repository.get_id(sess, repo_name)
+        if repository_id is None:
+            return
+        PatchRun.create_table(sess)
+        PatchRun.add_all(sess, repository_id, runs)
+        sess.commit()
+
+def expected_durations(runs):
+    """Returns a dictionary mapping ``(patch_name, operation)`` to the median
+    duration of the successful `runs` (as returned by
+    ``PatchRun.get_durations``)."""
+    durations = {}
+    for patch_name, operation, duration, succeeded in runs:
+        if succeeded:
+            durations.setdefault((patch_name, operation), []).append(duration)
+    return dict((key, percentile(sorted(values), 50))
+            for key, values in durations.iteritems())
+
+class ProgressReporter(MigrationListener):
+    """Writes a progress bar to the file object `fp` after each patch of a
+    plan, with an estimate of the remaining time. The estimate is based on the
+    `expected` durations (see ``expected_durations``), scaled by how fast the
+    patches run compared to their history. Patches without history are
+    expected to take as long as the average patch of the current run.
+
+    The remaining patches and their expected durations are kept as running
+    totals, so each finished patch is accounted for in constant time.
+    """
+    def __init__(self, fp, expected, width=30):
+        self._fp = fp
+        self._expected = expected
+        self._width = width
+        self._expected_average = None
+        if len(expected) > 0:
+            self._expected_average = sum(expected.itervalues()) / \
+                    len(expected)
+        self._remaining = set()
+        self._remaining_expected = 0.0
+        self._num_remaining_unknown = 0
+        self._num_patches = 0
+        self._start = None
+        self._total_duration = 0.0
+        self._num_durations = 0
+        self._actual_known = 0.0
+        self._expected_known = 0.0
+
+    def handle(self, event):
+        if event.kind == PLAN_COMPUTED:
+            self._remaining = set((patch_name, event['operation'])
+                    for patch_name in event['patches'])
+            self._remaining_expected = 0.0
+            self._num_remaining_unknown = 0
+            for key in self._remaining:
+                if key in self._expected:
+                    self._remaining_expected += self._expected[key]
+                else:
+                    self._num_remaining_unknown += 1
+            self._num_patches = len(self._remaining)
+            self._start = event.timestamp
+            self._total_duration = 0.0
+            self._num_durations = 0
+            self._actual_known = 0.0
+            self._expected_known = 0.0
+        elif event.kind == PATCH_END and self._start is not None:
+            key = (event['patch'], event['operation'])
+            if key in self._remaining:
+                self._remaining.remove(key)
+                if key in self._expected:
+                    self._remaining_expected -= self._expected[key]
+                else:
+                    self._num_remaining_unknown -= 1
+            self._total_duration += event['duration']
+            self._num_durations += 1
+            if key in self._expected:
+                self._actual_known += event['duration']
+                self._expected_known += self._expected[key]
+            self._fp.write(self.format(event.timestamp) + '\n')
+            self._fp.flush()
+
+    def estimate(self):
+        """Returns the estimated number of seconds left or None, if
+        unknown."""
+        if len(self._remaining) == 0:
+            return 0.0
+        scale = 1.0
+        if self._expected_known > 0:
+            scale = self._actual_known / self._expected_known
+        total = max(self._remaining_expected, 0.0) * scale
+        if self._num_remaining_unknown == 0:
+            return total
+        if self._num_durations > 0:
+            average = self._total_duration / self._num_durations
+        elif self._expected_average is not None:
+            average = self._expected_average
+        else:
+            return None
+        return total + self._num_remaining_unknown * average
+
+    def format(self, now):
+        num_done = self._num_patches - len(self._remaining)
+        filled = 0
+        if self._num_patches > 0:
+            filled = self._width * num_done // self._num_patches
+        eta = self.estimate()
+        return 'progress: [%s%s] %d/%d patches, elapsed %s, ETA %s' % (
+                '#' * filled, '-' * (self._width - filled), num_done,
+                self._num_patches, format_duration(now - self._start),
+                'unknown' if eta is None else format_duration(eta))
+
+def format_duration(seconds):
+    """Returns `seconds` formatted as ``H:MM:SS``."""
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+            seconds % 60)
+
+def percentile(values, percent):
+    """Returns the `percent` percentile of the sorted list `values`, using
+    the nearest-rank method, or None for an empty list."""
+    if len(values) == 0:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+def summarize_runs(runs):
+    """Returns a list of ``(patch_name, operation, num_runs, num_failed,
+    percentiles, maximum)`` tuples, one per patch and operation of the
+    `runs` (as returned by ``PatchRun.get_durations``), ordered by name.
+    `percentiles` is the list of the ``PERCENTILES`` of the successful
+    runs' durations and `maximum` is their maximum (all None, if there were no
+    successful runs).
+    """
+    stats = {}
+    for patch_name, operation, duration, succeeded in runs:
+        durations, num_failed = stats.get((patch_name, operation), ([], 0))
+        if succeeded:
+            durations.append(duration)
+        else:
+            num_failed += 1
+        stats[(patch_name, operation)] = (durations, num_failed)
+    summary = []
+    for (patch_name, operation), (durations, num_failed) in sorted(
+            stats.iteritems()):
+        durations.sort()
+        summary.append((patch_name, operation, len(durations) + num_failed,
+                num_failed, [percentile(durations, percent)
+                        for percent in PERCENTILES],
+                durations[-1] if durations else None))
+    return summary
@@ -0,0 +1,111 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Tests the ``spabademy.database.migration.history`` module.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from StringIO import StringIO
+from nose.tools import eq_
+from sqlalchemy.engine import create_engine
+from sqlalchemy.orm.session import sessionmaker
+from spabademy.database.migrations.driver import Driver
+from spabademy.database.migrations.db import PatchRun
+from spabademy.database.migrations.patch import Patch
+from spabademy.database.migrations.patch import PatchRepository
+from spabademy.database.migrations.events import MigrationEvent
+from spabademy.database.migrations.events import PLAN_COMPUTED
+from spabademy.database.migrations.events import PATCH_END
+from spabademy.database.migrations.history import RunHistoryRecorder
+from spabademy.database.migrations.history import ProgressReporter
+from spabademy.database.migrations.history import expected_durations
+from spabademy.database.migrations.history import summarize_runs
+from spabademy.database.migrations.history import percentile
+from spabademy.database.migrations.history import format_duration
+
+def test_percentile():
+    values = range(1, 101)
+    eq_(percentile(values, 50), 50)
+    eq_(percentile(values, 99), 99)
+    eq_(percentile(values, 100), 100)
+    eq_(percentile([3.0], 90), 3.0)
+    eq_(percentile([], 50), None)
+
+def test_format_duration():
+    eq_(format_duration(0.4), '0:00:00')
+    eq_(format_duration(3725), '1:02:05')
+
+def test_summarize_runs():
+    runs = [('b', 'upgrade', 2.0, True), ('a', 'upgrade', 1.0, True),
+            ('a', 'upgrade', 3.0, True), ('a', 'upgrade', 9.0, False),
+            ('a', 'downgrade', 0.5, False)]
+    eq_(summarize_runs(runs), [
+            ('a', 'downgrade', 1, 1, [None, None, None], None),
+            ('a', 'upgrade', 3, 1, [1.0, 3.0, 3.0], 3.0),
+            ('b', 'upgrade', 1, 0, [2.0, 2.0, 2.0], 2.0)])
+    eq_(expected_durations(runs), {('a', 'upgrade'): 1.0,
+            ('b', 'upgrade'): 2.0})
+
+def test_progress_reporter():
+    fp = StringIO()
+    reporter = ProgressReporter(fp, {('a', 'upgrade'): 10.0,
+            ('b', 'upgrade'): 20.0}, width=4)
+    reporter.handle(MigrationEvent(PLAN_COMPUTED, 100.0, operation='upgrade',
+            patches=['a', 'b', 'c'], duration=0.0))
+    # Without runs, unknown patches take as long as known ones on average.
+    eq_(reporter.estimate(), 45.0)
+    # The patches run twice as fast as before.
+    reporter.handle(MigrationEvent(PATCH_END, 105.0, operation='upgrade',
+            patch='a', duration=5.0, failed=False))
+    eq_(reporter.estimate(), 15.0)
+    eq_(fp.getvalue(), 'progress: [#---] 1/3 patches, elapsed 0:00:05, '
+            'ETA 0:00:15\n')
+
+def test_recorder():
+    engine = create_engine('sqlite://')
+    sess = sessionmaker(bind=engine)()
+    repo = PatchRepository(repo_name='test_repo')
+    repo.add_patches(Patch('patch1', upgrade_sql='CREATE TABLE t1(a integer);'
+            '\nINSERT INTO t1 VALUES (1);'), Patch('patch2',
+            depends_on_names=[('patch1', False)],
+            upgrade_sql='INSERT INTO missing VALUES (1);'))
+    repo.resolve_dependencies()
+    driver = Driver(sess, repo, split_scripts=True)
+    driver.init_repo()
+    driver.commit()
+    recorder = RunHistoryRecorder('sqlite:memory')
+    driver.add_listener(recorder)
+    try:
+        driver.upgrade()
+    except Exception:
+        driver.rollback()
+    else:
+        assert False, 'expected the upgrade to fail'
+    runs = recorder.runs
+    eq_([(run['patch_name'], run['operation'], run['num_statements'],
+            run['rowcount'], run['succeeded'], run['database'])
+            for run in runs], [
+            ('patch1', 'upgrade', 2, 1, True, 'sqlite:memory'),
+            ('patch2', 'upgrade', 1, None, False, 'sqlite:memory')])
+
+    # The runs are recorded, although the upgrade was rolled back.
+    recorder.flush(sess, 'test_repo')
+    eq_(recorder.runs, [])
+    eq_([(name, operation, duration, succeeded) for name, operation,
+            duration, succeeded in PatchRun.get_durations(sess, 'test_repo')],
+            [(run['patch_name'], 'upgrade', run['duration'],
+                    run['succeeded']) for run in runs])
+    eq_(len(PatchRun.get_durations(sess, 'test_repo', ['patch2'])), 1)
@@ -0,0 +1,248 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Provides a persistent, compiled index of directory-based patch repositories,
+which avoids re-parsing unchanged patch directories on every start-up.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from __future__ import with_statement
+
+import sys
+import os
+import os.path
+import errno
+import time
+import hashlib
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from spabademy.database.migrations.patch import Patch
+from spabademy.database.migrations.patch import PatchRepository
+from spabademy.database.migrations.patch import DataFile
+from spabademy.database.migrations.patch import FileScript
+from spabademy.database.migrations.patch import COMPRESSED_SUFFIXES
+
+INDEX_MAGIC = 'SPABADEMY-INDEX 7\n'
+
+PATCH_FILES = ['depends_on', 'parallel_safe', 'data_files', 'upgrade.py',
+        'downgrade.py']
+# Files that may also exist in compressed form.
+SCRIPT_FILES = ['upgrade.sql', 'downgrade.sql']
+
+# Files modified less than this number of seconds before the index was written
+# might be modified again without changing their mtime, so they are not trusted
+# on the next start-up.
+_RACY_SECONDS = 2
+
+class CachedDirPatchRepositoryLoader(object):
+    """Loads patches from directory of patches, like
+    ``DirPatchRepositoryLoader``, but keeps a compiled index of each loaded
+    repository within `cache_dir`.
+
+    The index only holds the metadata of the patches: their names, the
+    parsed dependencies, the content hashes, the parallel-safe markers and the
+    data file manifests. The SQL scripts, Python migrations and data files
+    stay in the patch directories and are read from there on demand (see
+    ``FileScript``). On start-up, the index is validated by comparing the
+    mtimes and sizes of the patch directories and files, so an unchanged
+    repository is loaded with ``stat`` calls only. Patches whose files
+    changed are re-read by `patch_loader`.
+    """
+    def __init__(self, patch_loader, cache_dir):
+        self._patch_loader = patch_loader
+        self._cache_dir = cache_dir
+        self.num_reloaded_patches = 0
+
+    def index_path(self, repo_dir):
+        """Returns the path of the index file used for `repo_dir`."""
+        key = hashlib.sha1(os.path.abspath(repo_dir)).hexdigest()
+        return os.path.join(self._cache_dir, '%s.idx' % key)
+
+    def load_repo(self, repo_dir):
+        """Returns a new repo with patches loaded from ``repo_dir``.
+        """
+        index_path = self.index_path(repo_dir)
+        index = _read_index(index_path)
+        if index is None or index['repo_dir'] != os.path.abspath(repo_dir):
+            index = {'repo_dir': os.path.abspath(repo_dir), 'dir_mtime': None,
+                    'repo_name': None, 'repo_name_stat': None, 'patches': []}
+        cached_patches = dict((entry['name'], entry)
+                for entry in index['patches'])
+
+        changed = False
+        dir_mtime = os.stat(repo_dir).st_mtime
+        if dir_mtime == index['dir_mtime']:
+            patch_names = [entry['name'] for entry in index['patches']]
+        else:
+            # Patches might have been added or removed, so scan the directory.
+            changed = True
+            patch_names = []
+            for name in sorted(os.listdir(repo_dir)):
+                if os.path.isdir(os.path.join(repo_dir, name)):
+                    patch_names.append(name)
+        repo_name_stat = _stat_file(os.path.join(repo_dir, 'repo_name'))
+
+        repo_name = index['repo_name']
+        if repo_name_stat != index['repo_name_stat']:
+            changed = True
+            repo_name = None
+            if repo_name_stat is not None:
+                with open(os.path.join(repo_dir, 'repo_name'), 'r') as fp:
+                    repo_name = fp.read().strip()
+
+        repo = PatchRepository(repo_name=repo_name)
+        entries = []
+        for patch_name in patch_names:
+            patch_path = os.path.join(repo_dir, patch_name)
+            entry = cached_patches.get(patch_name)
+            if entry is not None:
+                stats = _stat_patch(patch_path, [data_entry['name']
+                        for data_entry in entry['data_files']])
+            if entry is not None and _is_fresh(entry, stats):
+                patch = _patch_from_entry(entry, patch_path)
+            else:
+                changed = True
+                self.num_reloaded_patches += 1
+                patch = self._patch_loader.load_patch_dir(patch_path)
+                # The data files are only known after loading the patch.
+                stats = _stat_patch(patch_path, [data_file.name
+                        for data_file in patch.data_files])
+                entry = _patch_entry(patch, stats)
+            entries.append((entry, patch))
+            repo.add_patch(patch)
+
+        if changed:
+            try:
+                _write_index(index_path, repo_dir, dir_mtime, repo_name,
+                        repo_name_stat, entries)
+            except (IOError, OSError), e:
+                # The index is only a cache, so don't fail because of it.
+                print >>sys.stderr, "warning: could not write index '%s': "\
+                        "%s" % (index_path, e)
+        return repo
+
+def _stat_file(path):
+    """Returns ``[mtime, size]`` of `path` or None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    return [st.st_mtime, st.st_size]
+
+def _stat_patch(patch_path, data_file_names):
+    stats = {'.': _stat_file(patch_path)}
+    for fn in PATCH_FILES:
+        stats[fn] = _stat_file(os.path.join(patch_path, fn))
+    for fn in SCRIPT_FILES + data_file_names:
+        for suffix in [''] + [suffix for suffix, _ in COMPRESSED_SUFFIXES]:
+            stats[fn + suffix] = _stat_file(os.path.join(patch_path,
+                    fn + suffix))
+    return stats
+
+def _is_fresh(entry, stats):
+    return entry['stats'] == stats
+
+def _patch_entry(patch, stats):
+    """Returns the index entry describing `patch`, whose files have the
+    `stats`."""
+    return {
+        'name': patch.name,
+        'depends_on_names': patch.depends_on_names,
+        'content_hash': patch.content_hash,
+        'parallel_safe': patch.parallel_safe,
+        'data_files': [{
+            'name': data_file.name,
+            'table': data_file.table,
+            'columns': data_file.columns,
+            'downgrade': data_file.downgrade,
+            } for data_file in patch.data_files],
+        'stats': stats,
+        }
+
+def _patch_from_entry(entry, patch_path):
+    """Returns the ``Patch`` described by the index entry `entry`, with its
+    files read from `patch_path` on demand, like ``DirPatchLoader`` does."""
+    depends_on_names = [(dep_name, is_optional)
+            for dep_name, is_optional in entry['depends_on_names']]
+    data_files = [DataFile(data_entry['name'], data_entry['table'],
+            data_entry['columns'], FileScript(os.path.join(patch_path,
+                    data_entry['name'])), data_entry['downgrade'])
+            for data_entry in entry['data_files']]
+    return Patch(entry['name'], depends_on_names,
+            FileScript(os.path.join(patch_path, 'upgrade.sql')),
+            FileScript(os.path.join(patch_path, 'downgrade.sql')),
+            origin=patch_path, content_hash=entry['content_hash'],
+            parallel_safe=entry['parallel_safe'], data_files=data_files,
+            upgrade_py=FileScript(os.path.join(patch_path, 'upgrade.py'),
+                    compressed=False),
+            downgrade_py=FileScript(os.path.join(patch_path, 'downgrade.py'),
+                    compressed=False))
+
+def _read_index(index_path):
+    """Returns the index stored in `index_path` or None in case the file
+    doesn't exist or is not a valid index."""
+    try:
+        fp = open(index_path, 'rb')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    with fp:
+        if fp.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            return None
+        try:
+            return json.load(fp)
+        except ValueError:
+            return None
+
+def _write_index(index_path, repo_dir, dir_mtime, repo_name, repo_name_stat,
+        entries):
+    """Writes the index of the loaded patches to `index_path`. The file is
+    replaced atomically, so concurrent readers see either the old or the new
+    index.
+    """
+    racy_after = time.time() - _RACY_SECONDS
+    def trusted(stat):
+        if stat is not None and stat[0] >= racy_after:
+            return 'racy'
+        return stat
+
+    patch_entries = []
+    for entry, _ in entries:
+        entry = dict(entry)
+        entry['stats'] = dict((key, trusted(stat))
+                for key, stat in entry['stats'].iteritems())
+        patch_entries.append(entry)
+    index = {
+        'repo_dir': os.path.abspath(repo_dir),
+        'dir_mtime': dir_mtime if dir_mtime < racy_after else None,
+        'repo_name': repo_name,
+        'repo_name_stat': trusted(repo_name_stat),
+        'patches': patch_entries,
+        }
+
+    index_dir = os.path.dirname(os.path.abspath(index_path))
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    tmp_path = '%s.%d.tmp' % (index_path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        fp.write(INDEX_MAGIC)
+        json.dump(index, fp)
+    os.rename(tmp_path, index_path)
@@ -0,0 +1,150 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Tests the ``spabademy.database.migrations.index`` module.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from __future__ import with_statement
+
+import os
+import os.path
+import time
+import tempfile
+import shutil
+from nose.tools import eq_
+from spabademy.database.migrations.patch import DirPatchLoader
+from spabademy.database.migrations.patch import DirPatchRepositoryLoader
+from spabademy.database.migrations.index import CachedDirPatchRepositoryLoader
+
+class TestCachedDirPatchRepositoryLoader(object):
+    tmp_dir_path = None
+    repo_dir = None
+    cache_dir = None
+
+    def setUp(self):
+        self.tmp_dir_path = tempfile.mkdtemp()
+        self.repo_dir = os.path.join(self.tmp_dir_path, 'repo')
+        self.cache_dir = os.path.join(self.tmp_dir_path, 'cache')
+        os.mkdir(self.repo_dir)
+        # Files are dated back, so that the index trusts their mtimes.
+        self.mtime = time.time() - 100
+        self.write_file('repo_name', 'the_repo\n')
+        self.write_file('patch1/depends_on', 'patch2\npatch3?\n')
+        self.write_file('patch1/upgrade.sql', u'SELECT \'\xe4\'\n')
+        self.write_file('patch1/downgrade.sql', 'SELECT 2\n')
+        self.write_file('patch2/upgrade.sql', 'SELECT 3\n')
+        self.write_file('patch2/downgrade.sql', 'SELECT 4\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir_path, ignore_errors=True)
+
+    def write_file(self, name, contents):
+        path = os.path.join(self.repo_dir, name)
+        dir_path = os.path.dirname(path)
+        if not os.path.isdir(dir_path):
+            os.mkdir(dir_path)
+        with open(path, 'wb') as fp:
+            fp.write(contents.encode('utf-8'))
+        self.mtime += 1
+        for p in (path, dir_path, self.repo_dir):
+            os.utime(p, (self.mtime, self.mtime))
+
+    def load(self):
+        loader = CachedDirPatchRepositoryLoader(DirPatchLoader(),
+                self.cache_dir)
+        return loader, loader.load_repo(self.repo_dir)
+
+    def assert_same_repo(self, repo):
+        expected = DirPatchRepositoryLoader(DirPatchLoader())\
+                .load_repo(self.repo_dir)
+        eq_(repo.repo_name, expected.repo_name)
+        eq_(sorted(repo.patches.keys()), sorted(expected.patches.keys()))
+        for name, patch in expected.patches.iteritems():
+            cached_patch = repo.patches[name]
+            eq_(cached_patch.depends_on_names, patch.depends_on_names)
+            eq_(cached_patch.upgrade_sql, patch.upgrade_sql)
+            eq_(cached_patch.downgrade_sql, patch.downgrade_sql)
+            eq_(cached_patch.origin, patch.origin)
+            eq_(cached_patch.content_hash, patch.content_hash)
+
+    def test_warm_load(self):
+        loader, repo = self.load()
+        eq_(loader.num_reloaded_patches, 2)
+        self.assert_same_repo(repo)
+
+        loader, repo = self.load()
+        eq_(loader.num_reloaded_patches, 0)
+        self.assert_same_repo(repo)
+
+    def test_modified_patch(self):
+        self.load()
+        self.write_file('patch2/upgrade.sql', 'SELECT 5; SELECT 6;\n')
+        loader, repo = self.load()
+        eq_(loader.num_reloaded_patches, 1)
+        self.assert_same_repo(repo)
+
+        self.write_file('patch2/depends_on', 'patch1\n')
+        loader, repo = self.load()
+        eq_(loader.num_reloaded_patches, 1)
+        self.assert_same_repo(repo)
+
+    def test_added_and_removed_patch(self):
+        self.load()
+        self.write_file('patch3/upgrade.sql', 'SELECT 7\n')
+        shutil.rmtree(os.path.join(self.repo_dir, 'patch2'))
+        os.utime(self.repo_dir, (self.mtime + 1, self.mtime + 1))
+        loader, repo = self.load()
+        eq_(loader.num_reloaded_patches, 1)
+        self.assert_same_repo(repo)
+
+    def test_scripts_are_read_from_patch_dirs(self):
+        loader, _ = self.load()
+        with open(loader.index_path(self.repo_dir), 'rb') as fp:
+            assert 'SELECT' not in fp.read()
+        loader, repo = self.load()
+        eq_(loader.num_reloaded_patches, 0)
+        eq_(repo.patches['patch1'].upgrade_sql, u'SELECT \'\xe4\'\n')
+        # The scripts are only read when needed, from the patch directory.
+        with open(os.path.join(self.repo_dir, 'patch2', 'downgrade.sql'),
+                'r+b') as fp:
+            fp.write('SELECT 9\n')
+        eq_(repo.patches['patch2'].downgrade_sql, 'SELECT 9\n')
+
+    def test_renamed_repo(self):
+        self.load()
+        self.write_file('repo_name', 'other_repo\n')
+        loader, repo = self.load()
+        eq_(loader.num_reloaded_patches, 0)
+        eq_(repo.repo_name, 'other_repo')
+
+    def test_recently_modified_files_are_not_trusted(self):
+        self.write_file('patch2/upgrade.sql', 'SELECT 5\n')
+        now = time.time()
+        os.utime(os.path.join(self.repo_dir, 'patch2', 'upgrade.sql'),
+                (now, now))
+        self.load()
+        loader, repo = self.load()
+        eq_(loader.num_reloaded_patches, 1)
+        self.assert_same_repo(repo)
+
+    def test_corrupt_index(self):
+        loader, _ = self.load()
+        with open(loader.index_path(self.repo_dir), 'wb') as fp:
+            fp.write('garbage')
+        loader, repo = self.load()
+        eq_(loader.num_reloaded_patches, 2)
+        self.assert_same_repo(repo)
@@ -0,0 +1,76 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Provides the settings of the driver's online mode, in which patches are
+applied to databases in use: the patches run with lock and statement timeouts
+and are retried with jittered exponential backoff when they time out waiting
+for a lock, instead of queueing up the application's queries behind them.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+import time
+import random
+
+# Defaults of ``OnlinePolicy``, in seconds.
+LOCK_TIMEOUT = 2.0
+RETRY_BUDGET = 60.0
+BASE_DELAY = 0.5
+MAX_DELAY = 15.0
+
+# Used for waiting between the attempts and for the jitter. Can be replaced
+# for testing.
+sleep = time.sleep
+uniform = random.uniform
+
+class OnlinePolicy(object):
+    """Describes how patches are applied in online mode.
+
+    *lock_timeout*
+      seconds a statement may wait for a lock before it fails (the busy
+      timeout on SQLite).
+    *statement_timeout*
+      seconds a statement may run before it is cancelled, or None for no
+      limit (not supported on SQLite).
+    *retry_budget*
+      seconds after the first failed attempt of a patch, after which no
+      further attempts are made.
+    *base_delay*, *max_delay*
+      the wait before the n-th retry is chosen randomly between zero and
+      ``base_delay * 2 ** (n - 1)`` seconds, but at most `max_delay`
+      seconds.
+    """
+    def __init__(self, lock_timeout=LOCK_TIMEOUT, statement_timeout=None,
+            retry_budget=RETRY_BUDGET, base_delay=BASE_DELAY,
+            max_delay=MAX_DELAY):
+        self.lock_timeout = lock_timeout
+        self.statement_timeout = statement_timeout
+        self.retry_budget = retry_budget
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def iter_delays(self):
+        """Yields the seconds to wait before each retry, until the retry
+        budget is used up. The budget starts with the first ``next`` call,
+        i.e. after the first failed attempt.
+        """
+        start = time.time()
+        ceiling = self.base_delay
+        while True:
+            remaining = self.retry_budget - (time.time() - start)
+            if remaining <= 0:
+                return
+            yield min(uniform(0, min(ceiling, self.max_delay)), remaining)
+            ceiling *= 2
@@ -0,0 +1,43 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Tests the ``spabademy.database.migration.online`` module.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+import itertools
+from nose.tools import eq_
+from spabademy.database.migrations import online
+from spabademy.database.migrations.online import OnlinePolicy
+
+def test_iter_delays():
+    uniform = online.uniform
+    online.uniform = lambda low, high: high
+    try:
+        policy = OnlinePolicy(base_delay=0.5, max_delay=3.0)
+        eq_(list(itertools.islice(policy.iter_delays(), 5)),
+                [0.5, 1.0, 2.0, 3.0, 3.0])
+    finally:
+        online.uniform = uniform
+
+def test_iter_delays_jitter():
+    policy = OnlinePolicy(base_delay=1.0, max_delay=4.0)
+    for num, delay in enumerate(itertools.islice(policy.iter_delays(), 20)):
+        assert 0 <= delay <= min(2 ** num, 4.0)
+
+def test_iter_delays_budget():
+    policy = OnlinePolicy(retry_budget=0)
+    eq_(list(policy.iter_delays()), [])
@@ -0,0 +1,268 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Provides support for packed patch repositories: a single file holding all
+patches of a repository.
+
+A pack file starts with a magic line, followed by the UTF-8 encoded SQL
+scripts, Python migrations and data files of all patches. Behind them follows
+a JSON encoded header with the repository name and an entry per patch (name,
+dependencies, origin, content hash, parallel-safe marker, data file manifest
+and the byte offsets of the scripts, Python migrations and data files). The
+file ends with a trailer holding the offset of the header. Loading a pack only
+reads the header; everything else is read from a memory mapping of the file
+on demand.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from __future__ import with_statement
+
+import os
+import os.path
+import errno
+import codecs
+import mmap
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from spabademy.database.migrations.patch import Patch
+from spabademy.database.migrations.patch import PatchRepository
+from spabademy.database.migrations.patch import DataFile
+from spabademy.database.migrations.patch import iter_script_bytes
+from spabademy.database.migrations.patch import decode_chunks
+from spabademy.database.migrations.patch import STREAM_CHUNK_SIZE
+from spabademy.database.migrations.patch import hash_patch_content
+
+PACK_MAGIC = 'SPABADEMY-PACK 4\n'
+_TRAILER_LEN = 17
+
+class InvalidPack(Exception):
+    pass
+
+class PackScript(object):
+    """Provides the SQL text stored within a memory mapped pack file at
+    `offset`. The text is only decoded on demand.
+    """
+    def __init__(self, pack_map, offset, length):
+        self._pack_map = pack_map
+        self.offset = offset
+        self.length = length
+
+    def open(self):
+        """Returns a file-like object reading the text's bytes."""
+        return _PackReader(self._pack_map, self.offset, self.length)
+
+    def read_bytes(self):
+        return self._pack_map[self.offset:self.offset + self.length]
+
+    def read(self):
+        return codecs.utf_8_decode(buffer(self._pack_map, self.offset,
+                self.length), 'strict', True)[0]
+
+    def size(self):
+        return self.length
+
+    def iter_bytes(self, chunk_size=None):
+        """Returns an iterator over the bytes in pieces of up to `chunk_size`
+        bytes."""
+        if chunk_size is None:
+            chunk_size = STREAM_CHUNK_SIZE
+        end = self.offset + self.length
+        return (self._pack_map[pos:min(pos + chunk_size, end)]
+                for pos in xrange(self.offset, end, chunk_size))
+
+    def iter_chunks(self, chunk_size=None):
+        """Returns an iterator over the text in pieces of roughly
+        `chunk_size` bytes."""
+        return decode_chunks(self.iter_bytes(chunk_size))
+
+class _PackReader(object):
+    """Reads a section of a memory mapped pack file like a file."""
+    def __init__(self, pack_map, offset, length):
+        self._pack_map = pack_map
+        self._pos = offset
+        self._end = offset + length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, _value, _traceback):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        pass
+
+    def read(self, size=-1):
+        end = self._end if size < 0 else min(self._pos + size, self._end)
+        data = self._pack_map[self._pos:end]
+        self._pos = end
+        return data
+
+    def readline(self):
+        end = self._pack_map.find('\n', self._pos, self._end)
+        return self.read(-1 if end == -1 else end + 1 - self._pos)
+
+def pack_repo(pack_path, repo):
+    """Writes all patches of `repo` to the pack file `pack_path`, ordered by
+    name.
+    """
+    patches = sorted(repo.patches.itervalues(), key=lambda p: p.name)
+    write_pack(pack_path, repo.repo_name, patches)
+
+class PackedPatchRepositoryLoader(object):
+    """Loads patches from a pack file, as written by ``write_pack``.
+    """
+    def load_repo(self, pack_path):
+        """Returns a new repo with patches loaded from the pack file
+        ``pack_path``.
+        """
+        header, pack_map = read_pack(pack_path)
+        if header is None:
+            raise InvalidPack('%s is not a patch pack' % pack_path)
+        repo = PatchRepository(repo_name=header['repo_name'])
+        for entry in header['patches']:
+            repo.add_patch(patch_from_entry(entry, pack_map))
+        return repo
+
+def patch_from_entry(entry, pack_map):
+    """Returns the ``Patch`` described by the header entry `entry`."""
+    def script(key):
+        if entry[key] is None:
+            return None
+        offset, length = entry[key]
+        return PackScript(pack_map, offset, length)
+    depends_on_names = [(dep_name, is_optional)
+            for dep_name, is_optional in entry['depends_on_names']]
+    data_files = [DataFile(data_entry['name'], data_entry['table'],
+            data_entry['columns'], PackScript(pack_map, *data_entry['data']),
+            data_entry['downgrade'])
+            for data_entry in entry['data_files']]
+    return Patch(entry['name'], depends_on_names, script('upgrade'),
+            script('downgrade'), origin=entry['origin'],
+            content_hash=entry['content_hash'],
+            parallel_safe=entry['parallel_safe'], data_files=data_files,
+            upgrade_py=script('upgrade_py'),
+            downgrade_py=script('downgrade_py'))
+
+def read_pack(pack_path):
+    """Returns the header and a read-only memory mapping of the pack file
+    `pack_path` or ``(None, None)`` in case the file doesn't exist or is not a
+    valid pack.
+    """
+    try:
+        fp = open(pack_path, 'rb')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return (None, None)
+        raise
+    with fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size < len(PACK_MAGIC) + _TRAILER_LEN:
+            return (None, None)
+        # The mapping stays valid after closing the file and even after the
+        # file is replaced.
+        pack_map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if pack_map[:len(PACK_MAGIC)] != PACK_MAGIC:
+            return (None, None)
+        header_offset = int(pack_map[-_TRAILER_LEN:], 16)
+        header = json.loads(pack_map[header_offset:-_TRAILER_LEN])
+    except ValueError:
+        return (None, None)
+    return (header, pack_map)
+
+def write_pack(pack_path, repo_name, patches):
+    """Writes `patches` to the pack file `pack_path`. The file is replaced
+    atomically, so concurrent readers see either the old or the new pack.
+    """
+    pack_dir = os.path.dirname(os.path.abspath(pack_path))
+    if not os.path.isdir(pack_dir):
+        os.makedirs(pack_dir)
+    tmp_path = '%s.%d.tmp' % (pack_path, os.getpid())
+    with open(tmp_path, 'w+b') as fp:
+        fp.write(PACK_MAGIC)
+        def add_script(script):
+            # The scripts are copied piece by piece, to keep the memory usage
+            # low.
+            chunks = iter_script_bytes(script)
+            if chunks is None:
+                return None
+            offset = fp.tell()
+            for data in chunks:
+                fp.write(data)
+            return [offset, fp.tell() - offset]
+
+        entries = []
+        for patch in patches:
+            upgrade_pos = add_script(patch.upgrade_script)
+            downgrade_pos = add_script(patch.downgrade_script)
+            upgrade_py_pos = add_script(patch.upgrade_py)
+            downgrade_py_pos = add_script(patch.downgrade_py)
+            data_entries = []
+            data_digests = []
+            for data_file in patch.data_files:
+                # Data files are copied piece by piece.
+                offset = fp.tell()
+                length, digest = data_file.copy(fp.write)
+                data_digests.append(digest)
+                data_entries.append({
+                    'name': data_file.name,
+                    'table': data_file.table,
+                    'columns': data_file.columns,
+                    'downgrade': data_file.downgrade,
+                    'data': [offset, length],
+                    })
+            entry = {
+                'name': patch.name,
+                'origin': patch.origin,
+                'depends_on_names': patch.depends_on_names,
+                'content_hash': _pack_content_hash(fp, patch, [upgrade_pos,
+                        downgrade_pos, upgrade_py_pos, downgrade_py_pos],
+                        data_digests),
+                'upgrade': upgrade_pos,
+                'downgrade': downgrade_pos,
+                'upgrade_py': upgrade_py_pos,
+                'downgrade_py': downgrade_py_pos,
+                'parallel_safe': patch.parallel_safe,
+                'data_files': data_entries,
+                }
+            entries.append(entry)
+
+        header = {'repo_name': repo_name, 'patches': entries}
+        header_offset = fp.tell()
+        fp.write(json.dumps(header))
+        fp.write('%016x\n' % header_offset)
+    os.rename(tmp_path, pack_path)
+
+def _pack_content_hash(fp, patch, positions, data_digests):
+    """Returns the content hash of `patch`, whose scripts were just written
+    at the `[offset, length]` `positions` of the pack file `fp`. The scripts
+    are hashed piece by piece from the written copies, so compressed scripts
+    aren't decompressed again.
+    """
+    fp.flush()
+    pack_map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        scripts = [PackScript(pack_map, *pos) if pos is not None else None
+                for pos in positions]
+        return hash_patch_content(patch.depends_on_names, scripts[0],
+                scripts[1], data_digests, (scripts[2], scripts[3]))
+    finally:
+        pack_map.close()
@@ -0,0 +1,133 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Tests the ``spabademy.database.migrations.pack`` module.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from __future__ import with_statement
+
+import os
+import os.path
+import tempfile
+import shutil
+from nose.tools import eq_
+from nose.tools import raises
+from spabademy.database.migrations.patch import Patch
+from spabademy.database.migrations.patch import PatchRepository
+from spabademy.database.migrations.patch import DirPatchLoader
+from spabademy.database.migrations.patch import DirPatchRepositoryLoader
+from spabademy.database.migrations.pack import PackedPatchRepositoryLoader
+from spabademy.database.migrations.pack import InvalidPack
+from spabademy.database.migrations.pack import pack_repo
+
+class TestPackedPatchRepositoryLoader(object):
+    tmp_dir_path = None
+
+    def setUp(self):
+        self.tmp_dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir_path, ignore_errors=True)
+
+    def write_file(self, name, contents):
+        path = os.path.join(self.tmp_dir_path, 'repo', name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fp:
+            fp.write(contents.encode('utf-8'))
+
+    def test_pack_dir_repo(self):
+        self.write_file('repo_name', 'the_repo\n')
+        self.write_file('patch1/depends_on', 'patch2\npatch3?\n')
+        self.write_file('patch1/upgrade.sql', u'SELECT \'\xe4\'\n')
+        self.write_file('patch1/downgrade.sql', '')
+        self.write_file('patch2/upgrade.sql', 'SELECT 3\n')
+        os.mkdir(os.path.join(self.tmp_dir_path, 'repo', 'patch3'))
+
+        repo = DirPatchRepositoryLoader(DirPatchLoader()).load_repo(
+                os.path.join(self.tmp_dir_path, 'repo'))
+        pack_path = os.path.join(self.tmp_dir_path, 'repo.pack')
+        pack_repo(pack_path, repo)
+        packed_repo = PackedPatchRepositoryLoader().load_repo(pack_path)
+
+        eq_(packed_repo.repo_name, 'the_repo')
+        eq_(sorted(packed_repo.patches.keys()), sorted(repo.patches.keys()))
+        for name, patch in repo.patches.iteritems():
+            packed_patch = packed_repo.patches[name]
+            eq_(packed_patch.depends_on_names, patch.depends_on_names)
+            eq_(packed_patch.upgrade_sql, patch.upgrade_sql)
+            eq_(packed_patch.downgrade_sql, patch.downgrade_sql)
+            eq_(packed_patch.origin, patch.origin)
+            eq_(packed_patch.content_hash, patch.content_hash)
+
+        packed_repo.resolve_dependencies()
+        eq_(packed_repo.patches['patch1'].depends_on,
+                [packed_repo.patches['patch2'], packed_repo.patches['patch3']])
+
+        # The scripts are read from the pack, not from the directories.
+        shutil.rmtree(os.path.join(self.tmp_dir_path, 'repo'))
+        eq_(packed_repo.patches['patch2'].upgrade_sql, 'SELECT 3\n')
+        eq_(list(packed_repo.patches['patch1'].upgrade_script.iter_chunks(
+                chunk_size=3)), [u'SEL', u'ECT', u" '", u"\xe4'\n"])
+
+    def test_pack_text_patches(self):
+        repo = PatchRepository(repo_name='the_repo')
+        repo.add_patches(Patch('patch1', upgrade_sql=u'SELECT 1'),
+                Patch('patch2', depends_on_names=[('patch1', False)],
+                        downgrade_sql='SELECT 2'))
+        pack_path = os.path.join(self.tmp_dir_path, 'repo.pack')
+        pack_repo(pack_path, repo)
+        packed_repo = PackedPatchRepositoryLoader().load_repo(pack_path)
+        eq_(packed_repo.patches['patch1'].upgrade_sql, 'SELECT 1')
+        eq_(packed_repo.patches['patch1'].downgrade_sql, None)
+        eq_(packed_repo.patches['patch2'].downgrade_sql, 'SELECT 2')
+        eq_(packed_repo.patches['patch2'].origin, None)
+
+    def test_pack_data_files(self):
+        self.write_file('repo_name', 'the_repo\n')
+        self.write_file('patch1/data_files', '# reference data\n'
+                'rows.csv t a,b delete\n')
+        self.write_file('patch1/rows.csv', u'1,x\n2,\xe4\n')
+        self.write_file('patch1/upgrade.py', 'QUERY = "SELECT 1"\n')
+        repo = DirPatchRepositoryLoader(DirPatchLoader()).load_repo(
+                os.path.join(self.tmp_dir_path, 'repo'))
+        pack_path = os.path.join(self.tmp_dir_path, 'repo.pack')
+        pack_repo(pack_path, repo)
+        packed_repo = PackedPatchRepositoryLoader().load_repo(pack_path)
+
+        patch = repo.patches['patch1']
+        packed_patch = packed_repo.patches['patch1']
+        eq_(packed_patch.content_hash, patch.content_hash)
+        eq_(packed_patch.upgrade_py.read(), 'QUERY = "SELECT 1"\n')
+        eq_(packed_patch.downgrade_py, None)
+        data_file, = packed_patch.data_files
+        eq_((data_file.name, data_file.table, data_file.columns,
+                data_file.downgrade), ('rows.csv', 't', ['a', 'b'], 'delete'))
+        with data_file.open() as fp:
+            eq_(list(fp), ['1,x\n', u'2,\xe4\n'.encode('utf-8')])
+
+        # The data file is part of the content hash.
+        self.write_file('patch1/rows.csv', '1,x\n')
+        eq_(DirPatchLoader().load_patch(os.path.join(self.tmp_dir_path,
+                'repo', 'patch1')).content_hash == patch.content_hash, False)
+
+    @raises(InvalidPack)
+    def test_invalid_pack(self):
+        pack_path = os.path.join(self.tmp_dir_path, 'repo.pack')
+        with open(pack_path, 'wb') as fp:
+            fp.write('garbage' * 10)
+        PackedPatchRepositoryLoader().load_repo(pack_path)
@@ -20,8 +20,32 @@ Provides support for parsing SQL patch files (snippets).
 
 from __future__ import with_statement
 
+import os
 import os.path
+import errno
 import codecs
+import heapq
+import hashlib
+import mmap
+import gzip
+import bz2
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+try:
+    import lzma as _lzma
+except ImportError:
+    try:
+        from backports import lzma as _lzma
+    except ImportError:
+        _lzma = None
 
 class Patch(object):
     '''
@@ -34,22 +58,79 @@ class Patch(object):
     may be optional, in which case it is acceptable for the patch to not exist.
     In case optional, depended-upon patches exist and aren't applied, they need
     to be applied before this patch.
+
+    The SQL directives are either passed as text or as script objects (like
+    ``FileScript``), which read the text on demand each time ``upgrade_sql``
+    or ``downgrade_sql`` is accessed. Large scripts can be read piece by piece
+    instead (see ``iter_script_chunks``).
+
+    Patches marked as ``parallel_safe`` may be applied concurrently with other
+    parallel-safe patches they don't depend on.
+
+    The ``data_files`` (see ``DataFile``) are bulk loaded after the upgrade
+    SQL and unloaded before the downgrade SQL. Afterwards and before that
+    (respectively), the Python source of ``upgrade_py`` or ``downgrade_py``
+    is run (see ``PythonMigration``). Like the SQL directives, it is passed as
+    text or as a script object.
     '''
 
     def __init__(self, name, depends_on_names=None, upgrade_sql=None,
-                 downgrade_sql=None, origin=None):
+                 downgrade_sql=None, origin=None, content_hash=None,
+                 parallel_safe=False, data_files=None, upgrade_py=None,
+                 downgrade_py=None):
         self.name = name
         self.depends_on_names = depends_on_names \
                 if depends_on_names is not None else []
         self.depends_on = []
+        self.dependents = []
         self.upgrade_sql = upgrade_sql
         self.downgrade_sql = downgrade_sql
         self.origin = origin
         self.missing_deps = []
+        self._content_hash = content_hash
+        self.parallel_safe = parallel_safe
+        self.data_files = data_files if data_files is not None else []
+        self.upgrade_py = upgrade_py
+        self.downgrade_py = downgrade_py
 
     def __repr__(self):
         return "<Patch('%s')>" % (self.name)
 
+    def _get_upgrade_sql(self):
+        return script_text(self._upgrade_sql)
+    def _set_upgrade_sql(self, upgrade_sql):
+        self._upgrade_sql = upgrade_sql
+    upgrade_sql = property(_get_upgrade_sql, _set_upgrade_sql)
+
+    def _get_downgrade_sql(self):
+        return script_text(self._downgrade_sql)
+    def _set_downgrade_sql(self, downgrade_sql):
+        self._downgrade_sql = downgrade_sql
+    downgrade_sql = property(_get_downgrade_sql, _set_downgrade_sql)
+
+    @property
+    def upgrade_script(self):
+        '''The script object or text the upgrade SQL is read from.'''
+        return self._upgrade_sql
+
+    @property
+    def downgrade_script(self):
+        '''The script object or text the downgrade SQL is read from.'''
+        return self._downgrade_sql
+
+    @property
+    def content_hash(self):
+        '''
+        SHA-1 hex digest over the patch's dependencies and SQL scripts, which
+        identifies the patch's contents. Calculated once on first use.
+        '''
+        if self._content_hash is None:
+            self._content_hash = hash_patch_content(self.depends_on_names,
+                    self._upgrade_sql, self._downgrade_sql,
+                    [data_file.digest() for data_file in self.data_files],
+                    (self.upgrade_py, self.downgrade_py))
+        return self._content_hash
+
     def resolve_dependencies(self, patch_repo):
         '''
         Search for the depended-on patches and populate
@@ -61,6 +142,7 @@ class Patch(object):
         Throws ``PatchNotFound`` in case a dependency can't be resolved.
         '''
         self.depends_on = []
+        self.missing_deps = []
         for dep_name, is_optional in self.depends_on_names:
             if dep_name in patch_repo.patches:
                 self.depends_on.append(patch_repo.patches[dep_name])
@@ -71,12 +153,336 @@ class Patch(object):
             else:
                 self.missing_deps.append(dep_name)
 
+def script_text(script):
+    """Returns the SQL text of `script`, which is either text or a script
+    object."""
+    if script is None or isinstance(script, basestring):
+        return script
+    return script.read()
+
+def script_bytes(script):
+    """Returns the UTF-8 encoded SQL of `script`, which is either text or a
+    script object."""
+    if script is None or isinstance(script, str):
+        return script
+    if isinstance(script, unicode):
+        return script.encode('utf-8')
+    return script.read_bytes()
+
+def script_size(script):
+    """Returns the length of the UTF-8 encoded SQL of `script` or None in
+    case there is no script. Script objects are not read into memory."""
+    if script is None or isinstance(script, str):
+        return None if script is None else len(script)
+    if isinstance(script, unicode):
+        return len(script.encode('utf-8'))
+    return script.size()
+
+def iter_script_bytes(script, chunk_size=None):
+    """Returns an iterator over the UTF-8 encoded SQL of `script` in pieces of
+    up to `chunk_size` bytes, or None in case there is no script. Script
+    objects only keep the current piece in memory.
+    """
+    if script is None or isinstance(script, basestring):
+        data = script_bytes(script)
+        return None if data is None else iter([data])
+    return script.iter_bytes(chunk_size)
+
+def iter_script_chunks(script, chunk_size=None):
+    """Returns an iterator over the SQL text of `script` in pieces of roughly
+    `chunk_size` bytes, or None in case there is no script. Script objects
+    only keep the current piece in memory.
+    """
+    if script is None:
+        return None
+    if isinstance(script, basestring):
+        return iter([script])
+    return script.iter_chunks(chunk_size)
+
+def decode_chunks(chunks):
+    """Decodes the UTF-8 encoded pieces of text `chunks`, which may split
+    multi-byte characters."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for data in chunks:
+        text = decoder.decode(data)
+        if text:
+            yield text
+    text = decoder.decode('', True)
+    if text:
+        yield text
+
+def hash_patch_content(depends_on_names, upgrade_script, downgrade_script,
+        data_file_digests=None, python_scripts=(None, None)):
+    """Returns the SHA-1 hex digest over a patch's dependencies, UTF-8
+    encoded SQL scripts, data files (see ``Patch.content_hash`` and
+    ``DataFile.digest``) and UTF-8 encoded Python upgrade and downgrade
+    sources `python_scripts`. The scripts are passed as text or script
+    objects, which are hashed piece by piece."""
+    h = hashlib.sha1()
+    for dep_name, is_optional in depends_on_names:
+        h.update('%s%s\n' % (dep_name.encode('utf-8'),
+                '?' if is_optional else ''))
+    for script in (upgrade_script, downgrade_script):
+        _hash_script(h, '', script, script_size(script))
+    # Patches without data files and Python sources keep the hash they had
+    # before these were supported.
+    for digest in data_file_digests or []:
+        h.update('\0data:%s' % digest)
+    python_sizes = [script_size(script) for script in python_scripts]
+    if python_sizes != [None, None]:
+        for script, size in zip(python_scripts, python_sizes):
+            _hash_script(h, 'py', script, size)
+    return h.hexdigest()
+
+def _hash_script(h, prefix, script, size):
+    # The script's length precedes its contents, so it is determined first.
+    if size is None:
+        h.update('\0%s-' % prefix)
+        return
+    h.update('\0%s%d:' % (prefix, size))
+    for data in iter_script_bytes(script) or []:
+        h.update(data)
+
+DATA_FORMATS = {'.csv': 'csv', '.tsv': 'text'}
+DATA_DOWNGRADE_MODES = ('truncate', 'delete')
+
+class InvalidDataFiles(Exception):
+    """Is raised when a patch's ``data_files`` manifest can't be parsed.
+    """
+    pass
+
+class DataFile(object):
+    '''
+    A file of rows that a patch bulk loads into `table`.
+
+    *name*
+      name of the file within the patch directory. Files ending in ``.csv``
+      are in CSV format (unquoted empty values are NULL, ``""`` is an empty
+      string), files ending in
+      ``.tsv`` are in PostgreSQL's tab-separated text format (``\\N`` is
+      NULL).
+    *columns*
+      list of the table's columns the values of each row are loaded into.
+    *source*
+      script object (like ``FileScript``) the file's contents are read from.
+    *downgrade*
+      ``'truncate'`` to remove all rows of the table on downgrade or
+      ``'delete'`` to only delete the rows of the file, matched on all
+      columns.
+    '''
+    def __init__(self, name, table, columns, source, downgrade='truncate'):
+        self.name = name
+        self.table = table
+        self.columns = columns
+        self.source = source
+        self.downgrade = downgrade
+
+    def __repr__(self):
+        return "<DataFile('%s')>" % (self.name)
+
+    @property
+    def format(self):
+        return DATA_FORMATS[os.path.splitext(self.name)[1]]
+
+    def open(self):
+        """Returns the file opened for binary reading or None in case it
+        doesn't exist."""
+        return self.source.open()
+
+    def copy(self, write=None, chunk_size=None):
+        """Reads the file piece by piece, passing each piece to `write` (if
+        given). Returns the file's length and its digest (see ``digest``).
+        """
+        fp = self.open()
+        if fp is None:
+            raise PatchNotFound('data file "%s"' % self.name)
+        h = hashlib.sha1()
+        h.update((u'%s\0%s\0%s\0%s\0' % (self.name, self.table,
+                u','.join(self.columns), self.downgrade)).encode('utf-8'))
+        length = 0
+        with fp:
+            for data in iter(lambda: fp.read(chunk_size or STREAM_CHUNK_SIZE),
+                    ''):
+                h.update(data)
+                length += len(data)
+                if write is not None:
+                    write(data)
+        return length, h.hexdigest()
+
+    def digest(self):
+        """Returns the SHA-1 hex digest over the file's manifest entry and
+        contents."""
+        return self.copy()[1]
+
+def parse_data_files(lines, patch_path):
+    """Returns the ``DataFile`` objects described by the manifest `lines`,
+    with the files located in `patch_path`. Each line has the form
+    ``FILE TABLE COLUMN[,COLUMN...] [truncate|delete]``.
+    """
+    data_files = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) == 0:
+            continue
+        if len(fields) not in (3, 4) or \
+                os.path.splitext(fields[0])[1] not in DATA_FORMATS or \
+                (len(fields) == 4 and fields[3] not in DATA_DOWNGRADE_MODES):
+            raise InvalidDataFiles('%s: invalid data file line "%s"' % (
+                    patch_path, line))
+        name, table, columns = fields[:3]
+        downgrade = fields[3] if len(fields) == 4 else 'truncate'
+        data_files.append(DataFile(name, table, columns.split(','),
+                FileScript(os.path.join(patch_path, name)), downgrade))
+    return data_files
+
+# Scripts at least this large are decoded straight from a memory mapping of
+# the file, instead of reading them into an intermediate buffer first.
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+# Number of bytes read at once when iterating over a script's text.
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+def _open_xz(fn, mode):
+    if _lzma is None:
+        # Fails like the other openers in case the file doesn't exist.
+        open(fn, mode).close()
+        raise PatchNotAccessible('%s is xz-compressed, which needs the lzma '
+                'module (backports.lzma on Python 2).' % fn)
+    return _lzma.LZMAFile(fn, mode)
+
+# Compressed variants of a script file, which are tried in this order in case
+# the uncompressed file doesn't exist.
+COMPRESSED_SUFFIXES = [
+    ('.gz', gzip.GzipFile),
+    ('.bz2', bz2.BZ2File),
+    ('.xz', _open_xz),
+    ]
+
+class FileScript(object):
+    '''
+    Provides the SQL text stored in the file `path`, reading it only on
+    demand. ``read`` returns None in case the file doesn't exist.
+
+    In case `path` doesn't exist, but a compressed variant of it (e.g.
+    ``upgrade.sql.gz``, see ``COMPRESSED_SUFFIXES``) does, the text is
+    decompressed on the fly. Pass false as `compressed` to disable this.
+    '''
+    def __init__(self, path, mmap_threshold=None, compressed=True):
+        self.path = path
+        self.mmap_threshold = mmap_threshold \
+                if mmap_threshold is not None else MMAP_THRESHOLD
+        self.compressed = compressed
+
+    def __repr__(self):
+        return "<FileScript('%s')>" % (self.path)
+
+    def _open(self):
+        fp = _open_patch_file(self.path, 'rb')
+        if fp is not None or not self.compressed:
+            return fp, False
+        for suffix, opener in COMPRESSED_SUFFIXES:
+            fp = _open_patch_file(self.path + suffix, 'rb', opener)
+            if fp is not None:
+                return fp, True
+        return None, False
+
+    def open(self):
+        """Returns the file opened for binary reading of the (decompressed)
+        text or None in case it doesn't exist."""
+        return self._open()[0]
+
+    def read_bytes(self):
+        fp = self.open()
+        if fp is None:
+            return None
+        with fp:
+            return fp.read()
+
+    def read(self):
+        fp, compressed = self._open()
+        if fp is None:
+            return None
+        with fp:
+            if compressed:
+                return fp.read().decode('utf-8')
+            size = os.fstat(fp.fileno()).st_size
+            if size < self.mmap_threshold or size == 0:
+                return fp.read().decode('utf-8')
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return codecs.utf_8_decode(mm, 'strict', True)[0]
+            finally:
+                mm.close()
+
+    def size(self):
+        """Returns the length of the (decompressed) text in bytes or None in
+        case the file doesn't exist. Compressed files are read piece by
+        piece to determine it."""
+        fp, compressed = self._open()
+        if fp is None:
+            return None
+        with fp:
+            if not compressed:
+                return os.fstat(fp.fileno()).st_size
+            return sum(len(data) for data in _iter_file_bytes(fp,
+                    STREAM_CHUNK_SIZE))
+
+    def iter_bytes(self, chunk_size=None):
+        """Returns an iterator over the (decompressed) bytes in pieces of up
+        to `chunk_size` bytes or None in case the file doesn't exist. The file
+        is closed once the iterator is exhausted or discarded.
+        """
+        fp = self.open()
+        if fp is None:
+            return None
+        return _iter_file_bytes(fp, chunk_size if chunk_size is not None
+                else STREAM_CHUNK_SIZE)
+
+    def iter_chunks(self, chunk_size=None):
+        """Returns an iterator over the text in pieces of roughly
+        `chunk_size` bytes or None in case the file doesn't exist. The file is
+        closed once the iterator is exhausted or discarded.
+        """
+        chunks = self.iter_bytes(chunk_size)
+        if chunks is None:
+            return None
+        return decode_chunks(chunks)
+
+def _iter_file_bytes(fp, chunk_size):
+    with fp:
+        for data in iter(lambda: fp.read(chunk_size), ''):
+            yield data
+
+def _open_patch_file(fn, mode, opener=open):
+    """Return ``fn`` opened with `mode` by `opener` or None if it doesn't
+    exist.
+    """
+    try:
+        return opener(fn, mode)
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        if e.errno == errno.EACCES:
+            raise PatchNotAccessible(
+                '%s is not accessible for the current user.' % fn)
+        raise
+
 class PatchNotFound(Exception):
     pass
 
 class PatchNotAccessible(Exception):
     pass
 
+class PatchDependencyCycle(Exception):
+    """Is raised when patches depend on each other in a cycle. ``cycle``
+    holds the patches that form the cycle, each patch depending on the next
+    one and the last one depending on the first one.
+    """
+    def __init__(self, cycle):
+        Exception.__init__(self, 'patch dependency cycle: %s' % (
+                ' -> '.join([patch.name for patch in cycle + cycle[:1]])))
+        self.cycle = cycle
+
 class PatchRepository(object):
     '''
     Holds all patches for a certain repository that could potentially be
@@ -86,17 +492,105 @@ class PatchRepository(object):
     def __init__(self, repo_name=None):
         self.patches = {}
         self.repo_name = repo_name
+        self._reset_closure()
 
     def add_patch(self, patch):
         self.patches[patch.name] = patch
+        self._reset_closure()
 
     def add_patches(self, *patches):
         for patch in patches:
             self.add_patch(patch)
 
     def resolve_dependencies(self):
+        '''
+        Resolves the dependencies of all patches and builds the reverse
+        index: afterwards, ``dependents`` of each patch lists the patches that
+        directly depend on it.
+        '''
+        for patch in self.patches.itervalues():
+            patch.dependents = []
         for patch in self.patches.itervalues():
             patch.resolve_dependencies(self)
+            for dep in patch.depends_on:
+                dep.dependents.append(patch)
+        self._reset_closure()
+
+    def _reset_closure(self):
+        self._patch_ids = {}
+        self._num_patch_ids = 0
+        self._ancestor_masks = {}
+
+    def patch_id(self, patch):
+        '''
+        Returns the integer id of `patch`. The id is the patch's bit position
+        within the bitsets returned by ``ancestor_mask``. Ids are assigned on
+        first use and stay valid until the repository changes.
+        '''
+        patch_id = self._patch_ids.get(patch)
+        if patch_id is None:
+            patch_id = self._num_patch_ids
+            self._patch_ids[patch] = patch_id
+            self._num_patch_ids += 1
+        return patch_id
+
+    def ancestor_mask(self, patch):
+        '''
+        Returns the set of all patches `patch` directly or indirectly depends
+        on, as a bitset of patch ids (see ``patch_id``). The bitsets are
+        memoized, so each patch's ancestors are only calculated once.
+
+        Throws ``PatchDependencyCycle`` in case `patch` depends on a cycle.
+        '''
+        mask = self._ancestor_masks.get(patch)
+        if mask is not None:
+            return mask
+
+        # Depth-first walk, calculating the bitsets of the dependencies before
+        # the bitsets of the patches depending on them.
+        stack = [(patch, iter(patch.depends_on))]
+        on_stack = set([patch])
+        while len(stack) > 0:
+            current, deps = stack[-1]
+            for dep in deps:
+                if dep in self._ancestor_masks:
+                    continue
+                if dep in on_stack:
+                    path = [entry[0] for entry in stack]
+                    raise PatchDependencyCycle(path[path.index(dep):])
+                stack.append((dep, iter(dep.depends_on)))
+                on_stack.add(dep)
+                break
+            else:
+                stack.pop()
+                on_stack.remove(current)
+                mask = 0
+                for dep in current.depends_on:
+                    mask |= self._ancestor_masks[dep] | \
+                            (1 << self.patch_id(dep))
+                self._ancestor_masks[current] = mask
+        return self._ancestor_masks[patch]
+
+    def is_ancestor(self, patch, other_patch):
+        '''
+        Returns True in case `other_patch` directly or indirectly depends on
+        `patch`.
+        '''
+        return (self.ancestor_mask(other_patch) >> self.patch_id(patch)) & 1 \
+                == 1
+
+    def minimal_patches(self, patches):
+        '''
+        Returns the minimal set of patches that is equivalent to `patches`,
+        i.e. all patches of `patches` that no other patch of `patches`
+        depends on.
+        '''
+        patches = set(patches)
+        covered = 0
+        for patch in patches:
+            covered |= self.ancestor_mask(patch)
+        return set(patch for patch in patches
+                if not (covered >> self.patch_id(patch)) & 1)
 
     def lookup_patch_name(self, patch_name):
         return self.patches[patch_name]
@@ -115,7 +609,11 @@ class DirPatchLoader(object):
     single patch name per line. Each patch name represents a dependency. The
     ``upgrade_sql`` and ``downgrade_sql`` files contain SQL
     code for upgrading to the patch or downgrading from the patch
-    (respectively).
+    (respectively). The presence of an (empty) ``parallel_safe`` file marks
+    the patch as safe for parallel application. The ``data_files`` manifest
+    lists files of rows to bulk load (see ``parse_data_files``). The
+    ``upgrade.py`` and ``downgrade.py`` files contain Python data migrations
+    (see ``PythonMigration``).
 
     Any of the files can be ommitted and any additional files within the
     directory will be ignored.
@@ -128,27 +626,37 @@ class DirPatchLoader(object):
         """Returns the ``Patch`` loaded from the path ``patch_path``."""
         if not self.is_patch(patch_path):
             raise PatchNotFound('patch dir "%s"' % (patch_path))
-        patch_name = os.path.basename(patch_path)
         if not os.access(os.path.join(patch_path, '.'), os.F_OK):
             raise PatchNotAccessible(
                 '%s is not accessible for the current user.' \
                     % os.path.join(patch_path))
+        return self.load_patch_dir(patch_path)
+
+    def load_patch_dir(self, patch_path):
+        """Returns the ``Patch`` loaded from the path ``patch_path``, which
+        is already known to be a directory. Only the ``depends_on`` and
+        ``data_files`` files are read right away, without checking for their
+        existence first. The SQL scripts and data files, possibly compressed,
+        are read on demand (see ``FileScript``).
+        """
+        patch_name = os.path.basename(patch_path)
         depends_on_names = self._parse_dependencies(patch_path)
-        upgrade_sql = self._read_contents(os.path.join(patch_path,
-                'upgrade.sql'))
-        downgrade_sql = self._read_contents(os.path.join(patch_path,
-                'downgrade.sql'))
+        upgrade_sql = FileScript(os.path.join(patch_path, 'upgrade.sql'))
+        downgrade_sql = FileScript(os.path.join(patch_path, 'downgrade.sql'))
+        parallel_safe = os.path.exists(os.path.join(patch_path,
+                'parallel_safe'))
+        data_files = parse_data_files(self._read_lines_as_list(
+                os.path.join(patch_path, 'data_files')) or [], patch_path)
+
+        upgrade_py = FileScript(os.path.join(patch_path, 'upgrade.py'),
+                compressed=False)
+        downgrade_py = FileScript(os.path.join(patch_path, 'downgrade.py'),
+                compressed=False)
 
         return Patch(patch_name, depends_on_names, upgrade_sql, downgrade_sql,
-                origin=patch_path)
-
-    def _read_contents(self, fn):
-        """Return contents of ``fn`` or None if it doesn't exists.
-        """
-        if not os.path.exists(fn):
-            return None
-        with codecs.open(fn, 'rb', 'utf-8') as fp:
-            return fp.read()
+                origin=patch_path, parallel_safe=parallel_safe,
+                data_files=data_files, upgrade_py=upgrade_py,
+                downgrade_py=downgrade_py)
 
     def _parse_dependencies(self, patch_path):
         lines = self._read_lines_as_list(os.path.join(patch_path,
@@ -171,12 +679,13 @@ class DirPatchLoader(object):
         """Return the lines of ``fn`` as array or None if the file doesn't
         exist. Lines starting with ``#`` are ignored.
         """
-        if not os.path.exists(fn):
+        fp = _open_patch_file(fn, 'rb')
+        if fp is None:
             return None
         l = []
-        with codecs.open(fn, 'rb', 'utf-8') as fp:
+        with fp:
             for line in fp:
-                line = line.strip()
+                line = line.decode('utf-8').strip()
                 if line.startswith('#'):
                     continue
                 l.append(line)
@@ -204,58 +713,256 @@ class DirPatchRepositoryLoader(object):
         assert hasattr(repo, 'repo_name')
         return repo
 
+class ParallelDirPatchRepositoryLoader(DirPatchRepositoryLoader):
+    """Loads patches from directory of patches, like
+    ``DirPatchRepositoryLoader``, but lists the directory in a single
+    ``scandir`` pass and reads the patches' files with a bounded pool of
+    threads. Useful for slow (e.g. network) file systems.
+
+    Falls back to ``os.listdir`` in case ``scandir`` is not available.
+    """
+    def __init__(self, patch_loader, num_threads=8):
+        DirPatchRepositoryLoader.__init__(self, patch_loader)
+        self._num_threads = num_threads
+
+    def load_repo(self, repo_dir):
+        """Returns a new repo with patches loaded from ``repo_dir``.
+        """
+        repo = PatchRepository()
+        patch_paths = []
+        for name, path, is_dir in _scan_dir(repo_dir):
+            if name == "repo_name":
+                with open(path, 'r') as fp:
+                    repo.repo_name = fp.read().strip()
+            if is_dir:
+                patch_paths.append(path)
+        patch_paths.sort()
+
+        pool = ThreadPool(min(self._num_threads, max(len(patch_paths), 1)))
+        try:
+            patches = pool.map(self._patch_loader.load_patch_dir, patch_paths)
+        finally:
+            pool.close()
+            pool.join()
+        repo.add_patches(*patches)
+        return repo
+
+class ReachablePatchRepositoryLoader(object):
+    """Loads only those patches from one or more directories of patches that
+    are reachable from a set of patches, following their dependencies. Patches
+    in later directories override equally named patches in earlier
+    directories.
+
+    Useful for commands that only operate on a few patches of a large
+    repository: only the directories of the reachable patches are read.
+    """
+    def __init__(self, patch_loader, repo_dirs):
+        self._patch_loader = patch_loader
+        self._repo_dirs = list(repo_dirs)
+
+    def load_repo_name(self):
+        """Returns the repository name of the first directory or None."""
+        fp = _open_patch_file(os.path.join(self._repo_dirs[0], 'repo_name'),
+                'r')
+        if fp is None:
+            return None
+        with fp:
+            return fp.read().strip()
+
+    def load_repo(self, patch_names):
+        """Returns a new repo with the patches `patch_names` and all patches
+        they directly or indirectly depend on. Patches that can't be found are
+        skipped; resolving the repository's dependencies reports them.
+        """
+        repo = PatchRepository(repo_name=self.load_repo_name())
+        pending = list(patch_names)
+        seen = set()
+        while len(pending) > 0:
+            patch_name = pending.pop()
+            if patch_name in seen:
+                continue
+            seen.add(patch_name)
+            patch_path = self._find_patch(patch_name)
+            if patch_path is None:
+                continue
+            patch = self._patch_loader.load_patch_dir(patch_path)
+            repo.add_patch(patch)
+            pending.extend(dep_name
+                    for dep_name, _ in patch.depends_on_names)
+        return repo
+
+    def load_patches(self, patch_names):
+        """Returns a new repo with only the patches `patch_names`, without
+        following their dependencies. Raises ``PatchNotFound`` in case a patch
+        can't be found.
+        """
+        repo = PatchRepository(repo_name=self.load_repo_name())
+        for patch_name in patch_names:
+            patch_path = self._find_patch(patch_name)
+            if patch_path is None:
+                raise PatchNotFound('patch "%s"' % patch_name)
+            repo.add_patch(self._patch_loader.load_patch_dir(patch_path))
+        return repo
+
+    def _find_patch(self, patch_name):
+        if os.path.basename(patch_name) != patch_name or \
+                patch_name in ('', '.', '..'):
+            return None
+        for repo_dir in reversed(self._repo_dirs):
+            patch_path = os.path.join(repo_dir, patch_name)
+            if os.path.isdir(patch_path):
+                return patch_path
+        return None
+
+def _scan_dir(path):
+    """Yields a ``(name, path, is_dir)`` tuple for each entry within the
+    directory `path`.
+    """
+    if _scandir is not None:
+        for entry in _scandir(path):
+            yield (entry.name, entry.path, entry.is_dir())
+    else:
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            yield (name, entry_path, os.path.isdir(entry_path))
+
 def generate_upgrade_plan(applied_patches, to_be_applied_patches):
     """Return the ordered list of patches to be installed, so that
     `to_be_applied_patches`, the list of patches that should be present
     after the upgrade, is installed, including all dependencies.
 
-    Note: Assumes that the patch dependency graph is acyclic, otherwise the
-    method will enter an infinite loop.
+    The plan is calculated by counting the missing dependencies of each
+    missing patch and installing patches once that count drops to zero, so
+    every patch and every dependency is visited only once. In case several
+    patches could be installed next, the one with the smallest name is
+    chosen, which keeps the plan deterministic.
+
+    Raises ``PatchDependencyCycle`` in case the missing patches depend on
+    each other in a cycle.
     """
-    missing_patches = set(to_be_applied_patches).\
-            difference(applied_patches)
-    install_list = []
+    applied_patches = set(applied_patches)
+
+    # Collect the missing patches, including all missing dependencies.
+    missing_patches = set()
+    pending = [patch for patch in to_be_applied_patches
+            if patch not in applied_patches]
+    while len(pending) > 0:
+        patch = pending.pop()
+        if patch in missing_patches:
+            continue
+        missing_patches.add(patch)
+        for dep in patch.depends_on:
+            if dep not in applied_patches and dep not in missing_patches:
+                pending.append(dep)
+
+    # Count the missing dependencies of each missing patch and remember which
+    # patches are waiting on each dependency.
+    num_missing_deps = {}
+    dependents = {}
+    ready = []
+    for patch in missing_patches:
+        num_deps = 0
+        for dep in patch.depends_on:
+            if dep in missing_patches:
+                num_deps += 1
+                dependents.setdefault(dep, []).append(patch)
+        num_missing_deps[patch] = num_deps
+        if num_deps == 0:
+            ready.append((patch.name, patch))
+    heapq.heapify(ready)
 
-    while len(missing_patches) > 0:
-        for missing_patch in missing_patches.copy():
-            missing_deps = set(missing_patch.depends_on)
-            missing_deps.difference_update(applied_patches)
-            missing_deps.difference_update(set(install_list))
-            if len(missing_deps) == 0:
-                # At this point, we can install the patch, because the
-                # dependencies are either a) already installed or b) will
-                # be installed before this patch.
-                install_list.append(missing_patch)
-                missing_patches.remove(missing_patch)
-            else:
-                # Dependencies are missing. Add them to the set of patches
-                # that should be upgraded.
-                missing_patches.update(missing_deps)
+    install_list = []
+    while len(ready) > 0:
+        _, patch = heapq.heappop(ready)
+        install_list.append(patch)
+        for dependent in dependents.get(patch, ()):
+            num_missing_deps[dependent] -= 1
+            if num_missing_deps[dependent] == 0:
+                heapq.heappush(ready, (dependent.name, dependent))
+
+    if len(install_list) < len(missing_patches):
+        # The remaining patches (transitively) depend on themselves.
+        raise PatchDependencyCycle(_find_cycle(set(
+                patch for patch, num_deps in num_missing_deps.iteritems()
+                if num_deps > 0), lambda patch: patch.depends_on))
 
     return install_list
 
+def _find_cycle(blocked_patches, get_edges):
+    """Return a list of patches that form a cycle within `blocked_patches`,
+    following the edges returned by `get_edges` for each patch. Each of the
+    blocked patches needs an edge to at least one other blocked patch.
+    """
+    patch = min(blocked_patches, key=lambda p: p.name)
+    path = []
+    path_pos = {}
+    while patch not in path_pos:
+        path_pos[patch] = len(path)
+        path.append(patch)
+        for next_patch in get_edges(patch):
+            if next_patch in blocked_patches:
+                patch = next_patch
+                break
+    return path[path_pos[patch]:]
+
 def generate_downgrade_plan(applied_patches, to_be_removed_patches):
     """Return the ordered list of patches to uninstall. The list will also
     contain any patches that depend on the patches that are supposed to
     be uninstalled according to `to_be_removed_patches`.
+
+    Relies on the ``dependents`` index built by
+    ``PatchRepository.resolve_dependencies``. The plan is calculated by a
+    single walk over the applied dependents, removing each patch once all of
+    its applied dependents have been removed. In case several patches could be
+    removed next, the one with the smallest name is chosen.
+
+    Raises ``PatchDependencyCycle`` in case the patches to remove depend on
+    each other in a cycle.
     """
-    to_be_removed_patches = set(to_be_removed_patches).\
-            intersection(applied_patches)
-    uninstall_list = []
+    applied_patches = set(applied_patches)
+
+    # Collect the patches to remove, including all applied dependents.
+    removed_patches = set()
+    pending = [patch for patch in to_be_removed_patches
+            if patch in applied_patches]
+    while len(pending) > 0:
+        patch = pending.pop()
+        if patch in removed_patches:
+            continue
+        removed_patches.add(patch)
+        for dependent in patch.dependents:
+            if dependent in applied_patches and \
+                    dependent not in removed_patches:
+                pending.append(dependent)
+
+    # Count the remaining dependents of each patch to remove.
+    num_dependents = {}
+    ready = []
+    for patch in removed_patches:
+        num = 0
+        for dependent in patch.dependents:
+            if dependent in removed_patches:
+                num += 1
+        num_dependents[patch] = num
+        if num == 0:
+            ready.append((patch.name, patch))
+    heapq.heapify(ready)
 
-    while len(to_be_removed_patches) > 0:
-        for downgrade_patch in to_be_removed_patches.copy():
-            has_dependencies = False
-            for patch in set(applied_patches).\
-                    difference(set(uninstall_list)):
-                if downgrade_patch in patch.depends_on:
-                    # This patch has a dependency on the to-be uninstalled
-                    # patch, so it needs to go too.
-                    has_dependencies = True
-                    to_be_removed_patches.add(patch)
-            if not has_dependencies:
-                # Patch has no remaining dependencies.
-                uninstall_list.append(downgrade_patch)
-                to_be_removed_patches.remove(downgrade_patch)
+    uninstall_list = []
+    while len(ready) > 0:
+        _, patch = heapq.heappop(ready)
+        uninstall_list.append(patch)
+        for dep in patch.depends_on:
+            if dep in removed_patches:
+                num_dependents[dep] -= 1
+                if num_dependents[dep] == 0:
+                    heapq.heappush(ready, (dep.name, dep))
+
+    if len(uninstall_list) < len(removed_patches):
+        cycle = _find_cycle(set(
+                patch for patch, num in num_dependents.iteritems()
+                if num > 0), lambda patch: patch.dependents)
+        cycle.reverse()
+        raise PatchDependencyCycle(cycle)
 
     return uninstall_list
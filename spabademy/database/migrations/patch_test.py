@@ -21,13 +21,27 @@ Tests the ``spabademy.database.migrations.patch`` module.
 import tempfile
 import shutil
 import os.path
+import gzip
+import bz2
 from nose.tools import eq_
 from spabademy.database.migrations.patch import Patch
 from spabademy.database.migrations.patch import PatchRepository
+from spabademy.database.migrations.patch import PatchNotFound
 from spabademy.database.migrations.patch import DirPatchLoader
 from spabademy.database.migrations.patch import DirPatchRepositoryLoader
+from spabademy.database.migrations.patch import \
+        ParallelDirPatchRepositoryLoader
+from spabademy.database.migrations.patch import \
+        ReachablePatchRepositoryLoader
 from spabademy.database.migrations.patch import generate_upgrade_plan
 from spabademy.database.migrations.patch import generate_downgrade_plan
+from spabademy.database.migrations.patch import PatchDependencyCycle
+from spabademy.database.migrations.patch import FileScript
+from spabademy.database.migrations.patch import iter_script_chunks
+from spabademy.database.migrations.patch import hash_patch_content
+from spabademy.database.migrations import patch as patch_module
+from spabademy.database.migrations.patch import parse_data_files
+from spabademy.database.migrations.patch import InvalidDataFiles
 
 def test_create_empty_patch():
     """Check whether creating a Patch instance works."""
@@ -48,6 +62,71 @@ def test_resolve_deps():
     eq_(p3.depends_on, [])
     eq_(p4.depends_on, [])
 
+def test_resolve_dependents():
+    """Check that the reverse dependency index is built."""
+    p1 = Patch('patch1', depends_on_names=[
+            ('patch3', False), ('patch4', False)])
+    p3 = Patch('patch3', depends_on_names=[('patch4', False)])
+    p4 = Patch('patch4')
+    repo = PatchRepository()
+    repo.add_patches(p1, p3, p4)
+    repo.resolve_dependencies()
+    eq_(p1.dependents, [])
+    eq_(p3.dependents, [p1])
+    eq_(set(p4.dependents), set([p1, p3]))
+
+    # Resolving again must not duplicate entries.
+    repo.resolve_dependencies()
+    eq_(set(p4.dependents), set([p1, p3]))
+    eq_(len(p4.dependents), 2)
+
+def test_ancestors():
+    p1 = Patch('patch1', depends_on_names=[('patch2', False)])
+    p2 = Patch('patch2', depends_on_names=[('patch3', False),
+            ('patch4', False)])
+    p3 = Patch('patch3', depends_on_names=[('patch4', False)])
+    p4 = Patch('patch4')
+    p5 = Patch('patch5', depends_on_names=[('patch4', False)])
+    repo = PatchRepository()
+    repo.add_patches(p1, p2, p3, p4, p5)
+    repo.resolve_dependencies()
+
+    eq_(repo.ancestor_mask(p4), 0)
+    eq_(repo.ancestor_mask(p1), (1 << repo.patch_id(p2)) |
+            (1 << repo.patch_id(p3)) | (1 << repo.patch_id(p4)))
+    assert repo.is_ancestor(p4, p1)
+    assert repo.is_ancestor(p3, p2)
+    assert not repo.is_ancestor(p1, p4)
+    assert not repo.is_ancestor(p3, p5)
+    assert not repo.is_ancestor(p1, p1)
+
+def test_ancestors_cycle():
+    p1 = Patch('patch1', depends_on_names=[('patch2', False)])
+    p2 = Patch('patch2', depends_on_names=[('patch3', False)])
+    p3 = Patch('patch3', depends_on_names=[('patch2', False)])
+    repo = PatchRepository()
+    repo.add_patches(p1, p2, p3)
+    repo.resolve_dependencies()
+    try:
+        repo.ancestor_mask(p1)
+    except PatchDependencyCycle, ex:
+        eq_(ex.cycle, [p2, p3])
+    else:
+        assert False, 'expected PatchDependencyCycle'
+
+def test_minimal_patches():
+    p1 = Patch('patch1', depends_on_names=[('patch2', False)])
+    p2 = Patch('patch2', depends_on_names=[('patch3', False)])
+    p3 = Patch('patch3')
+    p4 = Patch('patch4', depends_on_names=[('patch3', False)])
+    p5 = Patch('patch5')
+    repo = PatchRepository()
+    repo.add_patches(p1, p2, p3, p4, p5)
+    repo.resolve_dependencies()
+    eq_(repo.minimal_patches([p1, p2, p3, p4, p5]), set([p1, p4, p5]))
+    eq_(repo.minimal_patches([p2, p3, p3]), set([p2]))
+    eq_(repo.minimal_patches([]), set())
+
 def test_lookup_patches():
     p1 = Patch('patch1')
     p3 = Patch('patch3')
@@ -90,8 +169,104 @@ class TestDirPatchLoader(TempDirTestCase):
         eq_(patch.upgrade_sql, 'SELECT 1\n')
         eq_(patch.downgrade_sql, 'SELECT 2\n')
 
+    def test_lazy_scripts(self):
+        patch_dir = os.path.join(self.tmp_dir_path, 'the_patch')
+        os.mkdir(patch_dir)
+        patch = DirPatchLoader().load_patch(patch_dir)
+        eq_(patch.upgrade_sql, None)
+
+        # The scripts are only read once they are accessed.
+        with open(os.path.join(patch_dir, 'upgrade.sql'), 'wb') as fp:
+            fp.write(u'SELECT \'\xe4\'\n'.encode('utf-8'))
+        eq_(patch.upgrade_sql, u'SELECT \'\xe4\'\n')
+        eq_(patch.downgrade_sql, None)
+
+    def test_mmap_script(self):
+        path = os.path.join(self.tmp_dir_path, 'upgrade.sql')
+        with open(path, 'wb') as fp:
+            fp.write(u'SELECT \'\xe4\'\n'.encode('utf-8'))
+        eq_(FileScript(path, mmap_threshold=1).read(), u'SELECT \'\xe4\'\n')
+        eq_(FileScript(path, mmap_threshold=1).read(),
+                FileScript(path).read())
+        eq_(FileScript(os.path.join(self.tmp_dir_path, 'missing.sql'),
+                mmap_threshold=1).read(), None)
+
+    def test_compressed_scripts(self):
+        patch_dir = os.path.join(self.tmp_dir_path, 'the_patch')
+        os.mkdir(patch_dir)
+        text = u'SELECT \'\xe4\';\n' * 100
+        with gzip.GzipFile(os.path.join(patch_dir, 'upgrade.sql.gz'),
+                'wb') as fp:
+            fp.write(text.encode('utf-8'))
+        with bz2.BZ2File(os.path.join(patch_dir, 'downgrade.sql.bz2'),
+                'wb') as fp:
+            fp.write('SELECT 2\n')
+        patch = DirPatchLoader().load_patch(patch_dir)
+        eq_(patch.upgrade_sql, text)
+        eq_(patch.downgrade_sql, u'SELECT 2\n')
+        eq_(patch.upgrade_script.read_bytes(), text.encode('utf-8'))
+
+        # The uncompressed script takes precedence.
+        with open(os.path.join(patch_dir, 'upgrade.sql'), 'wb') as fp:
+            fp.write('SELECT 1\n')
+        eq_(patch.upgrade_sql, u'SELECT 1\n')
+
+    def test_data_files(self):
+        data_files = parse_data_files(['a.csv t x,y', '', 'b.tsv s.u z delete'],
+                self.tmp_dir_path)
+        eq_([(data_file.name, data_file.table, data_file.columns,
+                data_file.format, data_file.downgrade)
+                for data_file in data_files], [
+                ('a.csv', 't', ['x', 'y'], 'csv', 'truncate'),
+                ('b.tsv', 's.u', ['z'], 'text', 'delete')])
+        for line in ['a.csv t', 'a.txt t x', 'a.csv t x drop']:
+            try:
+                parse_data_files([line], self.tmp_dir_path)
+            except InvalidDataFiles:
+                pass
+            else:
+                assert False, 'expected InvalidDataFiles for "%s"' % line
+
+    def test_iter_chunks(self):
+        path = os.path.join(self.tmp_dir_path, 'upgrade.sql')
+        text = u'SELECT \'\xe4\';\n' * 10
+        with open(path, 'wb') as fp:
+            fp.write(text.encode('utf-8'))
+        # The pieces split the two byte character.
+        chunks = list(iter_script_chunks(FileScript(path), chunk_size=9))
+        eq_(u''.join(chunks), text)
+        assert len(chunks) > 10
+        eq_(list(iter_script_chunks(u'SELECT 1')), [u'SELECT 1'])
+        eq_(iter_script_chunks(None), None)
+        eq_(iter_script_chunks(FileScript(path + '.missing')), None)
+
+    def test_streamed_content_hash(self):
+        patch_dir = os.path.join(self.tmp_dir_path, 'the_patch')
+        os.mkdir(patch_dir)
+        upgrade_data = u'SELECT \'\xe4\';\n'.encode('utf-8') * 100
+        with gzip.GzipFile(os.path.join(patch_dir, 'upgrade.sql.gz'),
+                'wb') as fp:
+            fp.write(upgrade_data)
+        with open(os.path.join(patch_dir, 'downgrade.sql'), 'wb') as fp:
+            fp.write('SELECT 2\n')
+        expected = hash_patch_content([], upgrade_data, 'SELECT 2\n')
+
+        # The scripts are hashed piece by piece, without reading them at once.
+        orig_chunk_size = patch_module.STREAM_CHUNK_SIZE
+        orig_read_bytes = FileScript.read_bytes
+        def read_bytes(self):
+            assert False, 'unexpected read_bytes call'
+        patch_module.STREAM_CHUNK_SIZE = 7
+        FileScript.read_bytes = read_bytes
+        try:
+            patch = DirPatchLoader().load_patch(patch_dir)
+            eq_(patch.content_hash, expected)
+        finally:
+            patch_module.STREAM_CHUNK_SIZE = orig_chunk_size
+            FileScript.read_bytes = orig_read_bytes
+
 class TestDirPatchRepositoryLoader(TempDirTestCase):
-    def test_repo_dir_load(self):
+    def create_repo_dir(self):
         patch_dir = os.path.join(self.tmp_dir_path, 'patch1')
         os.mkdir(patch_dir)
         with open(os.path.join(patch_dir, 'depends_on'), 'wb') as fp:
@@ -115,9 +290,12 @@ class TestDirPatchRepositoryLoader(TempDirTestCase):
             fp.write('patch2\n')
         with open(os.path.join(patch_dir, 'upgrade.sql'), 'wb') as fp:
             fp.write('SELECT 5\n')
+        open(os.path.join(patch_dir, 'parallel_safe'), 'wb').close()
 
         open(os.path.join(self.tmp_dir_path, 'unrelated_file'), 'wb').close()
 
+    def test_repo_dir_load(self):
+        self.create_repo_dir()
         repo_loader = DirPatchRepositoryLoader(patch_loader=DirPatchLoader())
         repo = repo_loader.load_repo(self.tmp_dir_path)
         eq_(set(repo.patches.keys()), set(['patch1', 'patch2', 'patch7']))
@@ -126,10 +304,84 @@ class TestDirPatchRepositoryLoader(TempDirTestCase):
         eq_(set(patch.depends_on_names), set([('patch2', False)]))
         eq_(patch.upgrade_sql, 'SELECT 5\n')
         eq_(patch.downgrade_sql, None)
+        eq_(patch.parallel_safe, True)
+        eq_(repo.patches['patch1'].parallel_safe, False)
 
         repo.resolve_dependencies()
         eq_(set(patch.depends_on), set([repo.patches['patch2']]))
 
+    def test_parallel_repo_dir_load(self):
+        self.create_repo_dir()
+        with open(os.path.join(self.tmp_dir_path, 'repo_name'), 'wb') as fp:
+            fp.write('the_repo\n')
+        repo = DirPatchRepositoryLoader(patch_loader=DirPatchLoader())\
+                .load_repo(self.tmp_dir_path)
+        parallel_repo = ParallelDirPatchRepositoryLoader(
+                patch_loader=DirPatchLoader(), num_threads=2)\
+                .load_repo(self.tmp_dir_path)
+
+        eq_(parallel_repo.repo_name, 'the_repo')
+        eq_(sorted(parallel_repo.patches.keys()), sorted(repo.patches.keys()))
+        for name, patch in repo.patches.iteritems():
+            parallel_patch = parallel_repo.patches[name]
+            eq_(parallel_patch.depends_on_names, patch.depends_on_names)
+            eq_(parallel_patch.upgrade_sql, patch.upgrade_sql)
+            eq_(parallel_patch.downgrade_sql, patch.downgrade_sql)
+            eq_(parallel_patch.origin, patch.origin)
+
+class TestReachablePatchRepositoryLoader(TempDirTestCase):
+    def create_patch(self, repo_dir, patch_name, deps, upgrade_sql):
+        patch_dir = os.path.join(self.tmp_dir_path, repo_dir, patch_name)
+        os.makedirs(patch_dir)
+        with open(os.path.join(patch_dir, 'depends_on'), 'wb') as fp:
+            for dep in deps:
+                fp.write('%s\n' % dep)
+        with open(os.path.join(patch_dir, 'upgrade.sql'), 'wb') as fp:
+            fp.write(upgrade_sql)
+
+    def test_load_reachable(self):
+        self.create_patch('repo', 'patch1', ['patch2', 'patch9?'], 'SELECT 1')
+        self.create_patch('repo', 'patch2', ['patch3'], 'SELECT 2')
+        self.create_patch('repo', 'patch3', [], 'SELECT 3')
+        self.create_patch('repo', 'patch4', ['patch3'], 'SELECT 4')
+        self.create_patch('repo', 'broken', ['does_not_exist'], 'SELECT 5')
+        self.create_patch('other', 'patch2', [], 'SELECT 6')
+        with open(os.path.join(self.tmp_dir_path, 'repo', 'repo_name'),
+                'wb') as fp:
+            fp.write('the_repo\n')
+
+        loader = ReachablePatchRepositoryLoader(DirPatchLoader(),
+                [os.path.join(self.tmp_dir_path, 'repo')])
+        repo = loader.load_repo(['patch1'])
+        eq_(repo.repo_name, 'the_repo')
+        eq_(set(repo.patches.keys()), set(['patch1', 'patch2', 'patch3']))
+        repo.resolve_dependencies()
+        eq_(repo.patches['patch1'].missing_deps, ['patch9'])
+
+        # Override repositories take precedence.
+        loader = ReachablePatchRepositoryLoader(DirPatchLoader(),
+                [os.path.join(self.tmp_dir_path, 'repo'),
+                os.path.join(self.tmp_dir_path, 'other')])
+        repo = loader.load_repo(['patch1', 'patch4', '../repo'])
+        eq_(set(repo.patches.keys()), set(['patch1', 'patch2', 'patch3',
+                'patch4']))
+        eq_(repo.patches['patch2'].upgrade_sql, 'SELECT 6')
+        repo.resolve_dependencies()
+
+    def test_load_patches(self):
+        self.create_patch('repo', 'patch1', ['patch2'], 'SELECT 1')
+        self.create_patch('repo', 'patch2', [], 'SELECT 2')
+        loader = ReachablePatchRepositoryLoader(DirPatchLoader(),
+                [os.path.join(self.tmp_dir_path, 'repo')])
+        repo = loader.load_patches(['patch1'])
+        eq_(repo.patches.keys(), ['patch1'])
+        try:
+            loader.load_patches(['patch1', 'patch9'])
+        except PatchNotFound:
+            pass
+        else:
+            assert False, 'expected PatchNotFound'
+
 
 def test_upgrade_from_empty():
     patchrepo = PatchRepository()
@@ -177,6 +429,59 @@ def test_complex_upgrade():
             to_be_applied_patches=[patch1])
     eq_(plan, [patch3, patch2, patch1])
 
+def test_upgrade_order_is_deterministic():
+    patchrepo = PatchRepository()
+    patch1 = Patch('patch1', depends_on_names=[('patch4', False),
+            ('patch3', False), ('patch2', False)])
+    patch2 = Patch('patch2', depends_on_names=[('patch5', False)])
+    patch3 = Patch('patch3', depends_on_names=[])
+    patch4 = Patch('patch4', depends_on_names=[])
+    patch5 = Patch('patch5', depends_on_names=[])
+    patchrepo.add_patches(patch1, patch2, patch3, patch4, patch5)
+    patchrepo.resolve_dependencies()
+
+    plan = generate_upgrade_plan(applied_patches=[],
+            to_be_applied_patches=[patch1])
+    eq_(plan, [patch3, patch4, patch5, patch2, patch1])
+
+def test_upgrade_long_chain():
+    patchrepo = PatchRepository()
+    patches = [Patch('patch%05d' % i,
+            depends_on_names=[('patch%05d' % (i - 1), False)] if i > 0 else [])
+            for i in range(5000)]
+    patchrepo.add_patches(*patches)
+    patchrepo.resolve_dependencies()
+
+    plan = generate_upgrade_plan(applied_patches=patches[:10],
+            to_be_applied_patches=[patches[-1]])
+    eq_(plan, patches[10:])
+
+def test_upgrade_cycle():
+    patchrepo = PatchRepository()
+    patch1 = Patch('patch1', depends_on_names=[('patch2', False)])
+    patch2 = Patch('patch2', depends_on_names=[('patch3', False),
+            ('patch5', False)])
+    patch3 = Patch('patch3', depends_on_names=[('patch4', False)])
+    patch4 = Patch('patch4', depends_on_names=[('patch2', False)])
+    patch5 = Patch('patch5', depends_on_names=[])
+    patchrepo.add_patches(patch1, patch2, patch3, patch4, patch5)
+    patchrepo.resolve_dependencies()
+
+    try:
+        generate_upgrade_plan(applied_patches=[],
+                to_be_applied_patches=[patch1])
+    except PatchDependencyCycle, ex:
+        eq_(ex.cycle, [patch2, patch3, patch4])
+        eq_(ex.args[0], 'patch dependency cycle: '
+                'patch2 -> patch3 -> patch4 -> patch2')
+    else:
+        assert False, 'expected PatchDependencyCycle'
+
+    # The cycle is irrelevant in case it is already applied.
+    plan = generate_upgrade_plan(applied_patches=[patch2, patch3, patch4,
+            patch5], to_be_applied_patches=[patch1])
+    eq_(plan, [patch1])
+
 def test_downgrade():
     patchrepo = PatchRepository()
     patch1 = Patch('patch1', depends_on_names=[('patch2', False)])
@@ -206,3 +511,41 @@ def test_downgrade():
             to_be_removed_patches=[patch5, patch4])
     assert plan == [patch1, patch2, patch3, patch4, patch5] or \
             plan == [patch1, patch2, patch3, patch5, patch4]
+
+def test_downgrade_ignores_unapplied_dependents():
+    patchrepo = PatchRepository()
+    patch1 = Patch('patch1', depends_on_names=[('patch3', False)])
+    patch2 = Patch('patch2', depends_on_names=[('patch3', False)])
+    patch3 = Patch('patch3', depends_on_names=[])
+    patchrepo.add_patches(patch1, patch2, patch3)
+    patchrepo.resolve_dependencies()
+
+    plan = generate_downgrade_plan(applied_patches=[patch2, patch3],
+            to_be_removed_patches=[patch3])
+    eq_(plan, [patch2, patch3])
+
+    plan = generate_downgrade_plan(applied_patches=[patch2, patch3],
+            to_be_removed_patches=[patch1])
+    eq_(plan, [])
+
+def test_downgrade_cycle():
+    patchrepo = PatchRepository()
+    patch1 = Patch('patch1', depends_on_names=[('patch2', False)])
+    patch2 = Patch('patch2', depends_on_names=[('patch1', False)])
+    patch3 = Patch('patch3', depends_on_names=[('patch1', False)])
+    patchrepo.add_patches(patch1, patch2, patch3)
+    patchrepo.resolve_dependencies()
+
+    try:
+        generate_downgrade_plan(applied_patches=[patch1, patch2, patch3],
+                to_be_removed_patches=[patch3])
+    except PatchDependencyCycle:
+        assert False, 'patch3 is not part of the cycle'
+
+    try:
+        generate_downgrade_plan(applied_patches=[patch1, patch2, patch3],
+                to_be_removed_patches=[patch1])
+    except PatchDependencyCycle, ex:
+        eq_(set(ex.cycle), set([patch1, patch2]))
+    else:
+        assert False, 'expected PatchDependencyCycle'
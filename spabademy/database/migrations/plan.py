@@ -0,0 +1,105 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Provides precomputed migration plans, which are stored in plan files.
+
+A plan file starts with a magic line, followed by a JSON encoded object with
+the repository name, the operation (``'upgrade'`` or ``'downgrade'``), the
+digest of the applied patches the plan was computed for (see
+``AppliedPatch.get_digest``) and the ordered list of the planned patches'
+names and content hashes.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from __future__ import with_statement
+
+import os
+import os.path
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# Version 1 plans only stored the number of applied patches and the largest
+# applied patch name, so they are rejected.
+PLAN_MAGIC = 'SPABADEMY-PLAN 2\n'
+
+class InvalidPlan(Exception):
+    """Is raised when a file is not a valid plan file."""
+    pass
+
+class PlanMismatch(Exception):
+    """Is raised when a plan doesn't match the database or the patches it is
+    applied to.
+    """
+    pass
+
+class MigrationPlan(object):
+    """An ordered list of patches to upgrade or downgrade, computed for a
+    specific set of applied patches.
+
+    *operation*
+      ``'upgrade'`` or ``'downgrade'``.
+    *fingerprint*
+      the digest of the applied patches at planning time (see
+      ``AppliedPatch.get_digest``).
+    *patches*
+      list of ``(patch_name, content_hash)`` tuples in the order the patches
+      are applied or removed. The content hash is None for applied patches
+      that weren't known at planning time.
+    """
+    def __init__(self, repo_name, operation, fingerprint, patches):
+        self.repo_name = repo_name
+        self.operation = operation
+        self.fingerprint = fingerprint
+        self.patches = [tuple(patch) for patch in patches]
+
+    def __repr__(self):
+        return "<MigrationPlan('%s', %d patches)>" % (self.operation,
+                len(self.patches))
+
+    @property
+    def patch_names(self):
+        return [patch_name for patch_name, _ in self.patches]
+
+def write_plan(plan_path, plan):
+    """Writes `plan` to the plan file `plan_path`. The file is replaced
+    atomically."""
+    tmp_path = '%s.%d.tmp' % (plan_path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        fp.write(PLAN_MAGIC)
+        json.dump({
+            'repo_name': plan.repo_name,
+            'operation': plan.operation,
+            'fingerprint': plan.fingerprint,
+            'patches': plan.patches,
+            }, fp, separators=(',', ':'))
+        fp.write('\n')
+    os.rename(tmp_path, plan_path)
+
+def read_plan(plan_path):
+    """Returns the ``MigrationPlan`` read from the plan file `plan_path`."""
+    with open(plan_path, 'rb') as fp:
+        if fp.read(len(PLAN_MAGIC)) != PLAN_MAGIC:
+            raise InvalidPlan('%s is not a plan file' % plan_path)
+        try:
+            data = json.load(fp)
+            if not isinstance(data['fingerprint'], basestring):
+                raise TypeError('invalid fingerprint')
+            return MigrationPlan(data['repo_name'], data['operation'],
+                    data['fingerprint'], data['patches'])
+        except (ValueError, KeyError, TypeError):
+            raise InvalidPlan('%s is not a valid plan file' % plan_path)
@@ -0,0 +1,69 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Tests the ``spabademy.database.migration.plan`` module.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from __future__ import with_statement
+
+import os.path
+import tempfile
+import shutil
+from nose.tools import eq_
+from nose.tools import raises
+from spabademy.database.migrations.plan import PLAN_MAGIC
+from spabademy.database.migrations.plan import MigrationPlan
+from spabademy.database.migrations.plan import InvalidPlan
+from spabademy.database.migrations.plan import read_plan
+from spabademy.database.migrations.plan import write_plan
+
+class TestPlanFile(object):
+    def __init__(self):
+        self.tmp_dir_path = None
+
+    def setUp(self):
+        self.tmp_dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir_path)
+
+    def test_round_trip(self):
+        plan_path = os.path.join(self.tmp_dir_path, 'plan')
+        write_plan(plan_path, MigrationPlan('repo', 'downgrade', '0abc',
+                [('b', '0123'), ('a', None)]))
+        plan = read_plan(plan_path)
+        eq_(plan.repo_name, 'repo')
+        eq_(plan.operation, 'downgrade')
+        eq_(plan.fingerprint, '0abc')
+        eq_(plan.patches, [('b', '0123'), ('a', None)])
+        eq_(plan.patch_names, ['b', 'a'])
+        eq_(os.listdir(self.tmp_dir_path), ['plan'])
+
+    @raises(InvalidPlan)
+    def test_invalid(self):
+        plan_path = os.path.join(self.tmp_dir_path, 'plan')
+        with open(plan_path, 'wb') as fp:
+            fp.write(PLAN_MAGIC + '{"patches": []}')
+        read_plan(plan_path)
+
+    @raises(InvalidPlan)
+    def test_old_version(self):
+        plan_path = os.path.join(self.tmp_dir_path, 'plan')
+        with open(plan_path, 'wb') as fp:
+            fp.write('SPABADEMY-PLAN 1\n{"repo_name": "repo", "operation": '
+                    '"upgrade", "fingerprint": [2, "b"], "patches": []}')
+        read_plan(plan_path)
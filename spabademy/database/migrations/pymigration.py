@@ -0,0 +1,106 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Provides Python data migrations, which transform rows that plain SQL can't
+handle in chunks of bounded size.
+
+A migration is the Python source of a patch's ``upgrade.py`` or
+``downgrade.py``, which defines:
+
+*QUERY*
+  SQL query returning the rows to transform.
+*KEY*
+  name of the query's column that orders and identifies the rows (an integer
+  or string column, defaults to ``'id'``).
+*transform(conn, rows)*
+  function transforming a chunk of rows, e.g. by executing ``UPDATE``
+  statements on the SQLAlchemy connection `conn`.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from sqlalchemy.sql import text
+from spabademy.database.migrations.patch import script_bytes
+
+# Number of rows passed to each ``transform`` call.
+CHUNK_SIZE = 1000
+
+class InvalidPythonMigration(Exception):
+    """Is raised when a Python migration lacks ``QUERY`` or ``transform``.
+    """
+    pass
+
+class PythonMigration(object):
+    """A Python data migration, as defined by the module-level names of
+    `source` (see the module documentation). `filename` is only used in error
+    messages and tracebacks.
+    """
+    def __init__(self, source, filename):
+        namespace = {'__name__': 'spabademy_migration', '__file__': filename}
+        exec compile(source, filename, 'exec') in namespace
+        if 'QUERY' not in namespace or \
+                not callable(namespace.get('transform')):
+            raise InvalidPythonMigration('%s needs to define QUERY and '
+                    'transform(conn, rows)' % filename)
+        self.query = namespace['QUERY']
+        self.key = namespace.get('KEY', 'id')
+        self.transform = namespace['transform']
+
+    def _select(self, last_key):
+        where = ''
+        if last_key is not None:
+            where = ' WHERE %s > :last_key' % self.key
+        return text('SELECT * FROM (%s) AS migration_rows%s ORDER BY %s' % (
+                self.query, where, self.key))
+
+    def iter_chunks(self, sess, chunk_size=None, last_key=None,
+            restart=False):
+        """Yields the rows of the query, ordered by key and starting after
+        `last_key`, in lists of up to `chunk_size` rows. The query is executed
+        on the session's connection and the rows are streamed through a
+        server-side cursor where the back-end supports it.
+
+        In case `restart` is set, the query is executed again for each chunk,
+        starting after the chunk before. The transaction can then be committed
+        between the chunks, which closes server-side cursors.
+        """
+        if chunk_size is None:
+            chunk_size = CHUNK_SIZE
+        result = None
+        try:
+            while True:
+                if result is None:
+                    result = sess.connection().execution_options(
+                            stream_results=True).execute(
+                                    self._select(last_key), last_key=last_key)
+                rows = result.fetchmany(chunk_size)
+                if restart or len(rows) == 0:
+                    result.close()
+                    result = None
+                if len(rows) == 0:
+                    return
+                last_key = rows[-1][self.key]
+                yield rows
+        finally:
+            if result is not None:
+                result.close()
+
+def load_python_migration(script, filename):
+    """Returns the ``PythonMigration`` defined by `script` (text or a script
+    object) or None in case there is no script."""
+    source = script_bytes(script)
+    if source is None:
+        return None
+    return PythonMigration(source, filename)
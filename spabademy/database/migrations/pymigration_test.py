@@ -0,0 +1,67 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Tests the ``spabademy.database.migration.pymigration`` module.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from nose.tools import eq_
+from nose.tools import raises
+from sqlalchemy.engine import create_engine
+from sqlalchemy.orm.session import sessionmaker
+from spabademy.database.migrations.pymigration import load_python_migration
+from spabademy.database.migrations.pymigration import InvalidPythonMigration
+
+SOURCE = '''
+QUERY = "SELECT code AS k, name FROM t WHERE name IS NOT NULL"
+KEY = 'k'
+
+def transform(conn, rows):
+    pass
+'''
+
+class TestPythonMigration(object):
+    def __init__(self):
+        self.sess = None
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        self.sess = sessionmaker(bind=engine, autocommit=False)()
+        self.sess.execute('CREATE TABLE t(code text, name text)')
+        for code in 'edcba':
+            self.sess.execute("INSERT INTO t VALUES ('%s', 'n%s')" % (
+                    code, code))
+        self.sess.execute("INSERT INTO t VALUES ('f', NULL)")
+
+    def tearDown(self):
+        self.sess.close()
+
+    def test_iter_chunks(self):
+        migration = load_python_migration(SOURCE, 'upgrade.py')
+        eq_(migration.key, 'k')
+        for restart in (False, True):
+            eq_([[row['k'] for row in rows] for rows in migration.iter_chunks(
+                    self.sess, chunk_size=2, restart=restart)],
+                    [['a', 'b'], ['c', 'd'], ['e']])
+        eq_([[row['k'] for row in rows] for rows in migration.iter_chunks(
+                self.sess, chunk_size=2, last_key='c')], [['d', 'e']])
+
+    def test_missing_script(self):
+        eq_(load_python_migration(None, 'upgrade.py'), None)
+
+    @raises(InvalidPythonMigration)
+    def test_invalid(self):
+        load_python_migration('QUERY = "SELECT 1"\n', 'upgrade.py')
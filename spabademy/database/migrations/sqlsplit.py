@@ -0,0 +1,267 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Provides splitting of SQL scripts into single statements.
+
+The splitter knows enough about the SQL syntax to find the statement
+terminating semicolons: it skips quoted strings and identifiers, comments and
+(for PostgreSQL) dollar-quoted strings and keeps ``BEGIN ... END`` bodies
+(e.g. of SQLite triggers) and ``CASE ... END`` expressions together.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+import re
+
+_WORD_START = r'(?<![A-Za-z0-9_$])'
+_WORD_END = r'(?![A-Za-z0-9_$])'
+
+_KEYWORDS = r'%s(?P<keyword>BEGIN|CASE|END)%s' % (_WORD_START, _WORD_END)
+# Constructs closed by "END IF" etc. are not counted as blocks.
+_END_SUFFIX_RE = re.compile(r'\s+(?:(?P<case>CASE)|IF|LOOP|WHILE|REPEAT)%s'
+        % _WORD_END, re.I)
+
+# States of the splitter.
+_NORMAL = 0
+_SINGLE_QUOTE = 1
+_DOUBLE_QUOTE = 2
+_BACKTICK = 3
+_LINE_COMMENT = 4
+_BLOCK_COMMENT = 5
+_DOLLAR_QUOTE = 6
+
+class _Dialect(object):
+    """Describes the lexical details of an SQL dialect."""
+    def __init__(self, dollar_quotes=False, escape_strings=False,
+            backslash_escapes=False, backticks=False, hash_comments=False,
+            nested_comments=False):
+        tokens = [';', "'", '"', '--', r'/\*', _KEYWORDS]
+        if dollar_quotes:
+            tokens.append(r'%s\$(?P<tag>[A-Za-z_][A-Za-z0-9_]*)?\$' % (
+                    _WORD_START))
+        if escape_strings:
+            tokens.append(r"%s[Ee]'" % _WORD_START)
+        if backticks:
+            tokens.append('`')
+        if hash_comments:
+            tokens.append('#')
+        self.normal_re = re.compile('|'.join(tokens), re.I)
+        if backslash_escapes:
+            self.single_quote_re = re.compile(r"\\.|'", re.S)
+            self.double_quote_re = re.compile(r'\\.|"', re.S)
+        else:
+            self.single_quote_re = re.compile("'")
+            self.double_quote_re = re.compile('"')
+        self.escape_string_re = re.compile(r"\\.|'", re.S)
+        self.backtick_re = re.compile('`')
+        if nested_comments:
+            self.block_comment_re = re.compile(r'/\*|\*/')
+        else:
+            self.block_comment_re = re.compile(r'\*/')
+
+_DIALECTS = {
+    'postgresql': _Dialect(dollar_quotes=True, escape_strings=True,
+            nested_comments=True),
+    'mysql': _Dialect(backslash_escapes=True, backticks=True,
+            hash_comments=True),
+    }
+_DEFAULT_DIALECT = _Dialect()
+
+class StatementSplitter(object):
+    """Splits SQL text into statements. The text can be passed in pieces of
+    arbitrary size to ``feed``, which returns the statements completed so far.
+    ``finish`` returns the remaining statement, if any. Only the text of the
+    incomplete statement is kept in memory.
+
+    The statements are returned without the terminating semicolon and
+    surrounding whitespace. Empty statements and statements only consisting
+    of comments are dropped.
+
+    `dialect_name` selects the lexical rules, e.g. ``'postgresql'`` enables
+    dollar quoting and ``'mysql'`` enables backslash escapes. The rules
+    default to standard SQL (which is suitable for SQLite).
+    """
+    def __init__(self, dialect_name=None):
+        self._dialect = _DIALECTS.get(dialect_name, _DEFAULT_DIALECT)
+        self._buf = ''
+        self._pos = 0
+        self._state = _NORMAL
+        self._quote_re = None
+        self._dollar_tag = None
+        self._comment_depth = 0
+        self._block_depth = 0
+        self._has_content = False
+
+    def feed(self, text):
+        """Adds `text` to the script and returns the list of statements that
+        were completed by it.
+        """
+        self._buf += text
+        # Tokens never span lines or semicolons, so the text is scanned up to
+        # the last line break or semicolon. Scripts without line breaks are
+        # thus still split as they arrive.
+        limit = max(self._buf.rfind('\n', self._pos),
+                self._buf.rfind(';', self._pos)) + 1
+        statements = []
+        if limit > self._pos:
+            self._scan(limit, statements, final=False)
+        return statements
+
+    def finish(self):
+        """Returns the list of statements remaining at the end of the
+        script."""
+        statements = []
+        self._scan(len(self._buf), statements, final=True)
+        if self._has_content:
+            statements.append(self._buf.strip())
+        self._buf = ''
+        self._pos = 0
+        self._state = _NORMAL
+        self._block_depth = 0
+        self._has_content = False
+        return statements
+
+    def _scan(self, limit, statements, final):
+        buf = self._buf
+        dialect = self._dialect
+        pos = self._pos
+        # The buffer starts with the current statement. To avoid copying the
+        # buffer for each statement, it is only cut once at the end.
+        start = 0
+        while pos < limit:
+            state = self._state
+            if state == _NORMAL:
+                match = dialect.normal_re.search(buf, pos, limit)
+                end = limit if match is None else match.start()
+                if not self._has_content and \
+                        len(buf[pos:end].strip()) > 0:
+                    self._has_content = True
+                if match is None:
+                    pos = limit
+                    break
+                token = match.group(0)
+                pos = match.end()
+                if token == ';':
+                    if self._block_depth == 0:
+                        if self._has_content:
+                            statements.append(buf[start:match.start()]
+                                    .strip())
+                        start = pos
+                        self._has_content = False
+                elif token == "'":
+                    self._has_content = True
+                    self._state = _SINGLE_QUOTE
+                    self._quote_re = dialect.single_quote_re
+                elif token == '"':
+                    self._has_content = True
+                    self._state = _DOUBLE_QUOTE
+                    self._quote_re = dialect.double_quote_re
+                elif token == '`':
+                    self._has_content = True
+                    self._state = _BACKTICK
+                    self._quote_re = dialect.backtick_re
+                elif token == '--' or token == '#':
+                    self._state = _LINE_COMMENT
+                elif token == '/*':
+                    self._state = _BLOCK_COMMENT
+                    self._comment_depth = 1
+                elif token[0] == '$':
+                    self._has_content = True
+                    self._state = _DOLLAR_QUOTE
+                    self._dollar_tag = token
+                elif token[-1] == "'":
+                    # Escape string constant, e.g. E'\n'.
+                    self._has_content = True
+                    self._state = _SINGLE_QUOTE
+                    self._quote_re = dialect.escape_string_re
+                else:
+                    keyword = match.group('keyword').upper()
+                    if keyword == 'END':
+                        suffix = _END_SUFFIX_RE.match(buf, pos)
+                        if suffix is None and not final and \
+                                len(buf[pos:].strip()) == 0:
+                            # The next word isn't known yet.
+                            pos = match.start()
+                            break
+                        if suffix is not None:
+                            pos = suffix.end()
+                        if (suffix is None or suffix.group('case')) and \
+                                self._block_depth > 0:
+                            self._block_depth -= 1
+                    elif keyword == 'CASE' or self._has_content:
+                        # A BEGIN at the start of the statement starts a
+                        # transaction.
+                        self._block_depth += 1
+                    self._has_content = True
+            elif state == _LINE_COMMENT:
+                end = buf.find('\n', pos, limit)
+                if end == -1:
+                    pos = limit
+                else:
+                    pos = end + 1
+                    self._state = _NORMAL
+            elif state == _BLOCK_COMMENT:
+                match = dialect.block_comment_re.search(buf, pos, limit)
+                if match is None:
+                    pos = limit
+                else:
+                    pos = match.end()
+                    if match.group(0) == '/*':
+                        self._comment_depth += 1
+                    else:
+                        self._comment_depth -= 1
+                        if self._comment_depth == 0:
+                            self._state = _NORMAL
+            elif state == _DOLLAR_QUOTE:
+                end = buf.find(self._dollar_tag, pos, limit)
+                if end == -1:
+                    pos = limit
+                else:
+                    pos = end + len(self._dollar_tag)
+                    self._state = _NORMAL
+            else:
+                match = self._quote_re.search(buf, pos, limit)
+                if match is None:
+                    pos = limit
+                elif len(match.group(0)) == 2:
+                    # Backslash escape.
+                    pos = match.end()
+                else:
+                    quote = match.group(0)
+                    pos = match.end()
+                    if buf[pos:pos + 1] == quote:
+                        # Quote escaped by doubling it.
+                        pos += 1
+                    else:
+                        self._state = _NORMAL
+        self._buf = buf[start:]
+        self._pos = pos - start
+
+def split_statements(sql_text, dialect_name=None):
+    """Returns the list of statements of the SQL script `sql_text`."""
+    splitter = StatementSplitter(dialect_name)
+    statements = splitter.feed(sql_text)
+    statements.extend(splitter.finish())
+    return statements
+
+def iter_statements(chunks, dialect_name=None):
+    """Yields the statements of the SQL script passed as the iterable of
+    pieces of text `chunks`, as soon as they are complete."""
+    splitter = StatementSplitter(dialect_name)
+    for text in chunks:
+        for statement in splitter.feed(text):
+            yield statement
+    for statement in splitter.finish():
+        yield statement
@@ -0,0 +1,87 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Tests the ``spabademy.database.migration.sqlsplit`` module.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from nose.tools import eq_
+from spabademy.database.migrations.sqlsplit import split_statements
+from spabademy.database.migrations.sqlsplit import StatementSplitter
+from spabademy.database.migrations.sqlsplit import iter_statements
+
+def test_simple():
+    eq_(split_statements('CREATE TABLE a(x int);\nINSERT INTO a VALUES (1);'
+            '\n\n;  ; SELECT 1'), ['CREATE TABLE a(x int)',
+            'INSERT INTO a VALUES (1)', 'SELECT 1'])
+
+def test_quotes_and_comments():
+    eq_(split_statements("SELECT 'it''s; here', \"a;b\" -- c; d\n"
+            "FROM t; /* ; */ SELECT 2;\n-- only a comment;\n/* another */"),
+            ["SELECT 'it''s; here', \"a;b\" -- c; d\nFROM t",
+            '/* ; */ SELECT 2'])
+
+def test_begin_end():
+    eq_(split_statements('BEGIN; CREATE TRIGGER t AFTER INSERT ON a BEGIN '
+            'UPDATE a SET x = CASE WHEN x THEN 1 ELSE 2 END; '
+            'DELETE FROM b; END; COMMIT;'), ['BEGIN',
+            'CREATE TRIGGER t AFTER INSERT ON a BEGIN UPDATE a SET x = CASE '
+            'WHEN x THEN 1 ELSE 2 END; DELETE FROM b; END', 'COMMIT'])
+    eq_(split_statements('CREATE TABLE a(begin_date int, ending int); '
+            'SELECT 1'), ['CREATE TABLE a(begin_date int, ending int)',
+            'SELECT 1'])
+
+def test_postgresql():
+    eq_(split_statements('CREATE FUNCTION f() RETURNS int AS $body$ BEGIN '
+            'RETURN 1; END; $body$ LANGUAGE plpgsql; '
+            "SELECT E'a\\';b', $$;$$; /* /* ; */ ; */ SELECT 1",
+            'postgresql'),
+            ['CREATE FUNCTION f() RETURNS int AS $body$ BEGIN RETURN 1; '
+            'END; $body$ LANGUAGE plpgsql', "SELECT E'a\\';b', $$;$$",
+            '/* /* ; */ ; */ SELECT 1'])
+
+def test_mysql():
+    eq_(split_statements("CREATE PROCEDURE p() BEGIN IF 1 THEN SELECT 1; "
+            "END IF; SELECT 'a\\';'; END; SELECT `a;b` # x;\n; SELECT 2",
+            'mysql'), ["CREATE PROCEDURE p() BEGIN IF 1 THEN SELECT 1; "
+            "END IF; SELECT 'a\\';'; END", 'SELECT `a;b` # x;', 'SELECT 2'])
+
+def test_feed_pieces():
+    script = "CREATE TRIGGER t AFTER INSERT ON a BEGIN\n SELECT 1;\n END\n" \
+            ";\nINSERT INTO a VALUES ('x\n;y'); -- z;\n" * 5
+    expected = split_statements(script)
+    eq_(len(expected), 10)
+    for piece_len in [1, 2, 7, 100]:
+        splitter = StatementSplitter()
+        statements = []
+        for pos in range(0, len(script), piece_len):
+            statements.extend(splitter.feed(script[pos:pos + piece_len]))
+        statements.extend(splitter.finish())
+        eq_(statements, expected)
+
+def test_feed_without_newlines():
+    splitter = StatementSplitter()
+    for i in range(100):
+        eq_(splitter.feed("INSERT INTO a VALUES (%d, 'a;b'); " % i),
+                ["INSERT INTO a VALUES (%d, 'a;b')" % i])
+    eq_(splitter.feed('SELECT 1 -- x; y'), [])
+    eq_(splitter.finish(), ['SELECT 1 -- x; y'])
+
+def test_iter_statements():
+    pieces = ['SELECT 1;\nSELE', 'CT 2;', '\nSELECT 3']
+    statements = iter_statements(iter(pieces))
+    eq_(statements.next(), 'SELECT 1')
+    eq_(list(statements), ['SELECT 2', 'SELECT 3'])
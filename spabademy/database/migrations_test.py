@@ -0,0 +1,129 @@
+# vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
+'''
+Tests the ``spabademy.database.migrations`` package.
+'''
+# Copyright © 2011  Fabian Knittel <fabian.knittel@lettink.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from sqlalchemy.engine import create_engine
+from sqlalchemy.orm.session import sessionmaker
+from sqlalchemy import event
+from nose.tools import eq_
+from spabademy.database.migrations import check_repository_has_patches
+from spabademy.database.migrations import SchemaGuard
+from spabademy.database.migrations import SqlMigrationException
+from spabademy.database.migrations.driver import Driver
+from spabademy.database.migrations.db import AppliedPatch
+from spabademy.database.migrations.patch import PatchRepository
+from spabademy.database.migrations.patch import Patch
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class TestSchemaGuard(object):
+    def __init__(self):
+        self.engine = None
+        self.sess = None
+        self.driver = None
+        self.statements = None
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Session = sessionmaker(bind=self.engine)
+        self.sess = Session()
+
+        patchrepo = PatchRepository(repo_name='test_repo')
+        patchrepo.add_patches(Patch('patch1'), Patch('patch2'),
+                Patch('patch3'))
+        patchrepo.resolve_dependencies()
+        self.driver = Driver(self.sess, patchrepo)
+        self.driver.init_repo(patches=patchrepo.lookup_patch_names(
+                ['patch1', 'patch2']))
+        self.sess.commit()
+
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute',
+                self._count_statement)
+
+    def _count_statement(self, _conn, _cursor, statement, *_):
+        self.statements.append(statement)
+
+    def assert_missing(self, func, not_applied):
+        try:
+            func()
+        except SqlMigrationException, ex:
+            assert str(not_applied) in ex.args[0], ex.args[0]
+        else:
+            assert False, 'expected SqlMigrationException'
+
+    def test_check_repository_has_patches(self):
+        check_repository_has_patches(self.sess, 'test_repo',
+                ['patch1', 'patch2'])
+        self.assert_missing(lambda: check_repository_has_patches(self.sess,
+                'test_repo', ['patch3', 'patch1', 'patch4']),
+                ['patch3', 'patch4'])
+        eq_(len(self.statements), 2)
+
+    def test_cached_check(self):
+        clock = FakeClock()
+        guard = SchemaGuard('test_repo', ['patch1', 'patch2'], ttl=10,
+                clock=clock)
+        guard.check(self.sess)
+        num_statements = len(self.statements)
+        guard.check(self.sess)
+        clock.now += 5
+        guard.check(self.sess)
+        eq_(len(self.statements), num_statements)
+
+        # After expiry, only the required patches are looked up, with one
+        # query.
+        clock.now += 10
+        guard.check(self.sess)
+        eq_(len(self.statements), num_statements + 1)
+        assert 'patch_name IN (' in self.statements[-1], self.statements[-1]
+
+    def test_revalidate_detects_change(self):
+        clock = FakeClock()
+        guard = SchemaGuard('test_repo', ['patch1', 'patch3'], ttl=10,
+                clock=clock)
+        self.assert_missing(lambda: guard.check(self.sess), ['patch3'])
+
+        self.driver.upgrade(execute_sql=False)
+        # Still cached.
+        self.assert_missing(lambda: guard.check(self.sess), ['patch3'])
+        eq_(guard.revalidate(self.sess).not_applied, [])
+        guard.check(self.sess)
+
+    def test_revalidate_detects_swap(self):
+        # Swapping patch1 for patch0 keeps the number of applied patches and
+        # the largest name.
+        guard = SchemaGuard('test_repo', ['patch1'])
+        guard.check(self.sess)
+        repository_id = self.driver._get_repository_id()
+        AppliedPatch.remove_all(self.sess, repository_id, ['patch1'])
+        AppliedPatch.add_all(self.sess, repository_id, ['patch0'])
+        eq_(guard.revalidate(self.sess).not_applied, ['patch1'])
+
+    def test_invalidate(self):
+        guard = SchemaGuard('test_repo', ['patch3'])
+        self.assert_missing(lambda: guard.check(self.sess), ['patch3'])
+        self.driver.upgrade(execute_sql=False)
+        guard.invalidate(self.engine)
+        guard.check(self.sess)
@@ -20,15 +20,61 @@
 import sys
 import os.path
 import argparse
+import tempfile
+import shutil
+try:
+    import json
+except ImportError:
+    import simplejson as json
 from sqlalchemy.engine.url import make_url
 from sqlalchemy.engine import create_engine
 from sqlalchemy.orm.session import sessionmaker
 from sqlalchemy import exc as sa_exc
 from spabademy.database import build_description_url
+from spabademy.database import table_exists
 from spabademy.database.migrations.driver import Driver
 from spabademy.database.migrations.driver import PatchFailedException
+from spabademy.database.migrations.driver import TRANSACTION_MODES
+from spabademy.database.migrations.driver import TRANSACTION_SINGLE
+from spabademy.database.migrations.driver import TRANSACTION_SAVEPOINT
+from spabademy.database.migrations.db import AppliedPatch
+from spabademy.database.migrations.db import PatchRun
+from spabademy.database.migrations.db import list_schemas
+from spabademy.database.migrations.db import enable_savepoints
 from spabademy.database.migrations.patch import DirPatchLoader
 from spabademy.database.migrations.patch import DirPatchRepositoryLoader
+from spabademy.database.migrations.patch import \
+        ParallelDirPatchRepositoryLoader
+from spabademy.database.migrations.patch import \
+        ReachablePatchRepositoryLoader
+from spabademy.database.migrations.patch import PatchDependencyCycle
+from spabademy.database.migrations.patch import PatchRepository
+from spabademy.database.migrations.plan import PlanMismatch
+from spabademy.database.migrations.plan import read_plan
+from spabademy.database.migrations.plan import write_plan
+from spabademy.database.migrations.index import CachedDirPatchRepositoryLoader
+from spabademy.database.migrations.pack import PackedPatchRepositoryLoader
+from spabademy.database.migrations.pack import pack_repo
+from spabademy.database.migrations.online import OnlinePolicy
+from spabademy.database.migrations.online import LOCK_TIMEOUT
+from spabademy.database.migrations.online import RETRY_BUDGET
+from spabademy.database.migrations.events import JsonLinesExporter
+from spabademy.database.migrations.events import TimingSummary
+from spabademy.database.migrations.history import RunHistoryRecorder
+from spabademy.database.migrations.history import ProgressReporter
+from spabademy.database.migrations.history import expected_durations
+from spabademy.database.migrations.history import summarize_runs
+from spabademy.database.migrations.history import PERCENTILES
+from spabademy.database.migrations.benchmark import SHAPES
+from spabademy.database.migrations.benchmark import run_benchmarks
+from spabademy.database.migrations.benchmark import compare_results
+from spabademy.database.migrations.fleet import describe_url
+from spabademy.database.migrations.fleet import read_url_file
+from spabademy.database.migrations.fleet import run_on_databases
+from spabademy.database.migrations.fleet import run_on_schemas
+from spabademy.database.migrations.fleet import RESULT_OK
+from spabademy.database.migrations.fleet import RESULT_FAILED
+from spabademy.database.migrations.fleet import RESULT_SKIPPED
 from spabademy import TextUserHostPasswordPrompt
 
 PATCH_REPO_PATH = os.path.join('sql_patches')
@@ -136,19 +182,24 @@ def cmd_status(driver, **_):
 def cmd_upgrade(options, repo, driver):
     execute_sql = (not options.skip_sql)
     if len(options.patches) > 0:
-        driver.upgrade_patches(repo.lookup_patch_names(options.patches),
+        patches = repo.lookup_patch_names(options.patches)
+    else:
+        patches = repo.patches.values()
+    if options.parallel > 0:
+        if options.simulate:
+            print >>sys.stderr, "error: parallel upgrades commit each patch "\
+                    "and cannot be simulated."
+            sys.exit(1)
+        driver.upgrade_patches_parallel(patches, num_workers=options.parallel,
                 execute_sql=execute_sql)
     else:
-        driver.upgrade(execute_sql=execute_sql)
+        driver.upgrade_patches(patches, execute_sql=execute_sql)
 
 def cmd_renew(options, repo, driver):
     driver.renew_patches(repo.lookup_patch_names(options.patches))
 
 def cmd_test(options, repo, driver):
-    if not options.simulate:
-        print >>sys.stderr, "notice: enforcing simulation"
-        options.simulate = True
-
+    # The simulation is enforced by check_options.
     if len(options.patches) > 0:
         driver.test_upgrade_patches(repo.lookup_patch_names(options.patches))
     else:
@@ -162,6 +213,53 @@ def cmd_downgrade(options, repo, driver):
     else:
         driver.downgrade(execute_sql=execute_sql)
 
+def cmd_plan(options, repo, driver):
+    if options.downgrade:
+        operation = 'downgrade'
+        if len(options.patches) > 0:
+            patches = repo.lookup_patch_names(options.patches)
+        else:
+            patches = driver.applied_patches
+    else:
+        operation = 'upgrade'
+        if len(options.patches) > 0:
+            patches = repo.lookup_patch_names(options.patches)
+        else:
+            patches = repo.patches.values()
+    plan = driver.make_plan(operation, patches)
+    write_plan(options.output, plan)
+    print "notice: planned %s of %d patches into '%s'" % (operation,
+            len(plan.patches), options.output)
+
+def cmd_apply(options, repo, driver):
+    driver.apply_plan(options.plan, execute_sql=not options.skip_sql)
+
+def read_run_history(sess, repo_name, patch_names=None):
+    """Returns the recorded runs of the repository's patches (see
+    ``PatchRun.get_durations``) or an empty list, in case nothing was recorded
+    yet."""
+    if not table_exists(sess, PatchRun.__tablename__):
+        return []
+    return PatchRun.get_durations(sess, repo_name, patch_names)
+
+def cmd_history(options, repo, driver):
+    patch_names = options.patches if len(options.patches) > 0 else None
+    summary = summarize_runs(read_run_history(driver.sess, driver.repo_name,
+            patch_names))
+    if len(summary) == 0:
+        print "No recorded patch runs."
+        return
+    def seconds(value):
+        return '-' if value is None else '%.3fs' % value
+    print '%-40s %-9s %5s %6s %s %9s' % ('patch', 'operation', 'runs',
+            'failed', ' '.join('%9s' % ('p%d' % percent)
+                    for percent in PERCENTILES), 'max')
+    for patch_name, operation, num_runs, num_failed, percentiles, maximum \
+            in summary:
+        print '%-40s %-9s %5d %6d %s %9s' % (patch_name, operation, num_runs,
+                num_failed, ' '.join('%9s' % seconds(value)
+                        for value in percentiles), seconds(maximum))
+
 def cmd_calc_minimal(options, repo, driver):
     minimal_patches = list(driver.calculate_minimal_deps(
             patches=repo.lookup_patch_names(options.patches)))
@@ -202,10 +300,194 @@ def open_engine(url_str):
         print >>sys.stderr, "Received Ctrl-C, exiting."
         sys.exit(1)
 
-def main():
+def load_repo(options):
+    """Returns the repository of all patches from the default and the
+    additional patch repositories. Repositories can either be directories of
+    patches or pack files.
+    """
+    if options.index_cache is not None:
+        repo_loader = CachedDirPatchRepositoryLoader(
+                patch_loader=DirPatchLoader(), cache_dir=options.index_cache)
+    elif options.load_threads > 0:
+        repo_loader = ParallelDirPatchRepositoryLoader(
+                patch_loader=DirPatchLoader(),
+                num_threads=options.load_threads)
+    else:
+        repo_loader = DirPatchRepositoryLoader(patch_loader=DirPatchLoader())
+    pack_loader = PackedPatchRepositoryLoader()
+
+    def load(repo_path):
+        if os.path.isfile(repo_path):
+            return pack_loader.load_repo(repo_path)
+        return repo_loader.load_repo(repo_path)
+
+    repo = load(PATCH_REPO_PATH)
+    for repo_path in options.repo_paths:
+        override_repo = load(repo_path)
+        repo.patches.update(override_repo.patches)
+    return repo
+
+def load_reachable_repo(sess, options):
+    """Returns the repository of the patches reachable from the requested
+    and the already applied patches.
+    """
+    repo_loader = ReachablePatchRepositoryLoader(patch_loader=DirPatchLoader(),
+            repo_dirs=[PATCH_REPO_PATH] + options.repo_paths)
+    root_names = list(options.patches)
+    if table_exists(sess, AppliedPatch.__tablename__):
+        root_names.extend(sorted(AppliedPatch.get_names(sess,
+                repo_loader.load_repo_name())))
+    return repo_loader.load_repo(root_names)
+
+def load_plan_repo(options):
+    """Reads the plan file of the ``apply`` command into ``options.plan`` and
+    returns the repository of only the planned patches. Their dependencies are
+    neither loaded nor resolved.
+    """
+    options.plan = read_plan(options.plan_file)
+    patch_names = [patch_name for patch_name, content_hash
+            in options.plan.patches if content_hash is not None]
+    repo_paths = [PATCH_REPO_PATH] + options.repo_paths
+    if any(os.path.isfile(repo_path) for repo_path in repo_paths):
+        # Pack files are cheap to load completely.
+        repo = load_repo(options)
+    else:
+        repo = ReachablePatchRepositoryLoader(patch_loader=DirPatchLoader(),
+                repo_dirs=repo_paths).load_patches(patch_names)
+    planned = PatchRepository(repo_name=options.plan.repo_name)
+    planned.add_patches(*[repo.patches[patch_name]
+            for patch_name in patch_names if patch_name in repo.patches])
+    return planned
+
+def load_command_repo(options):
+    """Returns the repository needed by the selected command, with resolved
+    dependencies unless a plan is applied."""
+    if getattr(options, 'loads_plan', False):
+        return load_plan_repo(options)
+    repo = load_repo(options)
+    repo.resolve_dependencies()
+    return repo
+
+def add_repo_arguments(parser):
+    parser.add_argument('--add-repo', help='additional repository of patches '
+            'to query', metavar='REPO', dest='repo_paths',
+            action='append', default=[])
+    parser.add_argument('--load-threads', help='load the patch repositories '
+            'with NUM parallel threads (defaults to loading serially)',
+            metavar='NUM', type=int, default=0)
+    parser.add_argument('--index-cache', help='keep compiled indexes of the '
+            'patch repositories in DIR and only re-read modified patches',
+            metavar='DIR', default=None)
+
+def pack_main():
     parser = argparse.ArgumentParser(
-            description='Migrate SQL schemas (and data) from one set of SQL '
-            'patches to another set.')
+            description='Pack the SQL patches of a repository into a single '
+            'file, which can be used in place of the patch directory.')
+    add_repo_arguments(parser)
+    parser.add_argument('output', help='path of the pack file to write')
+
+    options = parser.parse_args()
+
+    repo = load_repo(options)
+    repo.resolve_dependencies()
+    pack_repo(options.output, repo)
+    print "notice: packed %d patches into '%s'" % (len(repo.patches),
+            options.output)
+
+def benchmark_main():
+    parser = argparse.ArgumentParser(
+            description='Benchmark the patch loader, the planners and the '
+            'driver on generated patch repositories and write the results as '
+            'JSON.')
+    parser.add_argument('--shape', help='shape of the generated '
+            'repositories (may be given more than once, defaults to all '
+            'shapes)', dest='shapes', action='append', choices=SHAPES,
+            default=[])
+    parser.add_argument('--patches', help='number of patches per generated '
+            'repository (defaults to 10000)', metavar='NUM', type=int,
+            default=10000)
+    parser.add_argument('--driver-patches', help='number of patches upgraded '
+            'and downgraded by the driver benchmarks, 0 to skip them '
+            '(defaults to 1000)', metavar='NUM', type=int, default=1000)
+    parser.add_argument('--repeats', help='run each benchmark NUM times '
+            '(defaults to 3)', metavar='NUM', type=int, default=3)
+    parser.add_argument('--optional-ratio', help='fraction of optional '
+            'dependencies (defaults to 0.1)', metavar='RATIO', type=float,
+            default=0.1)
+    parser.add_argument('--seed', help='seed of the generated repositories '
+            '(defaults to 0)', metavar='NUM', type=int, default=0)
+    parser.add_argument('--split-statements', help='let the driver split the '
+            'patch scripts into single statements', action='store_true',
+            default=False)
+    parser.add_argument('--work-dir', help='generate the repositories and '
+            'databases within the new directory DIR and keep them (defaults to '
+            'a temporary directory)', metavar='DIR', default=None)
+    parser.add_argument('--output', help='write the results to FILE instead '
+            'of standard output', metavar='FILE', default=None)
+    parser.add_argument('--compare', help='compare the results to the '
+            'results in FILE and fail in case a benchmark became slower',
+            metavar='FILE', default=None)
+    parser.add_argument('--max-slowdown', help='factor by which a benchmark '
+            'may become slower than in the compared results (defaults to 1.2)',
+            metavar='FACTOR', type=float, default=1.2)
+
+    options = parser.parse_args()
+    if options.repeats < 1:
+        parser.error('--repeats needs to be at least 1')
+
+    baseline = None
+    if options.compare is not None:
+        with open(options.compare, 'r') as fp:
+            baseline = json.load(fp)
+
+    if options.work_dir is not None:
+        work_dir = options.work_dir
+        os.makedirs(work_dir)
+    else:
+        work_dir = tempfile.mkdtemp(prefix='spabademy-benchmark-')
+    def progress(message):
+        print >>sys.stderr, "notice: %s" % message
+    try:
+        run = run_benchmarks(work_dir, shapes=options.shapes or SHAPES,
+                num_patches=options.patches,
+                driver_patches=options.driver_patches,
+                repeats=options.repeats, optional_ratio=options.optional_ratio,
+                seed=options.seed, split_scripts=options.split_statements,
+                progress=progress)
+    finally:
+        if options.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    if options.output is not None:
+        with open(options.output, 'w') as fp:
+            json.dump(run, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+    else:
+        json.dump(run, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if baseline is not None:
+        num_regressed = 0
+        for benchmark, shape, num_patches, baseline_time, current_time, \
+                regressed in compare_results(baseline, run,
+                        max_slowdown=options.max_slowdown):
+            print >>sys.stderr, "%s: %s %s/%d %.4fs -> %.4fs (%+.1f%%)" % (
+                    'regression' if regressed else 'ok', benchmark, shape,
+                    num_patches, baseline_time, current_time,
+                    (current_time / baseline_time - 1) * 100
+                            if baseline_time > 0 else 0.0)
+            if regressed:
+                num_regressed += 1
+        if num_regressed > 0:
+            print >>sys.stderr, "error: %d benchmarks became slower" % (
+                    num_regressed)
+            sys.exit(1)
+
+def build_parser(description):
+    """Returns the argument parser for the migration commands and the options
+    shared by ``main`` and ``fleet_main``.
+    """
+    parser = argparse.ArgumentParser(description=description)
     cmd_parser = parser.add_subparsers(title='migration commands',
             description='the list of migration operations that can be '
             'performed')
@@ -242,14 +524,18 @@ def main():
     upgrade_parser.add_argument('--skip-sql', help='only modify the metadata '
             'but do not execute the SQL of the patches', action='store_true',
             default=False)
-    upgrade_parser.set_defaults(cmd_func=cmd_upgrade)
+    upgrade_parser.add_argument('--parallel', help='apply independent patches '
+            'marked as parallel-safe on NUM concurrent connections, '
+            'committing each patch separately', metavar='NUM', type=int,
+            default=0)
+    upgrade_parser.set_defaults(cmd_func=cmd_upgrade, loads_reachable=True)
 
     test_parser = cmd_parser.add_parser('test', help='test the '
             'specified SQL patch')
     test_parser.add_argument('patches', metavar='PATCH', nargs='*',
             help='list of patches that will be tested (defaults to all '
             'missing patches)', default=[])
-    test_parser.set_defaults(cmd_func=cmd_test)
+    test_parser.set_defaults(cmd_func=cmd_test, loads_reachable=True)
 
     downgrade_parser = cmd_parser.add_parser('downgrade', help='downgrade the '
             'repository by reverting SQL patches')
@@ -270,6 +556,34 @@ def main():
             default=[])
     renew_parser.set_defaults(cmd_func=cmd_renew)
 
+    plan_parser = cmd_parser.add_parser('plan', help='compute the plan of '
+            'an upgrade or downgrade and write it to a file, which can be '
+            'applied later on with the apply command')
+    plan_parser.add_argument('output', help='path of the plan file to write')
+    plan_parser.add_argument('patches', metavar='PATCH', nargs='*',
+            help='list of patches to apply or remove (defaults to all missing '
+            'or all applied patches, respectively)', default=[])
+    plan_parser.add_argument('--downgrade', help='plan a downgrade instead '
+            'of an upgrade', action='store_true', default=False)
+    plan_parser.set_defaults(cmd_func=cmd_plan)
+
+    apply_parser = cmd_parser.add_parser('apply', help='apply a plan written '
+            'by the plan command, in case the applied patches didn\'t change '
+            'since planning')
+    apply_parser.add_argument('plan_file', metavar='PLAN', help='path of the '
+            'plan file')
+    apply_parser.add_argument('--skip-sql', help='only modify the metadata '
+            'but do not execute the SQL of the patches', action='store_true',
+            default=False)
+    apply_parser.set_defaults(cmd_func=cmd_apply, loads_plan=True)
+
+    history_parser = cmd_parser.add_parser('history', help='summarise the '
+            'recorded durations of the patch upgrades and downgrades')
+    history_parser.add_argument('patches', metavar='PATCH', nargs='*',
+            help='list of patches to summarise (defaults to all patches)',
+            default=[])
+    history_parser.set_defaults(cmd_func=cmd_history)
+
     calc_minimal_parser = cmd_parser.add_parser('calc-minimal',
             help='calculcate the minimal set of patches necessary to cause the '
             'listed set of patches to be applied')
@@ -277,48 +591,300 @@ def main():
             help='list of patches for which the minimal set will be determined')
     calc_minimal_parser.set_defaults(cmd_func=cmd_calc_minimal)
 
-    parser.add_argument('--add-repo', help='additional repository of patches '
-            'to query', metavar='REPO', dest='repo_paths',
-            action='append', default=[])
+    add_repo_arguments(parser)
     parser.add_argument('--simulate', help='rollback all changes afterwards',
             action='store_true', default=False)
+    parser.add_argument('--split-statements', help='split the patch scripts '
+            'into single statements and execute them one by one within the '
+            'transaction', action='store_true', default=False)
+    parser.add_argument('--stream-batch-size', help='read the patch scripts '
+            'piece by piece and execute their statements in batches of NUM '
+            'statements within the transaction, keeping the memory usage low '
+            'for huge scripts', metavar='NUM', type=int, default=None)
+    parser.add_argument('--data-batch-size', help='insert the rows of the '
+            'patches\' data files in batches of NUM rows, unless they are '
+            'loaded with COPY', metavar='NUM', type=int, default=None)
+    parser.add_argument('--chunk-size', help='pass chunks of NUM rows to the '
+            'patches\' Python migrations (defaults to 1000)', metavar='NUM',
+            type=int, default=None)
+    parser.add_argument('--commit-chunks', help='commit after each chunk of '
+            'a Python migration and after each patch, so that an interrupted '
+            'migration resumes after the last committed chunk',
+            action='store_true', default=False)
+    parser.add_argument('--transaction-mode', help='commit all patches '
+            'at once at the end (single, the default), each patch on its own '
+            '(per-patch) or every --commit-every patches, with a savepoint '
+            'around each patch (savepoint)', choices=TRANSACTION_MODES,
+            default=TRANSACTION_SINGLE)
+    parser.add_argument('--commit-every', help='in the savepoint transaction '
+            'mode, commit after every NUM patches (defaults to 1)',
+            metavar='NUM', type=int, default=1)
+    parser.add_argument('--online', help='apply the patches to a database '
+            'in use: run each patch with lock and statement timeouts within a '
+            'savepoint and retry it with backoff when it times out waiting '
+            'for a lock', action='store_true', default=False)
+    parser.add_argument('--lock-timeout', help='in online mode, let '
+            'statements wait at most SECONDS for a lock (defaults to %g)' % (
+                    LOCK_TIMEOUT), metavar='SECONDS', type=float,
+            default=LOCK_TIMEOUT)
+    parser.add_argument('--statement-timeout', help='in online mode, cancel '
+            'statements running longer than SECONDS (PostgreSQL only)',
+            metavar='SECONDS', type=float, default=None)
+    parser.add_argument('--retry-budget', help='in online mode, stop '
+            'retrying a patch SECONDS after its first attempt timed out '
+            '(defaults to %g)' % RETRY_BUDGET, metavar='SECONDS', type=float,
+            default=RETRY_BUDGET)
+    parser.add_argument('--load-reachable', help='when upgrading or testing '
+            'specific patches, only load the patches reachable from them and '
+            'from the already applied patches', action='store_true',
+            default=False)
+    return parser
+
+def check_options(parser, options):
+    """Rejects combinations of the options added by ``build_parser`` that
+    contradict each other. The test command is always simulated, which is
+    decided here, before any listeners are attached to the drivers."""
+    if options.cmd_func is cmd_test and not options.simulate:
+        print >>sys.stderr, "notice: enforcing simulation"
+        options.simulate = True
+    if options.commit_chunks and options.simulate:
+        parser.error('--commit-chunks commits the changes and cannot be '
+                'combined with a simulation')
+    if options.transaction_mode != TRANSACTION_SINGLE and options.simulate:
+        parser.error('--transaction-mode %s commits the changes and cannot be '
+                'combined with a simulation' % options.transaction_mode)
+    if options.transaction_mode == TRANSACTION_SAVEPOINT and \
+            options.commit_chunks:
+        parser.error('--commit-chunks cannot be combined with the savepoint '
+                'transaction mode')
+    if options.online and options.commit_chunks:
+        parser.error('--commit-chunks cannot be combined with --online')
+    if options.commit_every < 1:
+        parser.error('--commit-every needs to be at least 1')
+
+def driver_options(options):
+    """Returns the keyword arguments of ``Driver`` selected by the options."""
+    return {
+        'split_scripts': options.split_statements,
+        'stream_batch_size': options.stream_batch_size,
+        'data_batch_size': options.data_batch_size,
+        'chunk_size': options.chunk_size,
+        'commit_chunks': options.commit_chunks,
+        'transaction_mode': options.transaction_mode,
+        'commit_every': options.commit_every,
+        'online': online_policy(options),
+        }
+
+def online_policy(options):
+    """Returns the ``OnlinePolicy`` selected by the options or None, if
+    online mode wasn't requested."""
+    if not options.online:
+        return None
+    return OnlinePolicy(lock_timeout=options.lock_timeout,
+            statement_timeout=options.statement_timeout,
+            retry_budget=options.retry_budget)
+
+def main():
+    parser = build_parser(description='Migrate SQL schemas (and data) from '
+            'one set of SQL patches to another set.')
+    parser.add_argument('--schema', help='apply the command to the '
+            'PostgreSQL schema NAME instead of the public schema, with '
+            'book-keeping tables of its own (may be given more than once)',
+            metavar='NAME', dest='schemas', action='append', default=[])
+    parser.add_argument('--schema-pattern', help='apply the command to all '
+            'PostgreSQL schemas matching the LIKE pattern PATTERN',
+            metavar='PATTERN', default=None)
+    add_fan_out_arguments(parser, 'schemas')
+    parser.add_argument('--trace', help='write a trace of the migration '
+            'steps and their timings to FILE, one JSON object per line',
+            metavar='FILE', default=None)
+    parser.add_argument('--timing-summary', help='print the NUM slowest '
+            'patches and the time spent on the other migration steps',
+            metavar='NUM', type=int, default=None)
+    parser.add_argument('--history', help='record the patch runs in the run '
+            'history (adds a listener to every migration step and writes the '
+            'runs to the database at the end)', action='store_true',
+            default=False)
+    parser.add_argument('--no-progress', help='do not report the progress '
+            'and the estimated remaining time after each patch (only '
+            'reported on terminals)', dest='progress', action='store_false',
+            default=True)
     parser.add_argument('url', help='SQL database connection URL')
 
     options = parser.parse_args()
+    check_options(parser, options)
+
+    if len(options.schemas) > 0 or options.schema_pattern is not None:
+        if options.cmd_func is cmd_plan:
+            parser.error('plans are computed for a single schema')
+        schemas_main(options)
+        return
 
     engine = open_engine(options.url)
+    if options.transaction_mode == TRANSACTION_SAVEPOINT or options.online:
+        enable_savepoints(engine)
     Session = sessionmaker(bind=engine, autocommit=False)
     sess = Session()
 
-    repo_loader = DirPatchRepositoryLoader(patch_loader=DirPatchLoader())
-    repo = repo_loader.load_repo(PATCH_REPO_PATH)
-    for repo_path in options.repo_paths:
-        override_repo = repo_loader.load_repo(repo_path)
-        repo.patches.update(override_repo.patches)
-    repo.resolve_dependencies()
+    if options.load_reachable and getattr(options, 'loads_reachable', False) \
+            and len(options.patches) > 0 and \
+            not any(os.path.isfile(repo_path) for repo_path in
+                    [PATCH_REPO_PATH] + options.repo_paths):
+        # Pack files are cheap to load completely, so only directories are
+        # loaded selectively.
+        repo = load_reachable_repo(sess, options)
+        repo.resolve_dependencies()
+    else:
+        repo = load_command_repo(options)
+
+    driver = Driver(sess, repo, **driver_options(options))
+    trace_fp = None
+    if options.trace is not None:
+        trace_fp = open(options.trace, 'w')
+        driver.add_listener(JsonLinesExporter(trace_fp))
+    timing_summary = None
+    if options.timing_summary is not None:
+        timing_summary = TimingSummary()
+        driver.add_listener(timing_summary)
+    # Simulated runs are not representative.
+    history = None
+    if options.history and not options.simulate:
+        history = RunHistoryRecorder(describe_url(engine.url))
+        driver.add_listener(history)
+    if options.progress and sys.stderr.isatty():
+        driver.add_listener(ProgressReporter(sys.stderr, expected_durations(
+                read_run_history(sess, driver.repo_name))))
 
     try:
-        driver = Driver(sess, repo)
         options.cmd_func(options=options, repo=repo, driver=driver)
         if options.simulate:
             print >>sys.stderr, "notice: simulation option set, rolling back "\
                     "any changes."
-            sess.rollback()
+            driver.rollback()
         else:
-            sess.commit()
+            driver.commit()
     except PatchFailedException, ex:
         print >>sys.stderr, "error: %s" % (ex.args[0])
         if ex.details is not None:
             for detail in ex.details:
                 print >>sys.stderr, "error: details: %s" % (detail)
         print >>sys.stderr, "notice: rolling back any changes to the database."
-        sess.rollback()
+        driver.rollback()
+        sys.exit(1)
+    except (PatchDependencyCycle, PlanMismatch), ex:
+        print >>sys.stderr, "error: %s" % (ex.args[0])
+        print >>sys.stderr, "notice: rolling back any changes to the database."
+        driver.rollback()
         sys.exit(1)
     except:
         print >>sys.stderr, "notice: rolling back any changes to the database "\
                 "due to an error"
-        sess.rollback()
+        driver.rollback()
         raise
+    finally:
+        if trace_fp is not None:
+            trace_fp.close()
+        if timing_summary is not None:
+            for line in timing_summary.format(limit=options.timing_summary):
+                print >>sys.stderr, "timing: %s" % line
+        if history is not None:
+            try:
+                history.flush(sess, driver.repo_name)
+            except Exception, ex:
+                print >>sys.stderr, "warning: could not record the run "\
+                        "history: %s" % ex
+                sess.rollback()
+
+def add_fan_out_arguments(parser, target_name):
+    parser.add_argument('--max-workers', help='process at most NUM '
+            '%s at the same time (defaults to 8)' % target_name,
+            metavar='NUM', type=int, default=8)
+    parser.add_argument('--max-failures', help='skip the remaining %s '
+            'after NUM of them failed' % target_name, metavar='NUM',
+            type=int, default=None)
+
+def fan_out_operation(options):
+    """Returns the operation performed by the selected command on each target
+    of a fan-out. The simulation of the test command is already enforced by
+    ``check_options``, before the fan-out starts."""
+    def operation(driver):
+        options.cmd_func(options=options, repo=driver.patch_repo,
+                driver=driver)
+    return operation
+
+def report_fan_out(results):
+    """Prints the outcome of each target of a fan-out and exits with an error
+    status unless all targets succeeded.
+    """
+    num_results = {}
+    for result in results:
+        num_results[result.status] = num_results.get(result.status, 0) + 1
+        if result.status == RESULT_OK:
+            print "ok: %s (%.2fs)" % (result.description, result.duration)
+        elif result.status == RESULT_FAILED:
+            if result.duration is not None:
+                print >>sys.stderr, "error: %s failed (%.2fs)" % (
+                        result.description, result.duration)
+            else:
+                print >>sys.stderr, "error: %s failed" % (result.description)
+            for error in result.errors:
+                print >>sys.stderr, "error: details: %s" % (error)
+        else:
+            print >>sys.stderr, "notice: %s skipped" % (result.description)
+    print "notice: %d ok, %d failed, %d skipped" % (
+            num_results.get(RESULT_OK, 0), num_results.get(RESULT_FAILED, 0),
+            num_results.get(RESULT_SKIPPED, 0))
+    if num_results.get(RESULT_OK, 0) != len(results):
+        sys.exit(1)
+
+def schemas_main(options):
+    """Performs the selected command on each of the selected schemas of the
+    database.
+    """
+    engine = open_engine(options.url)
+    if engine.dialect.name != 'postgresql':
+        print >>sys.stderr, "error: schemas are only supported by PostgreSQL."
+        sys.exit(1)
+    # Each worker keeps one connection of the pool.
+    engine.dispose()
+    engine = create_engine(engine.url, pool_size=options.max_workers)
+
+    schemas = list(options.schemas)
+    if options.schema_pattern is not None:
+        sess = sessionmaker(bind=engine)()
+        try:
+            schemas.extend(schema for schema in list_schemas(sess,
+                    options.schema_pattern) if schema not in schemas)
+        finally:
+            sess.close()
+
+    repo = load_command_repo(options)
+    results = run_on_schemas(engine, schemas, repo,
+            fan_out_operation(options), num_workers=options.max_workers,
+            max_failures=options.max_failures, simulate=options.simulate,
+            driver_options=driver_options(options))
+    report_fan_out(results)
+
+def fleet_main():
+    parser = build_parser(description='Migrate the SQL schemas (and data) of '
+            'many databases at once from one set of SQL patches to another '
+            'set.')
+    add_fan_out_arguments(parser, 'databases')
+    parser.add_argument('url_file', help='file with one SQL database '
+            'connection URL per line')
+
+    options = parser.parse_args()
+    check_options(parser, options)
+    if options.cmd_func is cmd_plan:
+        parser.error('plans are computed for a single database')
+
+    urls = read_url_file(options.url_file)
+    repo = load_command_repo(options)
+    results = run_on_databases(urls, repo, fan_out_operation(options),
+            num_workers=options.max_workers,
+            max_failures=options.max_failures, simulate=options.simulate,
+            driver_options=driver_options(options))
+    report_fan_out(results)
 
 if __name__ == '__main__':
     main()